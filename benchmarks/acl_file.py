@@ -0,0 +1,61 @@
+"""Measures the throughput of parsing and writing acl.txt files, in entries per second.
+
+A package made from /home can have an acl.txt with 150k entries, which dfu apply parses at every patch step.
+The entries are shuffled, so that writing them includes sorting them.
+
+Usage: uv run python benchmarks/acl_file.py [--entries N] [--runs N]
+"""
+
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+from dfu.package.acl_file import AclFile
+
+
+def generate(entries: int) -> str:
+    rng = random.Random(0)
+    lines = [
+        f"/home/user/project{i % 50}/src/module{i % 400}/file {i}.txt {rng.choice(['644', '755', '600'])} user user\n"
+        for i in range(entries)
+    ]
+    rng.shuffle(lines)
+    return "".join(lines)
+
+
+def measure(function: Callable[[], object], *, runs: int) -> float:
+    durations: list[float] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=150_000)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    content = generate(args.entries)
+    acl_file = AclFile.from_string(content)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "acl.txt"
+        results = {
+            "parse": measure(lambda: AclFile.from_string(content), runs=args.runs),
+            "write": measure(lambda: acl_file.write(path), runs=args.runs),
+        }
+    for name, duration in results.items():
+        print(
+            f"{name:>6}: {args.entries / duration:12,.0f} entries/s "
+            f"({duration * 1000:7.2f}ms for {args.entries:,} entries, median of {args.runs} runs)"
+        )
+
+
+if __name__ == "__main__":
+    main()
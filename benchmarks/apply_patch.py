@@ -0,0 +1,138 @@
+"""Measures how long dfu apply takes to apply a series of patches to the playground, with each strategy.
+
+merge: Cherry-pick the commit from the patch's bundle, which merges the whole tree at once (the default)
+git apply: Apply the patch text, which is what dfu apply does for patches without a bundle
+
+The patches are created the same way as dfu diff, and each one changes some of the files changed by the one before.
+Fetching the bundles is done by both strategies, so it isn't part of the measurement.
+
+Usage: uv run python benchmarks/apply_patch.py [--files N] [--changed N] [--patches N] [--runs N]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+from dfu.api.playground import Playground
+from dfu.revision.git import git_add, git_apply, git_bundle, git_commit, git_diff, git_fetch_head, git_init
+
+LINES_PER_FILE = 20
+
+
+def file_content(path: int, version: int) -> str:
+    lines = [f"setting_{line} = {path * line}\n" for line in range(LINES_PER_FILE)]
+    lines[path % LINES_PER_FILE] = f"changed_setting = {version}\n"
+    return "".join(lines)
+
+
+def file_path(path: int) -> Path:
+    return Path(f"etc/app{path % 100}/file{path}.conf")
+
+
+def write_files(files_dir: Path, versions: dict[int, int]) -> None:
+    for path, version in versions.items():
+        (files_dir / file_path(path)).parent.mkdir(parents=True, exist_ok=True)
+        (files_dir / file_path(path)).write_text(file_content(path, version))
+
+
+def generate(directory: Path, *, files: int, changed: int, patches: int) -> tuple[Path, list[Path]]:
+    """Returns the playground with the base files, and the patches to apply to it in order"""
+    versions = {path: 0 for path in range(files)}
+    playground = directory / "playground"
+    (playground / "files").mkdir(parents=True)
+    git_init(playground)
+    write_files(playground / "files", versions)
+    git_add(playground, ["files"])
+    git_commit(playground, "Initial files")
+
+    patch_files: list[Path] = []
+    for index in range(patches):
+        # Half of the files are the ones changed by the patch before, so the patches depend on each other
+        start = index * changed // 2
+        changed_paths = [(start + offset) % files for offset in range(changed)]
+        repo = directory / f"repo_{index}"
+        (repo / "files").mkdir(parents=True)
+        git_init(repo)
+        write_files(repo / "files", {path: versions[path] for path in changed_paths})
+        git_add(repo, ["files"])
+        git_commit(repo, "Initial files")
+        versions.update({path: index + 1 for path in changed_paths})
+        write_files(repo / "files", {path: versions[path] for path in changed_paths})
+        (repo / "config.json").write_text(json.dumps({"version": "0.0.4", "pack_format": 2}))
+        git_add(repo, ["files", "config.json"])
+        git_commit(repo, "Modified files")
+        patch_file = directory / f"{index:03}_to_{index + 1:03}.patch"
+        git_bundle(repo, patch_file.with_suffix(".pack"))
+        patch_file.write_text(git_diff(repo, "HEAD~1", "HEAD"))
+        patch_files.append(patch_file)
+    return playground, patch_files
+
+
+def apply_with_merge(playground: Playground, commits: list[str]) -> None:
+    for commit in commits:
+        if not playground._merge_commit(commit, reverse=False):
+            raise ValueError(f"Merging {commit} had conflicts")
+        git_commit(playground.location, "Patch")
+
+
+def apply_with_git_apply(playground: Playground, patches: list[Path]) -> None:
+    for patch in patches:
+        if not git_apply(playground.location, patch, exclude=["config.json"]):
+            raise ValueError(f"Applying {patch.name} had conflicts")
+        git_commit(playground.location, "Patch")
+
+
+def measure(function: Callable[[Playground], object], *, base: Path, runs: int) -> float:
+    durations: list[float] = []
+    for run in range(runs):
+        # Each run starts from the base files, with the bundles already fetched
+        playground = Playground(location=base.parent / f"run_{run}")
+        shutil.copytree(base, playground.location, symlinks=True)
+        # The copies have new modification times, so the index is refreshed like after a checkout
+        subprocess.run(["git", "update-index", "--refresh"], cwd=playground.location, check=True, capture_output=True)
+        start = time.perf_counter()
+        function(playground)
+        durations.append(time.perf_counter() - start)
+        shutil.rmtree(playground.location)
+    return statistics.median(durations)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=5_000)
+    parser.add_argument("--changed", type=int, default=500)
+    parser.add_argument("--patches", type=int, default=5)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    # The repositories are temporary, so they don't need the user's git identity
+    for variable in ("GIT_AUTHOR_NAME", "GIT_COMMITTER_NAME"):
+        os.environ.setdefault(variable, "dfu benchmark")
+    for variable in ("GIT_AUTHOR_EMAIL", "GIT_COMMITTER_EMAIL"):
+        os.environ.setdefault(variable, "benchmark@localhost")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base, patches = generate(Path(tmp_dir), files=args.files, changed=args.changed, patches=args.patches)
+        commits = [git_fetch_head(base, str(patch.with_suffix(".pack"))) for patch in patches]
+        results = {
+            "merge": measure(lambda playground: apply_with_merge(playground, commits), base=base, runs=args.runs),
+            "git apply": measure(
+                lambda playground: apply_with_git_apply(playground, patches), base=base, runs=args.runs
+            ),
+        }
+    for name, duration in results.items():
+        print(
+            f"{name:>9}: {duration * 1000:9.2f}ms for {args.patches} patches of {args.changed:,} files "
+            f"in {args.files:,} files (median of {args.runs} runs)"
+        )
+
+
+if __name__ == "__main__":
+    main()
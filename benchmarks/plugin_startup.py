@@ -0,0 +1,69 @@
+"""Measures how long loading the dfu plugins takes in a new interpreter, which is what every dfu command pays.
+
+uncached: Scan every distribution's entry points, and import every plugin (the behavior without the registry)
+registry (cold): Same as uncached, plus writing the registry cache
+registry (warm): Read the registry cache. Plugins are imported later, only if one of their events is dispatched
+
+Usage: uv run python benchmarks/plugin_startup.py [--runs N]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+UNCACHED = """
+from importlib.metadata import entry_points
+for entry_point in entry_points().select(group='dfu.plugin'):
+    entry_point.load()
+"""
+
+REGISTRY = """
+from pathlib import Path
+from dfu.api.plugin_registry import load_registry
+load_registry(Path({cache_path!r}))
+"""
+
+# dfu.api is imported by every command anyway, so it's imported before the timer starts
+TIMER = """
+import time
+import dfu.api.plugin_registry
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+"""
+
+
+def measure(code: str, *, runs: int, before_each: list[Path] | None = None) -> float:
+    durations: list[float] = []
+    for _ in range(runs):
+        for path in before_each or []:
+            path.unlink(missing_ok=True)
+        result = subprocess.run(
+            [sys.executable, "-c", TIMER.format(code=code)], check=True, text=True, capture_output=True
+        )
+        durations.append(float(result.stdout))
+    return statistics.median(durations)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = Path(tmp_dir) / "plugins.json"
+        registry = REGISTRY.format(cache_path=str(cache_path))
+        results = {
+            "uncached": measure(UNCACHED, runs=args.runs),
+            "registry (cold)": measure(registry, runs=args.runs, before_each=[cache_path]),
+            "registry (warm)": measure(registry, runs=args.runs),
+        }
+    for name, duration in results.items():
+        print(f"{name:>16}: {duration * 1000:7.2f}ms (median of {args.runs} runs)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,15 @@
-from .__about__ import __version__
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .__about__ import __version__
 
 __all__ = ["__version__"]
+
+
+def __getattr__(name: str) -> Any:
+    # Looking up the version reads the installed package metadata, so it's only done when something needs it
+    if name == "__version__":
+        from .__about__ import __version__
+
+        return __version__
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,27 +1,42 @@
+import fcntl
 import grp
 import os
 import pwd
+import secrets
 import subprocess
+import time
 from collections.abc import Iterable
 from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
 from shutil import rmtree
-from tempfile import mkdtemp
+from tempfile import NamedTemporaryFile, gettempdir, mkdtemp
 from typing import Generator
 
 import click
 from unidiff import PatchedFile, PatchSet
 from unidiff.constants import DEV_NULL
 
+from dfu.config import LargeFiles
+from dfu.package.acl_file import AclFile
+from dfu.package.objects import POINTER_PREFIX, ObjectPointer, ObjectStore, should_externalize
 from dfu.package.patch_config import PatchConfig
-from dfu.revision.git import git_add_remote, git_apply, git_fetch
+from dfu.revision.git import (
+    git_apply,
+    git_cherry_pick,
+    git_fetch_head,
+    git_grep_staged,
+    git_rev_parse,
+    git_rm,
+    git_show_staged,
+)
 
 
 @dataclass
 class CopyFile:
     source: Path
     target: Path
+    recursive: bool = False
 
     def __post_init__(self) -> None:
         if not self.source.is_absolute():
@@ -30,23 +45,34 @@ class CopyFile:
             raise ValueError(f"CopyFile target must be an absolute path, got: {self.target}")
 
 
+TEMPORARY_PREFIX = 'dfu_'
+# Playgrounds are renamed to this before they are removed, so that a removal which didn't finish can be found later
+TRASH_PREFIX = 'dfu_trash_'
+
+
 class Playground:
     location: Path
+    _lock_fd: int | None
 
-    def __init__(self, location: Path | None = None, prefix: str = 'dfu') -> None:
+    def __init__(self, location: Path | None = None, prefix: str = TEMPORARY_PREFIX) -> None:
+        self._lock_fd = None
         if location is None:
             location = Path(mkdtemp(prefix=prefix))
+            # Temporary playgrounds are locked while they're in use, so that dfu gc can tell which ones were leaked
+            self._lock_fd = _lock_directory(location)
 
         self.location = location.resolve()
 
     @classmethod
     @contextmanager
-    def temporary(cls, location: Path | None = None, prefix: str = 'dfu') -> Generator['Playground', None, None]:
+    def temporary(
+        cls, location: Path | None = None, prefix: str = TEMPORARY_PREFIX
+    ) -> Generator['Playground', None, None]:
         playground = cls(location=location, prefix=prefix)
         try:
             yield playground
         finally:
-            playground.cleanup()
+            playground.cleanup(background=True)
 
     def list_files_in_patch(
         self,
@@ -69,7 +95,84 @@ class Playground:
 
         return files
 
-    def copy_files_from_filesystem(self, paths: Iterable[CopyFile]) -> None:
+    def list_acl_changes_in_patch(self, patch: Path) -> AclFile:
+        # Returns the acl.txt entries which the patch adds or removes
+        acl_lines: list[str] = []
+        for file in PatchSet(patch.read_text()):
+            if file.path == 'acl.txt':
+                for hunk in file:
+                    acl_lines.extend([line.value for line in hunk if line.is_added or line.is_removed])
+        return AclFile.from_string("".join(acl_lines))
+
+    def list_permission_files_in_patch(self, patch: Path) -> set[Path]:
+        # Given a patch which changes the acl.txt entry for /etc/my_file, but not a/files/etc/my_file itself
+        # return {/etc/my_file, }. Parent directories of other files in the patch are not included
+        acl_paths = {Path(path) for path in self.list_acl_changes_in_patch(patch).entries}
+        if not acl_paths:
+            return set()
+        content_files = self.list_files_in_patch(patch)
+        directories = {parent for path in acl_paths | content_files for parent in path.parents}
+        return acl_paths - content_files - directories
+
+    def list_object_files_in_patch(self, patch: Path, *, reverse: bool = False) -> set[Path]:
+        # Given a patch where the source of a/files/etc/my_file is an object pointer, return {/etc/my_file, }
+        # A reversed patch applies to the target of the patch instead, so the pointers are on the added lines
+        files: set[Path] = set()
+        for file in PatchSet(patch.read_text()):
+            source_path = Path(file.path)
+            if len(source_path.parts) < 2 or source_path.parts[0] != 'files':
+                continue
+            for hunk in file:
+                base_lines = (line for line in hunk if not (line.is_removed if reverse else line.is_added))
+                if any(line.value.startswith(POINTER_PREFIX) for line in base_lines):
+                    files.add(Path('/', *source_path.parts[1:]))
+                    break
+        return files
+
+    def externalize_files(self, objects: ObjectStore, paths: Iterable[Path]) -> None:
+        """Moves the content of each file into the object store, and replaces the file with a pointer to it"""
+        for path in paths:
+            playground_path = self.location / 'files' / path.relative_to('/')
+            if playground_path.is_symlink() or not playground_path.is_file():
+                continue
+            if ObjectPointer.from_file(playground_path) is not None:
+                continue
+            pointer = objects.add(playground_path)
+            playground_path.write_text(pointer.encode())
+
+    def externalize_large_files(self, objects: ObjectStore, large_files: LargeFiles) -> int:
+        root_dir = self.location / 'files'
+        paths = [
+            Path('/') / p.relative_to(root_dir) for p in root_dir.glob('**/*') if should_externalize(p, large_files)
+        ]
+        self.externalize_files(objects, paths)
+        return len(paths)
+
+    def restore_objects(self, stores: list[ObjectStore], *, sudo: bool = True) -> None:
+        """Replaces every committed object pointer with the verified content from one of the stores"""
+        # The playground files may already be owned by root, so the pointers are read from git instead
+        candidates = [path for path, line in git_grep_staged(self.location, POINTER_PREFIX, ['files']) if line]
+        for path, content in git_show_staged(self.location, candidates).items():
+            try:
+                pointer = ObjectPointer.from_string(content.decode())
+            except UnicodeDecodeError:
+                continue
+            if pointer is None:
+                continue
+            store = next((store for store in stores if store.contains(pointer)), None)
+            if store is None:
+                raise ValueError(f"The object {pointer.digest} for {path} was not found")
+            with NamedTemporaryFile(prefix="dfu_object_") as tmp:
+                store.restore(pointer, Path(tmp.name))
+                # Copy into the existing file, which keeps the owner and mode already applied to it
+                subprocess.run(
+                    [*_sudo(sudo), 'cp', tmp.name, str(self.location / path)],
+                    capture_output=True,
+                    check=True,
+                    text=True,
+                )
+
+    def copy_files_from_filesystem(self, paths: Iterable[CopyFile], *, sudo: bool = True) -> None:
         for path in paths:
             source = path.source
             target = self.location / 'files' / path.target.relative_to('/')
@@ -77,8 +180,9 @@ class Playground:
             target.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
             subprocess.run(
                 [
-                    'sudo',
+                    *_sudo(sudo),
                     'cp',
+                    *(['--recursive'] if path.recursive else []),
                     '--preserve=all',
                     '--no-dereference',
                     str(source),
@@ -88,9 +192,9 @@ class Playground:
                 check=True,
                 text=True,
             )
-        self._apply_permissions_to_playground()
+        self._apply_permissions_to_playground(sudo=sudo)
 
-    def _apply_permissions_to_playground(self) -> None:
+    def _apply_permissions_to_playground(self, *, sudo: bool = True) -> None:
         if not (self.location / 'files').exists():
             return
 
@@ -98,7 +202,7 @@ class Playground:
         current_group = grp.getgrgid(os.getgid()).gr_name
         subprocess.run(
             [
-                "sudo",
+                *_sudo(sudo),
                 "chown",
                 "--no-dereference",
                 "--recursive",
@@ -110,14 +214,14 @@ class Playground:
             capture_output=True,
         )
         subprocess.run(
-            ["sudo", "chmod", "--no-dereference", "--recursive", "755", str(self.location / 'files')],
+            [*_sudo(sudo), "chmod", "--no-dereference", "--recursive", "755", str(self.location / 'files')],
             check=True,
             text=True,
             capture_output=True,
         )
 
     def apply_patch(self, patch: Path, *, reverse: bool = False) -> bool:
-        self._fetch_bundle(patch.with_suffix('.pack'))
+        bundle_commit = self._fetch_bundle(patch.with_suffix('.pack'))
         try:
             click.echo(f"Applying patch {patch.name}", err=True)
             try:
@@ -139,37 +243,55 @@ class Playground:
                     f"Patch {patch.name} does not contain config.json. Only version 2 patches are supported."
                 )
 
-            merged_cleanly = git_apply(self.location, patch, reverse=reverse, exclude=["config.json"])
-
+            start = time.perf_counter()
+            if bundle_commit is not None and self._has_commits():
+                # The bundle has the full before and after commits, so the whole tree can be merged at once.
+                # It handles renames, and is faster than git apply for large patches (see benchmarks/apply_patch.py)
+                strategy = "merge"
+                merged_cleanly = self._merge_commit(bundle_commit, reverse=reverse)
+            else:
+                strategy = "git apply"
+                merged_cleanly = git_apply(self.location, patch, reverse=reverse, exclude=["config.json"])
+            click.echo(f"Applied patch {patch.name} in {time.perf_counter() - start:.2f}s ({strategy})", err=True)
             return merged_cleanly
         except subprocess.CalledProcessError as e:
             click.echo(f"Failed to apply patch {patch.name}", err=True)
             click.echo(e.output, err=True)
             raise e
 
-    def _fetch_bundle(self, bundle: Path) -> None:
+    def _merge_commit(self, commit: str, *, reverse: bool) -> bool:
+        config_file = self.location / 'config.json'
+        had_config = config_file.exists()
+        merged_cleanly = git_cherry_pick(self.location, commit, reverse=reverse)
+        # config.json describes the patch itself, so it's never part of the playground
+        if not had_config and config_file.exists():
+            git_rm(self.location, ['config.json'])
+        return merged_cleanly
+
+    def _has_commits(self) -> bool:
+        try:
+            git_rev_parse(self.location, 'HEAD')
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def _fetch_bundle(self, bundle: Path) -> str | None:
         if bundle.exists():
-            remote_name = bundle.stem
-            try:
-                git_add_remote(self.location, remote_name, str(bundle.resolve()))
-            except subprocess.CalledProcessError as e:
-                # If the remote already exists (because we were resolving a merge conflict),
-                # then just ignore the error
-                if e.returncode != 3:
-                    raise e
-
-            git_fetch(self.location, remote_name)
+            # Fetch from the bundle's path instead of a named remote, since packages applied together
+            # can have bundles with the same name
+            return git_fetch_head(self.location, str(bundle.resolve()))
         else:
             click.echo("No bundle file found for patch {patch.name}. Continuing without it", err=True)
+            return None
 
-    def copy_files_to_filesystem(self, dest: Path = Path('/')) -> None:
+    def copy_files_to_filesystem(self, dest: Path = Path('/'), *, sudo: bool = True) -> None:
         root_dir = self.location / 'files'
         if not root_dir.exists():
             return
 
         result = subprocess.run(
             [
-                "sudo",
+                *_sudo(sudo),
                 "cp",
                 "--recursive",
                 "--preserve=all",
@@ -187,5 +309,101 @@ class Playground:
         if result.stderr:
             click.echo(result.stderr, err=True)
 
-    def cleanup(self) -> None:
-        rmtree(self.location, ignore_errors=True)
+    def cleanup(self, *, background: bool = False) -> None:
+        """Removes the playground. The location can be reused as soon as this returns, even if the files
+        are still being removed in the background"""
+        try:
+            if self.location.exists():
+                remove_directory(self.location, background=background)
+        finally:
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+
+def remove_directory(path: Path, *, background: bool = False) -> None:
+    """Removes the directory, using sudo for files that were chowned to other users.
+    The directory is renamed first, so the removal can happen in the background"""
+    trash = path.with_name(f"{TRASH_PREFIX}{path.name}_{secrets.token_hex(4)}")
+    try:
+        path.rename(trash)
+    except OSError:
+        trash = path
+
+    # sudo can't prompt for a password in the background, so directories that were chowned to other users
+    # (e.g. by dfu apply) are removed right away
+    if background and not _needs_sudo(trash):
+        # The shell exits right away, and the removal continues in its own session after dfu exits.
+        # dfu gc removes anything that is left over
+        subprocess.run(
+            [
+                "sh",
+                "-c",
+                'rm -rf -- "$1" >/dev/null 2>&1 &',
+                "sh",
+                str(trash),
+            ],
+            check=True,
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        return
+
+    rmtree(trash, ignore_errors=True)
+    if trash.exists():
+        # Removing all of the files that we couldn't remove with a single sudo call
+        subprocess.run(
+            ["sudo", "rm", "--recursive", "--force", "--one-file-system", "--", str(trash)],
+            check=True,
+            text=True,
+            capture_output=True,
+        )
+
+
+def _needs_sudo(path: Path) -> bool:
+    # Removing a file only needs access to its directory, so only the directories are checked
+    def raise_error(error: OSError) -> None:
+        raise error
+
+    try:
+        for directory, _, _ in os.walk(path, onerror=raise_error):
+            if not os.access(directory, os.W_OK | os.X_OK):
+                return True
+    except PermissionError:
+        return True
+    return False
+
+
+def find_leaked_playgrounds(directory: Path | None = None) -> list[Path]:
+    """Returns the temporary playgrounds in directory (the temp directory by default) that are no longer
+    used by a dfu process, and the playgrounds whose removal didn't finish"""
+    if directory is None:
+        directory = Path(gettempdir())
+    leaked: list[Path] = []
+    for path in sorted(directory.glob(f"{TEMPORARY_PREFIX}*")):
+        if path.is_symlink() or not path.is_dir() or path.stat().st_uid != os.getuid():
+            continue
+        if path.name.startswith(TRASH_PREFIX):
+            leaked.append(path)
+            continue
+        try:
+            os.close(_lock_directory(path))
+        except BlockingIOError:
+            # Another dfu process is using the playground
+            continue
+        leaked.append(path)
+    return leaked
+
+
+def _lock_directory(path: Path) -> int:
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _sudo(sudo: bool) -> list[str]:
+    return ["sudo"] if sudo else []
@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
+from pathlib import Path
+from typing import ClassVar
 
 
 @dataclass
@@ -11,12 +13,17 @@ class Event:
 class UpdateInstalledDependenciesEvent(Event):
     from_index: int
     to_index: int
+    # Copy the archives of the added programs into the package, so they can be installed without downloading them
+    export_packages: bool = False
 
 
 @dataclass
 class InstallDependenciesEvent(Event):
     confirm: bool
     dry_run: bool
+    # The packages whose exported archives can be installed, when several packages are applied together.
+    # Defaults to the store's package
+    package_dirs: tuple[Path, ...] = ()
 
 
 @dataclass
@@ -26,6 +33,18 @@ class UninstallDependenciesEvent(Event):
 
 
 class DfuPlugin(ABC):
+    # Plugins which declare the events they handle (and whether they subscribe to state changes) are only
+    # imported and created once they're needed. Plugins which don't declare them are created with the store
+    events: ClassVar[tuple[type[Event], ...] | None] = None
+    subscribes: ClassVar[bool] = False
+    # Whether handle() can run in a background thread (see Store.dispatch_async). The plugin then has to
+    # update the state with store.update(), instead of setting store.state
+    concurrent: ClassVar[bool] = False
+
     @abstractmethod
     def handle(self, event: Event) -> None:  # pragma: no cover
         pass
+
+
+def event_name(event_type: type) -> str:
+    return f"{event_type.__module__}:{event_type.__qualname__}"
@@ -0,0 +1,99 @@
+import hashlib
+import os
+import sys
+from dataclasses import dataclass, field
+from importlib.metadata import EntryPoint, entry_points
+from pathlib import Path
+
+import msgspec
+from platformdirs import PlatformDirs
+
+from dfu.api.entrypoint import Entrypoint
+from dfu.api.plugin import event_name
+from dfu.helpers.json_serializable import JsonSerializableMixin
+
+PLUGIN_GROUP = 'dfu.plugin'
+
+
+@dataclass(frozen=True)
+class PluginSpec:
+    name: str
+    value: str
+    # The event_name of each event the plugin handles, or None if the plugin doesn't declare them
+    events: tuple[str, ...] | None = None
+    subscribes: bool = False
+
+    def load(self) -> Entrypoint:
+        entrypoint: Entrypoint = EntryPoint(name=self.name, value=self.value, group=PLUGIN_GROUP).load()
+        return entrypoint
+
+
+@dataclass(frozen=True)
+class PluginRegistry(JsonSerializableMixin):
+    environment: str
+    plugins: tuple[PluginSpec, ...] = field(default_factory=tuple)
+
+
+def load_registry(cache_path: Path | None = None) -> PluginRegistry:
+    """Returns the dfu.plugin entry points. Finding them reads the metadata of every installed distribution,
+    and imports every plugin, so the result is cached until a distribution is installed, updated or removed"""
+    if cache_path is None:
+        cache_path = PlatformDirs("dfu").user_cache_path / "plugins.json"
+    environment = environment_key()
+    cached: PluginRegistry | None
+    try:
+        cached = PluginRegistry.from_file(cache_path)
+    except OSError:
+        cached = None
+    except msgspec.DecodeError:
+        # The cache was written by a different version of dfu
+        cached = None
+    if cached is not None and cached.environment == environment:
+        return cached
+
+    registry = PluginRegistry(environment=environment, plugins=discover_plugins())
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}.tmp")
+        registry.write(tmp_path)
+        tmp_path.replace(cache_path)
+    except OSError:
+        # The cache is only an optimization
+        pass
+    return registry
+
+
+def discover_plugins() -> tuple[PluginSpec, ...]:
+    specs: list[PluginSpec] = []
+    for entry_point in entry_points().select(group=PLUGIN_GROUP):
+        entrypoint = entry_point.load()
+        events = getattr(entrypoint, 'events', None)
+        specs.append(
+            PluginSpec(
+                name=entry_point.name,
+                value=entry_point.value,
+                events=None if events is None else tuple(event_name(event) for event in events),
+                subscribes=bool(getattr(entrypoint, 'subscribes', False)),
+            )
+        )
+    return tuple(specs)
+
+
+def environment_key() -> str:
+    """Hashes sys.path, and the name and modification time of every distribution's metadata directory.
+    Installing, updating, or removing a distribution creates or removes its metadata directory"""
+    digest = hashlib.sha256()
+    for path in sys.path:
+        digest.update(f"{path}\0".encode())
+        try:
+            with os.scandir(path or '.') as entries:
+                metadata_dirs = sorted(
+                    (entry.name, entry.stat().st_mtime_ns)
+                    for entry in entries
+                    if entry.name.endswith(('.dist-info', '.egg-info'))
+                )
+        except OSError:
+            continue
+        for name, mtime in metadata_dirs:
+            digest.update(f"{name}\0{mtime}\0".encode())
+    return digest.hexdigest()
@@ -1,23 +1,92 @@
-from typing import Callable
+import threading
+from collections.abc import Collection
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Generator
 
-from dfu.api.plugin import DfuPlugin, Event
+from dfu.api.plugin import DfuPlugin, Event, event_name
 from dfu.api.state import State
 
 Callback = Callable[[State, State], None]
+StateUpdate = Callable[[State], State]
+
+
+@dataclass(frozen=True)
+class _LazyPlugin:
+    load: Callable[[], Callable[['Store'], DfuPlugin]]
+    events: frozenset[str]
+    subscribes: bool
+
+
+class PendingDispatch:
+    """An event which is being handled in the background. The state updates of the plugins are only applied
+    by join(), in the order the plugins were added, so the result doesn't depend on which plugin finished first"""
+
+    futures: list[Future[list[StateUpdate]]]
+    # Whether join() or cancel() was called
+    finished: bool
+    _store: 'Store'
+
+    def __init__(self, store: 'Store', futures: list[Future[list[StateUpdate]]]) -> None:
+        self._store = store
+        self.futures = futures
+        self.finished = False
+
+    def cancel(self) -> None:
+        """Stops the plugins which haven't started, and waits for the others, without applying their state updates"""
+        self.finished = True
+        for future in self.futures:
+            future.cancel()
+        wait(self.futures)
+
+    def join(self) -> None:
+        self.finished = True
+        with self._store.transaction():
+            for future in self.futures:
+                for update in future.result():
+                    self._store.state = update(self._store.state)
 
 
 class Store:
     _state: State
     _callbacks: set[Callback]
-    plugins: set[DfuPlugin]
+    _lazy_plugins: list[_LazyPlugin]
+    _plugins_lock: threading.Lock
+    # Set in the threads which handle an event in the background, to collect their state updates
+    _background: threading.local
+    # The state before the outermost transaction started
+    _transaction_start: State | None
+    plugins: list[DfuPlugin]
 
     def __init__(self, state: State) -> None:
         self._state = state
         self._callbacks = set()
-        self.plugins = set()
+        self._lazy_plugins = []
+        self._plugins_lock = threading.Lock()
+        self._background = threading.local()
+        self._transaction_start = None
+        self.plugins = []
 
     def add_plugin(self, plugin: DfuPlugin) -> None:
-        self.plugins.add(plugin)
+        if plugin not in self.plugins:
+            self.plugins.append(plugin)
+
+    def add_lazy_plugin(
+        self, load: Callable[[], Callable[['Store'], DfuPlugin]], *, events: Collection[str], subscribes: bool
+    ) -> None:
+        """Adds a plugin which is loaded the first time one of its events (see event_name) is dispatched,
+        or the first time the state changes if it subscribes to the store"""
+        self._lazy_plugins.append(_LazyPlugin(load=load, events=frozenset(events), subscribes=subscribes))
+
+    def _load_plugins(self, predicate: Callable[[_LazyPlugin], bool]) -> None:
+        with self._plugins_lock:
+            to_load = [plugin for plugin in self._lazy_plugins if predicate(plugin)]
+            if not to_load:
+                return
+            self._lazy_plugins = [plugin for plugin in self._lazy_plugins if plugin not in to_load]
+        for plugin in to_load:
+            self.add_plugin(plugin.load()(self))
 
     def subscribe(self, callback: Callback) -> None:
         self._callbacks.add(callback)
@@ -26,8 +95,79 @@ class Store:
         self._callbacks.remove(callback)
 
     def dispatch(self, event: Event) -> None:
+        self._load_plugins_for(event)
+        with self.transaction():
+            for plugin in self.plugins:
+                plugin.handle(event)
+
+    def dispatch_async(self, event: Event) -> PendingDispatch:
+        """Handles the event in the background with the plugins that can run concurrently, and right away with
+        the other plugins. Call join() on the result to wait for the plugins, and to apply their state updates"""
+        self._load_plugins_for(event)
+        futures: list[Future[list[StateUpdate]]] = []
+        concurrent_plugins = [plugin for plugin in self.plugins if plugin.concurrent]
+        executor = ThreadPoolExecutor(max_workers=len(concurrent_plugins)) if concurrent_plugins else None
         for plugin in self.plugins:
+            if executor and plugin.concurrent:
+                futures.append(executor.submit(self._handle_in_background, plugin, event))
+            else:
+                plugin.handle(event)
+        if executor:
+            # The threads exit after handling the event
+            executor.shutdown(wait=False)
+        return PendingDispatch(self, futures)
+
+    @contextmanager
+    def transaction(self) -> Generator[None, None, None]:
+        """Batches the state updates, so the subscribers are only notified once, when the outermost transaction
+        ends. The updates are kept (and the subscribers are notified) even if the transaction raises"""
+        if self._transaction_start is not None:
+            yield
+            return
+        self._transaction_start = self._state
+        try:
+            yield
+        finally:
+            old_state = self._transaction_start
+            self._transaction_start = None
+            if self._state is not old_state:
+                self._notify(old_state, self._state)
+
+    def update(self, update: StateUpdate) -> None:
+        """Sets the state to update(state). Plugins which run concurrently have to use this instead of
+        setting the state, so the update can be applied after the plugin finishes"""
+        pending: list[StateUpdate] | None = getattr(self._background, 'updates', None)
+        if pending is not None:
+            pending.append(update)
+        else:
+            self.state = update(self.state)
+
+    def defer(self, action: Callable[[], None]) -> None:
+        """Runs the action after the state updates of the plugin. For plugins which run in the background,
+        that's when the event is joined, so e.g. nothing is written to the package if the command stops before"""
+        pending: list[StateUpdate] | None = getattr(self._background, 'updates', None)
+        if pending is None:
+            action()
+            return
+
+        def run(state: State) -> State:
+            action()
+            return state
+
+        pending.append(run)
+
+    def _handle_in_background(self, plugin: DfuPlugin, event: Event) -> list[StateUpdate]:
+        updates: list[StateUpdate] = []
+        self._background.updates = updates
+        try:
             plugin.handle(event)
+        finally:
+            del self._background.updates
+        return updates
+
+    def _load_plugins_for(self, event: Event) -> None:
+        names = {event_name(event_type) for event_type in type(event).__mro__}
+        self._load_plugins(lambda plugin: not plugin.events.isdisjoint(names))
 
     @property
     def state(self) -> State:
@@ -35,7 +175,14 @@ class Store:
 
     @state.setter
     def state(self, state: State) -> None:
+        if getattr(self._background, 'updates', None) is not None:
+            raise RuntimeError("Plugins which run concurrently have to update the state with store.update()")
         old_state = self._state
         self._state = state
+        if self._transaction_start is None:
+            self._notify(old_state, state)
+
+    def _notify(self, old_state: State, new_state: State) -> None:
+        self._load_plugins(lambda plugin: plugin.subscribes)
         for callback in self._callbacks:
-            callback(old_state, state)
+            callback(old_state, new_state)
@@ -1,22 +1,14 @@
 import os
 import sys
 from pathlib import Path
+from typing import Any, Sequence, TextIO
 
 import click
 
-from dfu.commands import (
-    apply_package,
-    create_config,
-    create_package,
-    create_snapshot,
-    generate_diff,
-    get_config_paths,
-    launch_snapshot_shell,
-    load_store,
-    ls_files,
-)
 from dfu.helpers.handle_errors import handle_errors
-from dfu.snapshots.snapper import Snapper
+
+# Each command imports its implementation when it runs, so that e.g. dfu --help and shell completion
+# don't have to import every command (and their dependencies)
 
 
 class NullableString(click.ParamType):
@@ -28,7 +20,36 @@ class NullableString(click.ParamType):
         return value
 
 
-@click.group()
+class DaemonGroup(click.Group):
+    """Runs the command in the dfu daemon instead, if it's running and can run the command"""
+
+    def main(
+        self,
+        args: Sequence[str] | None = None,
+        prog_name: str | None = None,
+        complete_var: str | None = None,
+        standalone_mode: bool = True,
+        **extra: Any,
+    ) -> Any:
+        if args is None and standalone_mode and _use_daemon():
+            from dfu.daemon import socket_path
+            from dfu.daemon.client import run_in_daemon
+
+            exit_code = run_in_daemon(socket_path(), sys.argv[1:])
+            if exit_code is not None:
+                sys.exit(exit_code)
+        return super().main(args, prog_name, complete_var, standalone_mode, **extra)
+
+
+def _use_daemon() -> bool:
+    from dfu.daemon import NO_DAEMON_VAR, socket_path
+
+    if NO_DAEMON_VAR in os.environ or '_DFU_COMPLETE' in os.environ:
+        return False
+    return socket_path().exists()
+
+
+@click.group(cls=DaemonGroup)
 def main() -> None:
     pass
 
@@ -38,6 +59,8 @@ def main() -> None:
 @click.option("-d", "--description", help="Description of the package")
 @handle_errors
 def init(name: str | None, description: str | None) -> None:
+    from dfu.commands.create_package import create_package
+
     final_name: str = click.prompt("Name", default=name or Path.cwd().name)
     final_description: str | None = click.prompt("Description", default=description or "", type=NullableString())
     path = create_package(name=final_name, description=final_description)
@@ -47,6 +70,9 @@ def init(name: str | None, description: str | None) -> None:
 @main.command()
 @handle_errors
 def snap() -> None:
+    from dfu.commands.create_snapshot import create_snapshot
+    from dfu.commands.load_store import load_store
+
     create_snapshot(load_store())
 
 
@@ -54,19 +80,84 @@ def snap() -> None:
 @click.option('--from', 'from_', type=int, default=0, help='Snapshot index to compute the before state')
 @click.option('--to', type=int, default=-1, help='Snapshot index to compute the end state')
 @click.option('--interactive', '-i', is_flag=True, help='Inspect and modify the changes', default=False)
+@click.option(
+    '--export-packages',
+    is_flag=True,
+    help="Copy the added programs from the snapshot's pacman cache, so they can be installed offline",
+    default=False,
+)
 @handle_errors
-def diff(from_: int, to: int, interactive: bool) -> None:
-    generate_diff(load_store(), from_index=from_, to_index=to, interactive=interactive)
+def diff(from_: int, to: int, interactive: bool, export_packages: bool) -> None:
+    from dfu.commands.diff import generate_diff
+    from dfu.commands.load_store import load_store
+
+    generate_diff(load_store(), from_index=from_, to_index=to, interactive=interactive, export_packages=export_packages)
 
 
 @main.command()
+@click.argument('package_dirs', nargs=-1, type=click.Path(exists=True, file_okay=False, path_type=Path))
 @click.option('--reverse', '-r', is_flag=True, help='Uninstall the package', default=False)
 @click.option('--force', '-f', is_flag=True, help='Do not require confirmation', default=False)
 @click.option('--interactive', '-i', is_flag=True, help='Inspect and modify the changes', default=False)
 @click.option('--dry-run', help="Do not apply the changes to the computer", is_flag=True, default=False)
+@click.option('--resume', help="Continue an apply that failed or was aborted", is_flag=True, default=False)
+@click.option('--abort', help="Discard an apply that failed or was aborted", is_flag=True, default=False)
+@click.option(
+    '--root',
+    'roots',
+    multiple=True,
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    help="Apply the package to this root directory instead of / (can be repeated)",
+)
+@handle_errors
+def apply(
+    package_dirs: tuple[Path, ...],
+    reverse: bool,
+    force: bool,
+    interactive: bool,
+    dry_run: bool,
+    resume: bool,
+    abort: bool,
+    roots: tuple[Path, ...],
+) -> None:
+    """Applies the package in the current directory, or the given packages in order"""
+    from dfu.commands.apply import abort_apply, apply_package
+    from dfu.commands.load_store import load_store
+
+    if resume and abort:
+        raise ValueError("--resume and --abort can't be used together")
+    stores = [load_store(package_dir) for package_dir in package_dirs] if package_dirs else [load_store()]
+    if abort:
+        abort_apply(stores, roots=roots or (Path("/"),))
+        return
+    apply_package(
+        stores,
+        reverse=reverse,
+        confirm=not force,
+        interactive=interactive,
+        dry_run=dry_run,
+        resume=resume,
+        roots=roots or (Path("/"),),
+    )
+
+
+@main.command()
+@handle_errors
+def squash() -> None:
+    from dfu.commands.load_store import load_store
+    from dfu.commands.squash import squash_patches
+
+    squash_patches(load_store())
+
+
+@main.command()
+@click.option('--dry-run', help="Only list the leaked playgrounds", is_flag=True, default=False)
 @handle_errors
-def apply(reverse: bool, force: bool, interactive: bool, dry_run: bool) -> None:
-    apply_package(load_store(), reverse=reverse, confirm=not force, interactive=interactive, dry_run=dry_run)
+def gc(dry_run: bool) -> None:
+    """Removes temporary playgrounds that dfu commands left behind"""
+    from dfu.commands.gc import collect_garbage
+
+    collect_garbage(dry_run=dry_run)
 
 
 @main.command(name="ls-files")
@@ -75,6 +166,9 @@ def apply(reverse: bool, force: bool, interactive: bool, dry_run: bool) -> None:
 @click.option('--to', type=int, default=-1, help='Snapshot index to compute the end state')
 @handle_errors
 def ls_files_command(ignored: bool, from_: int, to: int) -> None:
+    from dfu.commands.load_store import load_store
+    from dfu.commands.ls_files import ls_files
+
     ls_files(load_store(), from_index=from_, to_index=to, only_ignored=ignored)
 
 
@@ -88,6 +182,10 @@ def config() -> None:
 @click.option("-f", "--file", help="File to write config to")
 @handle_errors
 def config_init(snapper_config: list[str], file: str | None) -> None:
+    from dfu.commands.create_config import create_config
+    from dfu.commands.load_config import get_config_paths
+    from dfu.snapshots.snapper import Snapper
+
     if not snapper_config:
         default_configs = ",".join([c.name for c in Snapper.get_configs()])
         response = click.prompt(
@@ -104,9 +202,42 @@ def config_init(snapper_config: list[str], file: str | None) -> None:
 @click.option('--id', 'id_', type=int, help='The snapshot id to chroot into', default=-1)
 @handle_errors
 def shell(id_: int) -> None:
+    from dfu.commands.load_store import load_store
+    from dfu.commands.shell import launch_snapshot_shell
+
     launch_snapshot_shell(load_store(), id_)
 
 
+@main.command()
+@click.argument('file', type=click.File('r'), default='-')
+@click.option(
+    '--jobs', '-j', type=click.IntRange(min=1), default=os.cpu_count() or 1, help='How many entries to run at once'
+)
+@handle_errors
+def batch(file: TextIO, jobs: int) -> None:
+    """Runs the dfu commands in FILE (or stdin), one JSON object per line, e.g.
+    {"args": ["ls-files", "--from", "1"], "cwd": "my-package"}, and prints a JSON result for each one"""
+    from dfu.commands.batch import run_batch
+
+    if not run_batch(file, jobs=jobs):
+        sys.exit(1)
+
+
+@main.command()
+@handle_errors
+def daemon() -> None:
+    """Runs dfu ls-files, dfu diff and dfu apply --dry-run --force for the dfu CLI, with warm caches.
+
+    The commands are imported and the plugins are discovered once. The snapper mountpoints, the changes between
+    snapshots and the installed packages of each snapshot are kept until the snapper config or the snapshot changes.
+    The commands use the daemon's sudo credentials, since the daemon can't ask for a password.
+    Once they expire, the commands run in the CLI instead. Set DFU_NO_DAEMON to run a command without the daemon"""
+    from dfu.daemon import socket_path
+    from dfu.daemon.server import serve
+
+    serve(socket_path())
+
+
 main.add_command(config)
 
 if __name__ == "__main__":
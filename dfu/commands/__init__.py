@@ -1,15 +1,42 @@
-from dfu.commands.apply import apply_package
-from dfu.commands.create_config import create_config
-from dfu.commands.create_package import create_package
-from dfu.commands.create_snapshot import create_snapshot
-from dfu.commands.diff import generate_diff
-from dfu.commands.load_config import get_config_paths, load_config
-from dfu.commands.load_store import load_store
-from dfu.commands.ls_files import ls_files
-from dfu.commands.shell import launch_snapshot_shell
+from importlib import import_module
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from dfu.commands.apply import abort_apply, apply_package
+    from dfu.commands.batch import run_batch
+    from dfu.commands.create_config import create_config
+    from dfu.commands.create_package import create_package
+    from dfu.commands.create_snapshot import create_snapshot
+    from dfu.commands.diff import generate_diff
+    from dfu.commands.gc import collect_garbage
+    from dfu.commands.load_config import get_config_paths, load_config
+    from dfu.commands.load_store import load_store
+    from dfu.commands.ls_files import ls_files
+    from dfu.commands.shell import launch_snapshot_shell
+    from dfu.commands.squash import squash_patches
+
+# The commands are imported when they're first used, so that importing one command doesn't import all of them
+_COMMAND_MODULES = {
+    "abort_apply": "dfu.commands.apply",
+    "apply_package": "dfu.commands.apply",
+    "collect_garbage": "dfu.commands.gc",
+    "create_config": "dfu.commands.create_config",
+    "create_package": "dfu.commands.create_package",
+    "create_snapshot": "dfu.commands.create_snapshot",
+    "generate_diff": "dfu.commands.diff",
+    "get_config_paths": "dfu.commands.load_config",
+    "load_config": "dfu.commands.load_config",
+    "load_store": "dfu.commands.load_store",
+    "ls_files": "dfu.commands.ls_files",
+    "launch_snapshot_shell": "dfu.commands.shell",
+    "run_batch": "dfu.commands.batch",
+    "squash_patches": "dfu.commands.squash",
+}
 
 __all__ = [
+    "abort_apply",
     "apply_package",
+    "collect_garbage",
     "create_config",
     "create_package",
     "create_snapshot",
@@ -19,4 +46,12 @@ __all__ = [
     "load_store",
     "ls_files",
     "launch_snapshot_shell",
+    "run_batch",
+    "squash_patches",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _COMMAND_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(import_module(_COMMAND_MODULES[name]), name)
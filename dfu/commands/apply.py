@@ -1,21 +1,54 @@
+import glob
+import grp
+import hashlib
 import os
+import pwd
 import re
 import subprocess
+import threading
+from collections import defaultdict
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 from textwrap import dedent
-from typing import NamedTuple
+from types import MappingProxyType
+from typing import NamedTuple, TypeVar
 
 import click
+from platformdirs import PlatformDirs
 
 from dfu.api import InstallDependenciesEvent, Playground, Store, UninstallDependenciesEvent
 from dfu.api.playground import CopyFile
+from dfu.commands.load_store import load_plugins
+from dfu.commands.squash import archive_location
 from dfu.helpers.subshell import subshell
 from dfu.package.acl_file import AclEntry, AclFile
-from dfu.revision.git import git_add, git_are_files_staged, git_commit, git_init
+from dfu.package.apply_journal import ApplyJournal, JournalStep
+from dfu.package.objects import ObjectStore
+from dfu.revision.git import (
+    git_add,
+    git_apply_check,
+    git_are_files_staged,
+    git_changed_files,
+    git_commit,
+    git_enable_rerere,
+    git_fetch_head,
+    git_init,
+    git_rerere,
+    git_rerere_remaining,
+    git_reset_hard,
+    git_rev_parse,
+    git_show,
+)
 
 PatchStep = NamedTuple("PatchStep", [("patch", Path), ("interactive", bool)])
+T = TypeVar('T')
+R = TypeVar('R')
+
+# Roots are applied in parallel, but only one of them can use the terminal at a time
+_terminal_lock = threading.Lock()
 
 
 @dataclass(frozen=True)
@@ -23,37 +56,243 @@ class PathMetadata(AclEntry):
     is_symlink: bool
 
 
-def apply_package(store: Store, *, reverse: bool, interactive: bool, confirm: bool, dry_run: bool) -> None:
-    if not reverse:
-        store.dispatch(InstallDependenciesEvent(confirm=confirm, dry_run=dry_run))
+def apply_package(
+    stores: Sequence[Store],
+    *,
+    reverse: bool,
+    interactive: bool,
+    confirm: bool,
+    dry_run: bool,
+    resume: bool = False,
+    roots: Sequence[Path] = (Path("/"),),
+) -> None:
+    """Applies the packages to each root. The patches of every package are layered into a single playground
+    (in the order the packages are given), so that the files are only written to the root once"""
+    roots = list(dict.fromkeys(Path(os.path.abspath(root)) for root in roots))
+    # The playgrounds are kept in the package until the apply finishes, so that a failed apply can be resumed
+    playgrounds = [Playground(location=_playground_location(stores, root)) for root in roots]
+    if resume:
+        # Roots which already finished don't have a playground anymore
+        playgrounds = [playground for playground in playgrounds if _journal_path(playground).exists()]
+        if not playgrounds:
+            raise ValueError("There is no dfu apply in progress to resume")
+        journals = [_resume_journal(playground) for playground in playgrounds]
+        reverse = journals[0].reverse
+    else:
+        if any(_journal_path(playground).exists() for playground in playgrounds):
+            raise ValueError(
+                "A dfu apply is already in progress. "
+                "Run dfu apply --resume to continue it, or dfu apply --abort to discard it"
+            )
+        for playground in playgrounds:
+            # A previous apply failed before it could write the journal, so there's nothing to resume
+            playground.cleanup(background=True)
+        if not reverse and _includes_running_system(roots):
+            _dependencies_store(stores, reverse=False).dispatch(
+                InstallDependenciesEvent(
+                    confirm=confirm,
+                    dry_run=dry_run,
+                    package_dirs=tuple(store.state.package_dir for store in stores),
+                )
+            )
+        # The patches are only planned once, and then applied to the base files of each root
+        steps = _plan_patches(stores, reverse=reverse, interactive=interactive)
+        journals = _for_each_root(
+            lambda playground, root: _start_apply(
+                stores, playground=playground, root=root, reverse=reverse, confirm=confirm, steps=steps
+            ),
+            playgrounds,
+            roots,
+        )
 
-    with Playground.temporary(prefix="dfu_apply_") as playground:
-        git_init(playground.location)
-        _copy_base_files(store, playground=playground)
-        _auto_commit(playground, "Initial files")
-        _apply_patches(store, playground=playground, reverse=reverse, interactive=interactive)
-        if confirm:
-            _confirm_changes(playground)
+    try:
+        _for_each_root(
+            lambda playground, journal: _finish_apply(
+                stores, playground=playground, journal=journal, confirm=confirm, dry_run=dry_run
+            ),
+            playgrounds,
+            journals,
+        )
+    except BaseException:
+        click.echo("Run dfu apply --resume to continue the apply, or dfu apply --abort to discard it", err=True)
+        raise
 
-        if dry_run:
-            click.echo("Dry run: Skipping copying the files to the filesystem", err=True)
-        else:
-            playground.copy_files_to_filesystem()
+    if reverse and _includes_running_system(roots):
+        _dependencies_store(stores, reverse=True).dispatch(UninstallDependenciesEvent(confirm=confirm, dry_run=dry_run))
+
+
+def abort_apply(stores: Sequence[Store], *, roots: Sequence[Path] = (Path("/"),)) -> None:
+    playgrounds = [Playground(location=_playground_location(stores, Path(os.path.abspath(root)))) for root in roots]
+    if not any(playground.location.exists() for playground in playgrounds):
+        raise ValueError("There is no dfu apply in progress to abort")
+    for playground in playgrounds:
+        playground.cleanup(background=True)
+    click.echo("Discarded the dfu apply in progress", err=True)
+
+
+def _includes_running_system(roots: list[Path]) -> bool:
+    if Path("/") in roots:
+        return True
+    # The plugins install programs onto the running system, so they aren't used for other roots
+    click.echo("Skipping installing and uninstalling programs, since they only apply to /", err=True)
+    return False
 
-    if reverse:
-        store.dispatch(UninstallDependenciesEvent(confirm=confirm, dry_run=dry_run))
+
+def _dependencies_store(stores: Sequence[Store], *, reverse: bool) -> Store:
+    """Returns a store whose package config has the programs of every package, so that the plugins
+    install and remove all of them at once. Later packages take precedence if they disagree,
+    except when reversing, since the packages are undone in the opposite order"""
+    if len(stores) == 1:
+        return stores[0]
+    added: dict[str, None] = {}
+    removed: dict[str, None] = {}
+    versions: dict[str, str] = {}
+    for store in reversed(stores) if reverse else stores:
+        versions.update(store.state.package_config.program_versions)
+        for program in store.state.package_config.programs_added:
+            removed.pop(program, None)
+            added[program] = None
+        for program in store.state.package_config.programs_removed:
+            added.pop(program, None)
+            removed[program] = None
+    first = stores[0].state
+    state = first.update(
+        package_config=first.package_config.update(
+            programs_added=tuple(added), programs_removed=tuple(removed), program_versions=MappingProxyType(versions)
+        )
+    )
+    return load_plugins(Store(state))
+
+
+def _for_each_root(func: Callable[[Playground, T], R], playgrounds: list[Playground], items: list[T]) -> list[R]:
+    if len(playgrounds) == 1:
+        return [func(playgrounds[0], items[0])]
+    with ThreadPoolExecutor(max_workers=len(playgrounds)) as executor:
+        return list(executor.map(func, playgrounds, items))
+
+
+def _playground_location(stores: Sequence[Store], root: Path) -> Path:
+    # The playground is stored in the first package. Applying other roots or packages uses a different playground
+    key = [str(root), *(str(store.state.package_dir.resolve()) for store in stores[1:])]
+    if key == ["/"]:
+        return stores[0].state.package_dir / ".dfu" / "apply"
+    digest = hashlib.sha256("\0".join(key).encode()).hexdigest()[:16]
+    return stores[0].state.package_dir / ".dfu" / f"apply-{digest}"
+
+
+def _journal_path(playground: Playground) -> Path:
+    return playground.location / ".git" / "dfu" / "journal.json"
 
 
-def _copy_base_files(store: Store, *, playground: Playground) -> None:
-    patch_files = store.state.package_dir.glob('*.patch')
+def _resume_journal(playground: Playground) -> ApplyJournal:
+    journal = ApplyJournal.from_file(_journal_path(playground))
+    # Discards the changes of the step that was interrupted
+    if (
+        git_changed_files(playground.location, journal.last_commit)
+        or git_rev_parse(playground.location, "HEAD") != journal.last_commit
+    ):
+        # The files may already be owned by other users, so the reset needs the same permissions as the apply,
+        # and the files it wrote need their metadata again
+        paths = _changed_paths(playground, journal.last_commit)
+        git_reset_hard(playground.location, journal.last_commit, sudo=journal.sudo)
+        if journal.completed:
+            _apply_metadata(playground, paths=paths, sudo=journal.sudo)
+    click.echo(
+        f"Resuming {journal.root} after {len(journal.completed)} of {len(journal.steps)} patches",
+        err=True,
+    )
+    return journal
+
+
+def _start_apply(
+    stores: Sequence[Store],
+    *,
+    playground: Playground,
+    root: Path,
+    reverse: bool,
+    confirm: bool,
+    steps: list[PatchStep],
+) -> ApplyJournal:
+    # Roots owned by the current user (e.g. a container rootfs) can be read and written without sudo
+    root_sudo = os.stat(root).st_uid != os.getuid()
+    playground.location.mkdir(parents=True, mode=0o755)
+    git_init(playground.location)
+    # Conflict resolutions are shared between apply runs, so the same conflict only needs to be resolved once
+    git_enable_rerere(playground.location, PlatformDirs("dfu").user_data_path / "rr-cache")
+    _copy_base_files(stores, playground=playground, root=root, reverse=reverse, sudo=root_sudo)
+    _auto_commit(playground, "Initial files")
+
+    _check_patches(playground, root=root, patches=[step.patch for step in steps], reverse=reverse, confirm=confirm)
+    journal = ApplyJournal(
+        reverse=reverse,
+        base_commit=git_rev_parse(playground.location, "HEAD"),
+        root=str(root),
+        sudo=root_sudo or _sets_other_owners(playground, patches=[step.patch for step in steps]),
+        steps=tuple(JournalStep(patch=str(step.patch), interactive=step.interactive) for step in steps),
+    )
+    _journal_path(playground).parent.mkdir(parents=True, exist_ok=True)
+    journal.write_atomic(_journal_path(playground))
+    return journal
+
+
+def _finish_apply(
+    stores: Sequence[Store], *, playground: Playground, journal: ApplyJournal, confirm: bool, dry_run: bool
+) -> None:
+    _apply_patches(playground=playground, journal=journal)
+    if confirm:
+        _confirm_changes(playground)
+
+    if dry_run:
+        click.echo(f"Dry run: Skipping copying the files to {journal.root}", err=True)
+    else:
+        objects = [ObjectStore(store.state.package_dir / "objects") for store in stores]
+        playground.restore_objects([*objects, _base_objects(playground)], sudo=journal.sudo)
+        playground.copy_files_to_filesystem(dest=Path(journal.root), sudo=journal.sudo)
+    playground.cleanup(background=True)
+
+
+def _sets_other_owners(playground: Playground, *, patches: list[Path]) -> bool:
+    """Returns whether any of the files belong to someone other than the current user, which requires sudo to chown"""
+    acl_files = [AclFile.from_file(playground.location / "acl.txt")]
+    acl_files.extend(playground.list_acl_changes_in_patch(patch) for patch in patches)
+    current_user = pwd.getpwuid(os.getuid()).pw_name
+    current_group = grp.getgrgid(os.getgid()).gr_name
+    return any(
+        (entry.uid, entry.gid) != (current_user, current_group)
+        for acl_file in acl_files
+        for entry in acl_file.entries.values()
+    )
+
+
+def _copy_base_files(stores: Sequence[Store], *, playground: Playground, root: Path, reverse: bool, sudo: bool) -> None:
+    # Interactive applies can pick the original patches of a squashed patch instead, so they need base files too
+    patch_files = [
+        original
+        for store in stores
+        for patch in store.state.package_dir.glob('*.patch')
+        for original in (patch, *archive_location(patch).glob('*.patch'))
+    ]
     files_to_copy: set[Path] = set()
+    object_files: set[Path] = set()
     for patch in patch_files:
         files_to_copy.update(playground.list_files_in_patch(patch))
-    playground.copy_files_from_filesystem([CopyFile(source=f, target=f) for f in files_to_copy])
-    _write_initial_permissions(playground=playground, files=files_to_copy)
+        # Files which only had their permissions changed need a copy too, so the acl.txt entries can be applied
+        files_to_copy.update(playground.list_permission_files_in_patch(patch))
+        object_files.update(playground.list_object_files_in_patch(patch, reverse=reverse))
+    playground.copy_files_from_filesystem(
+        [CopyFile(source=root / f.relative_to("/"), target=f) for f in files_to_copy], sudo=sudo
+    )
+    # Large files are stored as pointers in the patch, so the base files need to match
+    playground.externalize_files(_base_objects(playground), object_files & files_to_copy)
+    _write_initial_permissions(playground=playground, files=files_to_copy, root=root, sudo=sudo)
 
 
-def _write_initial_permissions(*, playground: Playground, files: set[Path]) -> None:
+def _base_objects(playground: Playground) -> ObjectStore:
+    # Stored inside of .git so that the base objects are never committed
+    return ObjectStore(playground.location / ".git" / "dfu" / "objects")
+
+
+def _write_initial_permissions(*, playground: Playground, files: set[Path], root: Path, sudo: bool) -> None:
     acl_file = AclFile(entries={})
     paths: set[Path] = set()
     for file in files:
@@ -61,55 +300,108 @@ def _write_initial_permissions(*, playground: Playground, files: set[Path]) -> N
             paths.add(parent)
     paths.update(files)
 
-    for path in paths:
-        try:
-            normalized_path = Path(os.path.abspath(str(path)))
-            stats = subprocess.run(
-                ["sudo", "stat", "-c", "%a#%U#%G", str(normalized_path)],
-                capture_output=True,
-                text=True,
-                check=True,
-            )
-            mode, uid, gid = stats.stdout.strip().split("#")
-            entry = AclEntry(
-                path=normalized_path,
-                mode=mode,
-                uid=uid,
-                gid=gid,
-            )
-            acl_file.entries[normalized_path] = entry
-        except subprocess.CalledProcessError:
+    # Stat every path with a single call. Paths which can't be read (e.g. they don't exist) are
+    # reported on stderr and skipped, and xargs exits with 123, so the return code is not checked
+    # Important: Paths are separated by the null character, since it can't appear in a filename
+    normalized_paths = {os.path.abspath(str(path)) for path in paths}
+    stats = subprocess.run(
+        [*(["sudo"] if sudo else []), "xargs", "-0", "stat", "--printf", "%a#%U#%G#%n\\0", "--"],
+        input="\0".join(os.path.join(root, path.lstrip("/")) for path in sorted(normalized_paths)) + "\0",
+        capture_output=True,
+        text=True,
+    )
+    for record in stats.stdout.split("\0"):
+        if not record:
             continue
-    acl_file.entries.pop(Path("/"), None)
+        mode, uid, gid, name = record.split("#", 3)
+        normalized_path = str(Path("/") / Path(name).relative_to(root))
+        acl_file.entries[normalized_path] = AclEntry(
+            path=normalized_path,
+            mode=mode,
+            uid=uid,
+            gid=gid,
+        )
+    acl_file.entries.pop("/", None)
     acl_file.write(playground.location / "acl.txt")
 
 
-def _apply_patches(store: Store, *, playground: Playground, reverse: bool, interactive: bool) -> None:
-    patches = list(sorted(store.state.package_dir.glob('*.patch')))
+def _plan_patches(stores: Sequence[Store], *, reverse: bool, interactive: bool) -> list[PatchStep]:
+    # Each package's patches are applied in order, after the patches of the packages before it
+    patches = [patch for store in stores for patch in sorted(store.state.package_dir.glob('*.patch'))]
+    if interactive:
+        # Squashed patches are expanded into the original patches, so that they can be picked one by one
+        patches = [
+            original for patch in patches for original in (sorted(archive_location(patch).glob('*.patch')) or [patch])
+        ]
     if reverse:
         patches = list(reversed(patches))
-        pass
     if interactive:
-        steps = _patch_order_interactive(patches, reverse=reverse)
-    else:
-        steps = [PatchStep(patch=patch, interactive=False) for patch in patches]
-
-    for step in steps:
-        merged_cleanly = playground.apply_patch(step.patch, reverse=reverse)
-        if not merged_cleanly:
-            click.echo(
-                dedent(
-                    """\
-                    There was a merge conflict applying the patches. A subshell has been created for manual intervention.
-                    Make the correct changes, and then exit the subshell to continue."""
+        return _patch_order_interactive(patches, reverse=reverse)
+    return [PatchStep(patch=patch, interactive=False) for patch in patches]
+
+
+def _apply_patches(*, playground: Playground, journal: ApplyJournal) -> None:
+    for step in journal.remaining_steps:
+        patch = Path(step.patch)
+        merged_cleanly = playground.apply_patch(patch, reverse=journal.reverse)
+        if not merged_cleanly and not git_rerere_remaining(playground.location):
+            click.echo(f"Resolved the merge conflicts in {patch.name} using a recorded resolution", err=True)
+        elif not merged_cleanly:
+            with _terminal_lock:
+                click.echo(
+                    dedent(
+                        f"""\
+                        There was a merge conflict applying the patches to {journal.root}.
+                        A subshell has been created for manual intervention.
+                        Make the correct changes, and then exit the subshell to continue."""
+                    )
                 )
-            )
-            subshell(playground.location).check_returncode()
+                subshell(playground.location).check_returncode()
+            git_rerere(playground.location)
 
-        _apply_metadata(playground)
+        # The base files are only owned by the user after the initial copy, so the first step updates everything
+        _apply_metadata(playground, paths=_changed_paths(playground) if journal.completed else None, sudo=journal.sudo)
         if step.interactive:
             _confirm_changes(playground)
-        _auto_commit(playground, f"Patch {step.patch.name}")
+        _auto_commit(playground, f"Patch {patch.name}")
+        journal = journal.complete_step(git_rev_parse(playground.location, "HEAD"))
+        journal.write_atomic(_journal_path(playground))
+
+
+def _check_patches(playground: Playground, *, root: Path, patches: list[Path], reverse: bool, confirm: bool) -> None:
+    """Checks every patch against the base files before anything is applied, so that conflicts
+    are reported up front instead of after all of the patches before them were applied.
+    Without confirm, the conflicts are only reported"""
+    # A file modified by an earlier patch is compared against that patch's result instead of the base file,
+    # so it can only be checked once the earlier patch is applied
+    excludes: list[list[str]] = []
+    modified: set[str] = set()
+    for patch in patches:
+        excludes.append(["config.json", "acl.txt", *sorted(modified)])
+        modified.update(glob.escape(f"files{file}") for file in playground.list_files_in_patch(patch))
+        # The 3-way merge needs the files from before the patch, which are in its bundle
+        if patch.with_suffix('.pack').exists():
+            git_fetch_head(playground.location, str(patch.with_suffix('.pack').resolve()))
+
+    with ThreadPoolExecutor() as executor:
+        errors = list(
+            executor.map(
+                lambda patch, exclude: git_apply_check(playground.location, patch, reverse=reverse, exclude=exclude),
+                patches,
+                excludes,
+            )
+        )
+    conflicts = [(patch, error) for patch, error in zip(patches, errors) if error is not None]
+    if not conflicts:
+        return
+    with _terminal_lock:
+        click.echo(f"The following patches don't apply cleanly to the files in {root}:", err=True)
+        for patch, error in conflicts:
+            click.echo(f"  {patch.name}", err=True)
+            for line in error.splitlines():
+                click.echo(f"    {line}", err=True)
+        if confirm and not click.confirm("Continue and resolve the conflicts manually?", default=True, err=True):
+            raise ValueError("Aborting")
 
 
 def _patch_order_interactive(patches: list[Path], *, reverse: bool) -> list[PatchStep]:
@@ -151,39 +443,82 @@ def _patch_order_interactive(patches: list[Path], *, reverse: bool) -> list[Patc
     return steps
 
 
-def _apply_metadata(playground: Playground) -> None:
+def _changed_paths(playground: Playground, base: str = "HEAD") -> set[Path]:
+    """Returns the filesystem paths whose content or acl.txt entry changed since the base commit"""
+    changed = git_changed_files(playground.location, base)
+    paths = {Path("/", *Path(p).parts[1:]) for p in changed if Path(p).parts[0] == "files"}
+    if "acl.txt" in changed:
+        previous = AclFile.from_string(git_show(playground.location, base, "acl.txt"))
+        current = AclFile.from_file(playground.location / "acl.txt")
+        paths.update(Path(path) for path, entry in current.entries.items() if previous.entries.get(path) != entry)
+    return paths
+
+
+def _apply_metadata(playground: Playground, *, paths: set[Path] | None = None, sudo: bool = True) -> None:
+    """Applies the acl.txt entries to the playground files. If paths is None, every file is updated.
+    Otherwise only the paths (and their parent directories, which may have just been created) are updated"""
     try:
         acl_file = AclFile.from_file(playground.location / "acl.txt")
     except FileNotFoundError:
         raise ValueError("No acl.txt file found in the patch. This is unexpected")
-    metadata: dict[Path, PathMetadata] = {}
-    for path in playground.location.glob("files/**/*"):
-        sub_path = path.relative_to(playground.location / "files")
-        filesystem_path = Path("/") / sub_path
+    files_dir = playground.location / "files"
+    if paths is None:
+        playground_paths = set(files_dir.glob("**/*"))
+    else:
+        playground_paths = set()
+        for path in paths:
+            playground_path = files_dir / path.relative_to(Path("/"))
+            for candidate in (playground_path, *playground_path.parents):
+                if candidate == files_dir or candidate in playground_paths:
+                    break
+                playground_paths.add(candidate)
+        playground_paths = {p for p in playground_paths if os.path.lexists(p)}
+
+    # Group the paths by owner and mode, so there is one sudo call per group instead of two per file
+    owners: dict[str, list[str]] = defaultdict(list)
+    modes: dict[str, list[str]] = defaultdict(list)
+    for path in sorted(playground_paths):
+        sub_path = path.relative_to(files_dir)
+        filesystem_path = str(Path("/") / sub_path)
         if filesystem_path not in acl_file.entries:
             raise ValueError(f"File {filesystem_path} does not have an ACL entry")
         acl_entry = acl_file.entries[filesystem_path]
-        metadata[filesystem_path] = PathMetadata(
+        data = PathMetadata(
             path=filesystem_path,
             mode=acl_entry.mode,
             uid=acl_entry.uid,
             gid=acl_entry.gid,
             is_symlink=path.is_symlink(),
         )
-    for path, data in metadata.items():
-        playground_path = playground.location / "files" / path.relative_to(Path("/"))
-        normalized_path = Path(os.path.abspath(str(playground_path)))
-        subprocess.run(
-            ["sudo", "chown", "--no-dereference", f"{data.uid}:{data.gid}", str(normalized_path)],
-            check=True,
-            text=True,
-            capture_output=True,
-        )
+        normalized_path = os.path.abspath(str(path))
+        owners[f"{data.uid}:{data.gid}"].append(normalized_path)
         if not data.is_symlink:
-            subprocess.run(["sudo", "chmod", data.mode, normalized_path], check=True, text=True, capture_output=True)
+            modes[data.mode].append(normalized_path)
+
+    # chown clears the setuid and setgid bits, so it needs to run before chmod
+    for owner, owner_paths in owners.items():
+        _xargs(["chown", "--no-dereference", owner], owner_paths, sudo=sudo)
+    for mode, mode_paths in modes.items():
+        _xargs(["chmod", mode], mode_paths, sudo=sudo)
+
+
+def _xargs(command: list[str], paths: list[str], *, sudo: bool) -> None:
+    # Important: Paths are separated by the null character, since it can't appear in a filename
+    subprocess.run(
+        [*(["sudo"] if sudo else []), "xargs", "-0", *command, "--"],
+        input="\0".join(paths) + "\0",
+        check=True,
+        text=True,
+        capture_output=True,
+    )
 
 
 def _confirm_changes(playground: Playground) -> None:
+    with _terminal_lock:
+        _confirm_changes_locked(playground)
+
+
+def _confirm_changes_locked(playground: Playground) -> None:
     while True:
         response: str = click.prompt(
             "[I]nspect, [C]ontinue, [A]bort",
@@ -0,0 +1,205 @@
+import io
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import TemporaryFile
+from typing import Any, Callable, Generator, Mapping, TextIO
+
+import click
+import msgspec
+
+from dfu.daemon.protocol import PROTOCOL_VERSION, Request
+from dfu.daemon.server import command_params, run_command, warm_up
+from dfu.helpers.sudo import validate_sudo
+from dfu.package.package_config import find_package_config
+
+# These commands need a terminal, or don't finish
+UNSUPPORTED_COMMANDS = frozenset({'batch', 'daemon', 'shell'})
+# sudo forgets the password after 5 minutes by default
+SUDO_REFRESH_SECONDS = 60
+# The commands which write to the system, and whether they do with the given options.
+# Every package shares the system, so these entries run one at a time
+SYSTEM_COMMANDS: Mapping[str, Callable[[Mapping[str, Any]], bool]] = {
+    'apply': lambda params: not (params.get('dry_run') or params.get('abort')),
+    'snap': lambda params: True,
+}
+
+
+@dataclass(frozen=True)
+class BatchEntry:
+    args: tuple[str, ...]
+    # Relative to the directory that dfu batch runs in
+    cwd: str = '.'
+
+
+@dataclass(frozen=True)
+class BatchResult:
+    index: int
+    args: tuple[str, ...]
+    cwd: str
+    exit_code: int
+    stdout: str
+    stderr: str
+    duration: float
+
+
+def run_batch(batch: TextIO, *, jobs: int) -> bool:
+    """Runs each entry of the batch (a JSON object per line), and prints a JSON result per entry, in the same order.
+    Entries in different packages run in parallel, entries in the same package run in order,
+    and entries which write to the system run one at a time. Returns whether every entry succeeded"""
+    entries = parse_batch(batch)
+    if not entries:
+        return True
+    # The entries can't prompt for the password
+    validate_sudo()
+    # Import the commands, and discover the plugins, once instead of in each worker
+    warm_up()
+
+    groups = _group_entries(entries)
+    results: dict[int, BatchResult] = {}
+    next_index = 0
+    if jobs == 1 or len(groups) == 1:
+        last_refresh = time.monotonic()
+        for index, entry in enumerate(entries):
+            if time.monotonic() - last_refresh > SUDO_REFRESH_SECONDS:
+                _refresh_sudo()
+                last_refresh = time.monotonic()
+            results[index] = run_entry(index, entry)
+            next_index = _print_results(results, next_index)
+        return all(result.exit_code == 0 for result in results.values())
+
+    # The workers are forked, so they start with the imported commands and warm caches
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+        pending: set[Future[list[BatchResult]]] = {executor.submit(_run_group, group) for group in groups}
+        while pending:
+            done, pending = wait(pending, timeout=SUDO_REFRESH_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                for result in future.result():
+                    results[result.index] = result
+            next_index = _print_results(results, next_index)
+            if pending:
+                _refresh_sudo()
+    return all(result.exit_code == 0 for result in results.values())
+
+
+def parse_batch(batch: TextIO) -> list[BatchEntry]:
+    entries: list[BatchEntry] = []
+    for line_number, line in enumerate(batch, start=1):
+        if not line.strip():
+            continue
+        try:
+            entry = msgspec.json.decode(line, type=BatchEntry)
+        except msgspec.DecodeError as e:
+            raise ValueError(f"Line {line_number} of the batch is invalid: {e}")
+        if not entry.args:
+            raise ValueError(f"Line {line_number} of the batch doesn't have a command")
+        if entry.args[0] in UNSUPPORTED_COMMANDS:
+            raise ValueError(f"Line {line_number} of the batch runs dfu {entry.args[0]}, which can't run in a batch")
+        entries.append(entry)
+    return entries
+
+
+def run_entry(index: int, entry: BatchEntry) -> BatchResult:
+    start = time.perf_counter()
+    request = Request(version=PROTOCOL_VERSION, args=entry.args, cwd=os.path.abspath(entry.cwd))
+    with _capture_output() as (stdout, stderr):
+        exit_code = run_command(request, stdout, stderr)
+        stdout_text = _read_output(stdout)
+        stderr_text = _read_output(stderr)
+    return BatchResult(
+        index=index,
+        args=entry.args,
+        cwd=entry.cwd,
+        exit_code=exit_code,
+        stdout=stdout_text,
+        stderr=stderr_text,
+        duration=round(time.perf_counter() - start, 3),
+    )
+
+
+def _group_entries(entries: list[BatchEntry]) -> list[list[tuple[int, BatchEntry]]]:
+    """Groups the entries which have to run in order. The groups of packages with entries that write to the system
+    are merged, so that those entries don't run at the same time"""
+    groups: dict[Path, list[tuple[int, BatchEntry]]] = {}
+    for index, entry in enumerate(entries):
+        groups.setdefault(_package_dir(Path(entry.cwd)), []).append((index, entry))
+    system_group: list[tuple[int, BatchEntry]] = []
+    other_groups: list[list[tuple[int, BatchEntry]]] = []
+    for group in groups.values():
+        if any(_modifies_system(entry) for _, entry in group):
+            system_group.extend(group)
+        else:
+            other_groups.append(group)
+    return [sorted(system_group, key=lambda item: item[0]), *other_groups] if system_group else other_groups
+
+
+def _modifies_system(entry: BatchEntry) -> bool:
+    if entry.args[0] not in SYSTEM_COMMANDS:
+        return False
+    params = command_params(entry.args)
+    return params is not None and SYSTEM_COMMANDS[entry.args[0]](params)
+
+
+@contextmanager
+def _capture_output() -> Generator[tuple[io.TextIOWrapper, io.TextIOWrapper], None, None]:
+    """Captures the output of an entry into temporary files. The file descriptors are redirected too,
+    so that the output of the subprocesses it runs (e.g. pacman) doesn't end up in the results"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(fd) for fd in (0, 1, 2)]
+    with (
+        open(os.devnull, 'rb') as devnull,
+        TemporaryFile(buffering=0) as stdout_file,
+        TemporaryFile(buffering=0) as stderr_file,
+    ):
+        # Unbuffered, so that the output of the command and its subprocesses stays in order
+        stdout = io.TextIOWrapper(stdout_file, encoding='utf-8', errors='replace', write_through=True)
+        stderr = io.TextIOWrapper(stderr_file, encoding='utf-8', errors='replace', write_through=True)
+        try:
+            for fd, f in ((0, devnull), (1, stdout_file), (2, stderr_file)):
+                os.dup2(f.fileno(), fd)
+            yield stdout, stderr
+        finally:
+            for fd, saved_fd in zip((0, 1, 2), saved):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            # The temporary files are closed by their own context managers
+            stdout.detach()
+            stderr.detach()
+
+
+def _read_output(f: io.TextIOWrapper) -> str:
+    f.seek(0)
+    return f.read()
+
+
+def _run_group(group: list[tuple[int, BatchEntry]]) -> list[BatchResult]:
+    return [run_entry(index, entry) for index, entry in group]
+
+
+def _print_results(results: dict[int, BatchResult], next_index: int) -> int:
+    # Print the results in the same order as the entries, as soon as the earlier entries finished
+    while next_index in results:
+        click.echo(msgspec.json.encode(results[next_index]).decode())
+        next_index += 1
+    return next_index
+
+
+def _package_dir(cwd: Path) -> Path:
+    # Commands in the same package write to the same files, e.g. the patches and the apply playground
+    package_config = find_package_config(cwd.resolve())
+    return package_config.parent if package_config else cwd.resolve()
+
+
+def _refresh_sudo() -> None:
+    # If it fails, the entries which need sudo fail, and report it in their stderr
+    try:
+        subprocess.run(['sudo', '--non-interactive', '--validate'], capture_output=True)
+    except FileNotFoundError:
+        pass
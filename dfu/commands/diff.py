@@ -1,14 +1,19 @@
 import json
+from contextlib import contextmanager
 from pathlib import Path
 from shutil import copy2
+from typing import Generator
 
 import click
 
 from dfu import __version__
 from dfu.api import Playground, Store, UpdateInstalledDependenciesEvent
 from dfu.api.playground import CopyFile
+from dfu.api.store import PendingDispatch
 from dfu.helpers.normalize_snapshot_index import normalize_snapshot_index
 from dfu.helpers.subshell import subshell
+from dfu.helpers.sudo import validate_sudo
+from dfu.package.objects import ObjectStore
 from dfu.revision.git import (
     copy_template_gitignore,
     git_add,
@@ -19,35 +24,61 @@ from dfu.revision.git import (
     git_init,
     git_num_commits,
 )
-from dfu.snapshots.changes import files_modified, get_permissions
+from dfu.snapshots.changes import files_modified, get_permissions, in_subtrees
+from dfu.snapshots.dedupe import remove_identical_files
 from dfu.snapshots.snapper import Snapper, SnapperName
 
 
-def generate_diff(store: Store, *, from_index: int, to_index: int, interactive: bool) -> None:
+def generate_diff(
+    store: Store, *, from_index: int, to_index: int, interactive: bool, export_packages: bool = False
+) -> None:
     from_index = normalize_snapshot_index(store.state.package_config, from_index)
     to_index = normalize_snapshot_index(store.state.package_config, to_index)
     if from_index > to_index:
         raise ValueError(f"from_index {from_index} is greater than to_index {to_index}")
 
-    with Playground.temporary(prefix="dfu_diff_") as playground:
+    # The detection runs sudo in the background, where it can't ask for the password
+    validate_sudo()
+    # Detecting the installed programs only needs the snapshots, so it runs while the files are copied
+    dependencies = store.dispatch_async(
+        UpdateInstalledDependenciesEvent(from_index=from_index, to_index=to_index, export_packages=export_packages)
+    )
+    with _stop_unless_joined(dependencies), Playground.temporary(prefix="dfu_diff_") as playground:
         _initialize_playground(store, playground)
         sources = files_modified(store, from_index=from_index, to_index=to_index, only_ignored=False)
+        sources, dedupe_stats = remove_identical_files(store, from_index=from_index, to_index=to_index, sources=sources)
+        if dedupe_stats.files:
+            click.echo(
+                f"Skipped copying {dedupe_stats.files} unchanged files ({dedupe_stats.bytes} bytes)",
+                err=True,
+            )
         pre_sources = {snapper_name: files.pre_files for snapper_name, files in sources.items()}
         post_sources = {snapper_name: files.post_files for snapper_name, files in sources.items()}
-        _copy_files(store, playground=playground, snapshot_index=from_index, sources=pre_sources)
+        # Files where only the permissions changed are recorded in acl.txt, without copying their content
+        permission_sources = {snapper_name: files.permission_files for snapper_name, files in sources.items()}
+        pre_subtrees = {snapper_name: files.pre_subtrees for snapper_name, files in sources.items()}
+        post_subtrees = {snapper_name: files.post_subtrees for snapper_name, files in sources.items()}
+        objects = ObjectStore(store.state.package_dir / "objects")
+        _copy_files(store, playground=playground, snapshot_index=from_index, sources=pre_sources, subtrees=pre_subtrees)
+        num_objects = playground.externalize_large_files(objects, store.state.config.large_files)
         _copy_permissions(
             store,
             playground=playground,
-            files_modified=pre_sources,
+            files_modified=_merge_sources(pre_sources, permission_sources),
             snapshot_index=from_index,
+            subtrees=pre_subtrees,
         )
         _auto_commit(playground.location, "Initial files", ['files', 'acl.txt'])
-        _copy_files(store, playground=playground, snapshot_index=to_index, sources=post_sources)
+        _copy_files(store, playground=playground, snapshot_index=to_index, sources=post_sources, subtrees=post_subtrees)
+        num_objects += playground.externalize_large_files(objects, store.state.config.large_files)
+        if num_objects:
+            click.echo(f"Stored {num_objects} large files in {objects.root}", err=True)
         _copy_permissions(
             store,
             playground=playground,
-            files_modified=post_sources,
+            files_modified=_merge_sources(post_sources, permission_sources),
             snapshot_index=to_index,
+            subtrees=post_subtrees,
         )
         _copy_config(playground)
         if interactive:
@@ -57,13 +88,29 @@ def generate_diff(store: Store, *, from_index: int, to_index: int, interactive:
                 return
         _auto_commit(playground.location, "Modified files", ['files', 'acl.txt', 'config.json'])
         _create_patch(store, playground=playground, from_index=from_index, to_index=to_index)
-        click.echo("Detecting which programs were installed and removed...", err=True)
-        store.dispatch(UpdateInstalledDependenciesEvent(from_index=from_index, to_index=to_index))
+        click.echo("Waiting for the detection of the installed and removed programs...", err=True)
+        dependencies.join()
         click.echo("Updated the installed programs", err=True)
 
 
+@contextmanager
+def _stop_unless_joined(dependencies: PendingDispatch) -> Generator[None, None, None]:
+    # When the diff is aborted or fails, the detection is stopped instead of recording the programs
+    try:
+        yield
+    finally:
+        if not dependencies.finished:
+            click.echo("Stopping the detection of the installed and removed programs...", err=True)
+            dependencies.cancel()
+
+
 def _copy_files(
-    store: Store, *, playground: Playground, snapshot_index: int, sources: dict[SnapperName, set[str]]
+    store: Store,
+    *,
+    playground: Playground,
+    snapshot_index: int,
+    sources: dict[SnapperName, set[str]],
+    subtrees: dict[SnapperName, set[str]],
 ) -> None:
     for snapper_name, files in sources.items():
         snapshot_id = store.state.package_config.snapshots[snapshot_index][snapper_name]
@@ -71,7 +118,13 @@ def _copy_files(
         mountpoint = snapper.get_mountpoint()
         snapshot_dir = snapper.get_snapshot_path(snapshot_id)
         paths_to_copy: list[CopyFile] = []
+        roots = subtrees.get(snapper_name, set())
+        for root in roots:
+            src = snapshot_dir / Path(root).relative_to(mountpoint)
+            paths_to_copy.append(CopyFile(source=src, target=Path(root), recursive=True))
         for file in files:
+            if in_subtrees(file, roots):
+                continue
             sub_path = Path(file).relative_to(mountpoint)
             src = snapshot_dir / sub_path
             dest = Path(file)
@@ -79,14 +132,21 @@ def _copy_files(
         playground.copy_files_from_filesystem(paths_to_copy)
 
 
+def _merge_sources(
+    sources: dict[SnapperName, set[str]], other: dict[SnapperName, set[str]]
+) -> dict[SnapperName, set[str]]:
+    return {snapper_name: files | other.get(snapper_name, set()) for snapper_name, files in sources.items()}
+
+
 def _copy_permissions(
     store: Store,
     *,
     playground: Playground,
     files_modified: dict[SnapperName, set[str]],
     snapshot_index: int,
+    subtrees: dict[SnapperName, set[str]],
 ) -> None:
-    acl_file = get_permissions(store, files_modified=files_modified, snapshot_index=snapshot_index)
+    acl_file = get_permissions(store, files_modified=files_modified, snapshot_index=snapshot_index, subtrees=subtrees)
     dest = playground.location / "acl.txt"
     acl_file.write(dest)
 
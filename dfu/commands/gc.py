@@ -0,0 +1,28 @@
+from pathlib import Path
+
+import click
+
+from dfu.api.playground import find_leaked_playgrounds, remove_directory
+from dfu.package.package_config import find_package_config
+
+
+def collect_garbage(*, dry_run: bool) -> None:
+    """Removes the playgrounds that dfu commands left behind, e.g. because they were killed
+    or their files couldn't be removed without sudo"""
+    leaked = find_leaked_playgrounds()
+    package_config = find_package_config(Path.cwd())
+    if package_config and (package_config.parent / '.dfu').is_dir():
+        # dfu apply removes its playground from the package in the background
+        leaked.extend(find_leaked_playgrounds(package_config.parent / '.dfu'))
+
+    if not leaked:
+        click.echo("There are no leaked playgrounds", err=True)
+        return
+    for path in leaked:
+        if dry_run:
+            click.echo(f"Would remove {path}", err=True)
+        else:
+            click.echo(f"Removing {path}", err=True)
+            remove_directory(path)
+    if not dry_run:
+        click.echo(f"Removed {len(leaked)} leaked playgrounds", err=True)
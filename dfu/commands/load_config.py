@@ -7,9 +7,8 @@ from typing import Iterable
 import click
 from platformdirs import PlatformDirs
 
-from dfu.config import Btrfs, Config
-from dfu.snapshots.btrfs import get_all_subvolumes
-from dfu.snapshots.snapper import Snapper
+from dfu.config import Btrfs, Config, LargeFiles
+from dfu.snapshots.environment import load_environment
 from dfu.snapshots.sort_snapper_configs import sort_snapper_configs
 
 
@@ -45,15 +44,19 @@ def _merge(base_config: Config | None, override_config: Config | None) -> Config
     if base_config and override_config:
         return Config(
             btrfs=override_config.btrfs or base_config.btrfs,
+            large_files=(
+                override_config.large_files if override_config.large_files != LargeFiles() else base_config.large_files
+            ),
         )
     return override_config or base_config
 
 
 def _get_default_config() -> Config:
-    snapper_configs = sort_snapper_configs(Snapper.get_configs())
+    environment = load_environment()
+    snapper_configs = sort_snapper_configs(environment.snapper_configs)
     config = Config(btrfs=Btrfs(snapper_configs=snapper_configs))
-    all_subvolumes = set(get_all_subvolumes())
-    snapper_subvolumes = set([str(Snapper(c).get_mountpoint()) for c in config.btrfs.snapper_configs])
+    all_subvolumes = set(environment.subvolumes)
+    snapper_subvolumes = set(environment.mountpoints.values())
     missing_subvolumes = all_subvolumes - snapper_subvolumes
     if len(missing_subvolumes) > 0:
         click.echo(
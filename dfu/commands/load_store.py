@@ -1,22 +1,27 @@
-from importlib.metadata import entry_points
 from pathlib import Path
 
-from dfu.api.entrypoint import Entrypoint
+from dfu.api.plugin_registry import load_registry
 from dfu.api.state import State
 from dfu.api.store import Store
 from dfu.commands.load_config import load_config
 from dfu.package.package_config import PackageConfig, find_package_config
 
 
-def find_package_dir(path: Path = Path.cwd()) -> Path:
-    config_path = find_package_config(path)
+def find_package_dir(path: Path | None = None) -> Path:
+    # The current directory is read on every call, since the dfu daemon runs each command in the client's directory
+    config_path = find_package_config(path or Path.cwd())
     if not config_path:
         raise ValueError("No dfu_config.json found in the current directory or any parent directory")
     return config_path.parent
 
 
-def load_store() -> Store:
-    package_dir = find_package_dir()
+def load_store(package_dir: Path | None = None) -> Store:
+    if package_dir is None:
+        package_dir = find_package_dir()
+    elif not (package_dir / "dfu_config.json").exists():
+        raise ValueError(f"No dfu_config.json found in {package_dir}")
+    # Paths derived from the package dir (e.g. the patches in the apply journal) stay valid in other directories
+    package_dir = package_dir.resolve()
     package_config = PackageConfig.from_file(package_dir / "dfu_config.json")
 
     state = State(
@@ -24,9 +29,14 @@ def load_store() -> Store:
         package_dir=package_dir,
         package_config=package_config,
     )
-    store = Store(state)
-    for entry_point in entry_points().select(group='dfu.plugin'):
-        fn: Entrypoint = entry_point.load()
-        plugin = fn(store)
-        store.plugins.add(plugin)
+    return load_plugins(Store(state))
+
+
+def load_plugins(store: Store) -> Store:
+    for spec in load_registry().plugins:
+        if spec.events is None:
+            # The plugin doesn't declare what it needs, so it has to be created right away
+            store.add_plugin(spec.load()(store))
+        else:
+            store.add_lazy_plugin(spec.load, events=spec.events, subscribes=spec.subscribes)
     return store
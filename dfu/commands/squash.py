@@ -0,0 +1,194 @@
+import re
+import subprocess
+from pathlib import Path
+
+import click
+from unidiff import PatchSet
+
+from dfu.api import Playground, Store
+from dfu.package.acl_file import AclEntry, AclFile
+from dfu.revision.git import (
+    git_add,
+    git_apply,
+    git_bundle,
+    git_checkout_paths,
+    git_commit,
+    git_diff,
+    git_diff_name_status,
+    git_fetch_head,
+    git_init,
+    git_reset_hard,
+    git_rev_parse,
+    git_rm,
+    git_show,
+    git_write_tree,
+)
+
+_PATCH_NAME_REGEX = re.compile(r'^(?P<from_index>[0-9]+)_to_(?P<to_index>[0-9]+)$')
+
+
+def squash_patches(store: Store) -> None:
+    """Combines every patch in the package into a single patch, which is equivalent to applying them in order.
+    The original patches are moved to archive/<squashed patch name>/, so they can still be applied one by one"""
+    package_dir = store.state.package_dir
+    patches = list(sorted(package_dir.glob('*.patch')))
+    if len(patches) < 2:
+        raise ValueError("There need to be at least two patches to squash")
+    for patch in patches:
+        if not patch.with_suffix('.pack').exists():
+            raise ValueError(f"Patch {patch.name} does not have a bundle, so it can't be squashed")
+    squashed_patch = package_dir / f"{_patch_range(patches[0])[0]}_to_{_patch_range(patches[-1])[1]}.patch"
+    archive = archive_location(squashed_patch)
+    if archive.exists():
+        raise ValueError(f"{archive} already exists")
+
+    with Playground.temporary(prefix="dfu_squash_") as playground:
+        git_init(playground.location)
+        base_commit, head_commit = _compose_patches(playground, patches)
+        _verify_patches(playground, patches, base_commit=base_commit, head_commit=head_commit)
+        git_reset_hard(playground.location, head_commit)
+
+        # The squashed patch is written under temporary names first, so that the package keeps
+        # its original patches if anything fails
+        squashed_pack = squashed_patch.with_suffix('.pack')
+        temporary_patch = squashed_patch.with_name(f"{squashed_patch.name}.tmp")
+        temporary_pack = squashed_pack.with_name(f"{squashed_pack.name}.tmp")
+        try:
+            git_bundle(playground.location, temporary_pack)
+            temporary_patch.write_text(git_diff(playground.location, base_commit, head_commit))
+        except BaseException:
+            temporary_pack.unlink(missing_ok=True)
+            temporary_patch.unlink(missing_ok=True)
+            raise
+
+        archive.mkdir(parents=True, mode=0o755)
+        for patch in patches:
+            for path in (patch, patch.with_suffix('.pack')):
+                path.rename(archive / path.name)
+        temporary_pack.rename(squashed_pack)
+        temporary_patch.rename(squashed_patch)
+    click.echo(f"Squashed {len(patches)} patches into {squashed_patch.name}", err=True)
+    click.echo(f"The original patches were moved to {archive}", err=True)
+
+
+def archive_location(patch: Path) -> Path:
+    return patch.parent / "archive" / patch.stem
+
+
+def _patch_range(patch: Path) -> tuple[str, str]:
+    match = _PATCH_NAME_REGEX.match(patch.stem)
+    if not match:
+        raise ValueError(f"Unexpected patch name {patch.name}. Expected a name like 000_to_001.patch")
+    return match.group('from_index'), match.group('to_index')
+
+
+def _compose_patches(playground: Playground, patches: list[Path]) -> tuple[str, str]:
+    """Creates the "Initial files" and "Modified files" commits of the squashed patch, from the commits in each bundle.
+    A file's initial content comes from the first patch that changes it, and its final content from the last one"""
+    location = playground.location
+    commits: list[tuple[str, str]] = []
+    for patch in patches:
+        post_commit = git_fetch_head(location, str(patch.with_suffix('.pack').resolve()))
+        commits.append((git_rev_parse(location, f"{post_commit}~1"), post_commit))
+
+    seen_files: set[str] = set()
+    seen_acl: set[str] = set()
+    acl_file = AclFile(entries={})
+    for pre_commit, post_commit in commits:
+        changes = git_diff_name_status(location, pre_commit, post_commit)
+        # Files which were added by this patch didn't exist in the initial files
+        initial_files = [
+            path for status, path in changes if path.startswith('files/') and path not in seen_files and status != 'A'
+        ]
+        git_checkout_paths(location, pre_commit, initial_files)
+        seen_files.update(path for _, path in changes)
+
+        pre_acl = _read_acl(playground, pre_commit)
+        post_acl = _read_acl(playground, post_commit)
+        for path, entry in pre_acl.entries.items():
+            if path not in seen_acl:
+                acl_file.entries[path] = entry
+        seen_acl.update(pre_acl.entries.keys() | post_acl.entries.keys())
+    acl_file.write(location / 'acl.txt')
+    git_add(location, ['.'])
+    git_commit(location, "Initial files")
+    base_commit = git_rev_parse(location, 'HEAD')
+
+    for pre_commit, post_commit in commits:
+        changes = git_diff_name_status(location, pre_commit, post_commit)
+        git_checkout_paths(
+            location, post_commit, [path for status, path in changes if path.startswith('files/') and status != 'D']
+        )
+        git_rm(location, [path for status, path in changes if path.startswith('files/') and status == 'D'])
+
+        pre_acl = _read_acl(playground, pre_commit)
+        post_acl = _read_acl(playground, post_commit)
+        for path in pre_acl.entries.keys() - post_acl.entries.keys():
+            acl_file.entries.pop(path, None)
+        acl_file.entries.update(post_acl.entries)
+    acl_file.write(location / 'acl.txt')
+    git_checkout_paths(location, commits[-1][1], ['config.json'])
+    git_add(location, ['.'])
+    git_commit(location, "Modified files")
+    return base_commit, git_rev_parse(location, 'HEAD')
+
+
+def _verify_patches(playground: Playground, patches: list[Path], *, base_commit: str, head_commit: str) -> None:
+    """Applies the original patches and the squashed patch to the initial files, and checks that both result
+    in the same files and permissions"""
+    location = playground.location
+    expected_files = _files_tree(playground, head_commit)
+    expected_acl = _read_acl(playground, head_commit).entries
+
+    git_reset_hard(location, base_commit)
+    for patch in patches:
+        if not git_apply(location, patch, exclude=['acl.txt', 'config.json']):
+            raise ValueError(f"Patch {patch.name} does not apply cleanly after the previous patches")
+    if _files_tree(playground, git_write_tree(location)) != expected_files:
+        raise ValueError("The squashed patch does not produce the same files as the original patches")
+    acl_entries = dict(_read_acl(playground, base_commit).entries)
+    for patch in patches:
+        removed, added = _acl_changes(patch)
+        for path in removed:
+            acl_entries.pop(path, None)
+        acl_entries.update(added)
+    if acl_entries != expected_acl:
+        raise ValueError("The squashed patch does not produce the same permissions as the original patches")
+
+    git_reset_hard(location, base_commit)
+    squashed_patch = location / '.git' / 'squashed.patch'
+    squashed_patch.write_text(git_diff(location, base_commit, head_commit))
+    if not git_apply(location, squashed_patch, exclude=['acl.txt', 'config.json']):
+        raise ValueError("The squashed patch does not apply cleanly to the initial files")
+    if _files_tree(playground, git_write_tree(location)) != expected_files:
+        raise ValueError("The squashed patch does not produce the same files as the original patches")
+
+
+def _files_tree(playground: Playground, revision: str) -> str | None:
+    try:
+        return git_rev_parse(playground.location, f"{revision}:files")
+    except subprocess.CalledProcessError:
+        # Nothing is in the files directory
+        return None
+
+
+def _read_acl(playground: Playground, revision: str) -> AclFile:
+    try:
+        return AclFile.from_string(git_show(playground.location, revision, 'acl.txt'))
+    except subprocess.CalledProcessError:
+        return AclFile(entries={})
+
+
+def _acl_changes(patch: Path) -> tuple[set[str], dict[str, AclEntry]]:
+    """Returns the acl.txt entries that the patch removes, and the entries it adds"""
+    removed: list[str] = []
+    added: list[str] = []
+    for file in PatchSet(patch.read_text()):
+        if file.path == 'acl.txt':
+            for hunk in file:
+                removed.extend(line.value for line in hunk if line.is_removed)
+                added.extend(line.value for line in hunk if line.is_added)
+    return (
+        set(AclFile.from_string("".join(removed)).entries.keys()),
+        AclFile.from_string("".join(added)).entries,
+    )
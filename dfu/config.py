@@ -1,5 +1,5 @@
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import msgspec
 
@@ -11,9 +11,18 @@ class Btrfs:
     snapper_configs: tuple[SnapperName, ...]
 
 
+@dataclass
+class LargeFiles:
+    # Files bigger than this (in bytes) are stored in the package's objects directory, instead of the patch
+    max_size: int = 1024 * 1024
+    # Whether binary files of any size are also stored in the objects directory
+    binary: bool = True
+
+
 @dataclass
 class Config:
     btrfs: Btrfs
+    large_files: LargeFiles = field(default_factory=LargeFiles)
 
     @classmethod
     def from_file(cls, path: os.PathLike[str] | str) -> "Config":
@@ -0,0 +1,11 @@
+import os
+from pathlib import Path
+
+# Set to run the command in the current process, even if a dfu daemon is running
+NO_DAEMON_VAR = 'DFU_NO_DAEMON'
+
+
+def socket_path() -> Path:
+    # Same as PlatformDirs("dfu").user_runtime_path on Linux, without importing platformdirs on every startup
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or f"/run/user/{os.getuid()}"
+    return Path(runtime_dir) / 'dfu' / 'daemon.sock'
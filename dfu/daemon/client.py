@@ -0,0 +1,41 @@
+import os
+import socket
+import sys
+from pathlib import Path
+from typing import Sequence
+
+from dfu.daemon.protocol import PROTOCOL_VERSION, Reply, Request, read_frame, write_frame
+
+
+def run_in_daemon(path: Path, args: Sequence[str]) -> int | None:
+    """Runs the dfu command in the daemon listening on path, and returns its exit code.
+    Returns None if the daemon isn't running, or can't run the command"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(str(path))
+        except OSError:
+            # The daemon was stopped, or crashed and left its socket behind
+            return None
+        with sock.makefile('rwb') as f:
+            request = Request(
+                version=PROTOCOL_VERSION,
+                args=tuple(args),
+                cwd=os.getcwd(),
+                stdout_isatty=sys.stdout.isatty(),
+                stderr_isatty=sys.stderr.isatty(),
+            )
+            write_frame(f, request)
+            while True:
+                reply = read_frame(f, Reply)
+                if reply is None:
+                    print("The dfu daemon stopped before the command finished", file=sys.stderr)
+                    return 1
+                if not reply.served:
+                    return None
+                if reply.stream is not None:
+                    stream = sys.stdout if reply.stream == 'stdout' else sys.stderr
+                    stream.write(reply.text)
+                    stream.flush()
+                if reply.exit_code is not None:
+                    return reply.exit_code
@@ -0,0 +1,53 @@
+import io
+import struct
+from dataclasses import dataclass
+from typing import Literal, Type, TypeVar
+
+import msgspec
+
+# Bump when Request or Reply change, so that the CLI doesn't talk to a daemon started by a different version of dfu
+PROTOCOL_VERSION = 1
+
+T = TypeVar('T')
+
+# Each frame is the length of the payload as a big endian uint32, followed by the msgpack payload
+_LENGTH = struct.Struct('>I')
+
+
+@dataclass(frozen=True)
+class Request:
+    version: int
+    args: tuple[str, ...]
+    cwd: str
+    # Whether the client's stdout and stderr are terminals, so that the output is colored the same way
+    stdout_isatty: bool = False
+    stderr_isatty: bool = False
+
+
+@dataclass(frozen=True)
+class Reply:
+    """The daemon sends a Reply for each write to stdout or stderr, and a final Reply with the exit_code.
+    If the daemon can't run the command, the only Reply has served set to False"""
+
+    stream: Literal['stdout', 'stderr'] | None = None
+    text: str = ''
+    exit_code: int | None = None
+    served: bool = True
+
+
+def write_frame(f: io.BufferedIOBase, message: Request | Reply) -> None:
+    payload = msgspec.msgpack.encode(message)
+    f.write(_LENGTH.pack(len(payload)) + payload)
+    f.flush()
+
+
+def read_frame(f: io.BufferedIOBase, type: Type[T]) -> T | None:
+    """Returns the next message, or None if the connection was closed"""
+    header = f.read(_LENGTH.size)
+    if len(header) < _LENGTH.size:
+        return None
+    (length,) = _LENGTH.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length:
+        return None
+    return msgspec.msgpack.decode(payload, type=type)
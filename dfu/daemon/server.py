@@ -0,0 +1,179 @@
+import importlib
+import io
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+from typing import Any, Callable, Literal, Mapping, Sequence
+
+import click
+
+from dfu.daemon.protocol import PROTOCOL_VERSION, Reply, Request, read_frame, write_frame
+
+# The commands the daemon runs, and whether it can run them with the given options.
+# The daemon can't prompt the user, so interactive commands always run in the CLI
+SERVED_COMMANDS: Mapping[str, Callable[[Mapping[str, Any]], bool]] = {
+    'ls-files': lambda params: True,
+    'diff': lambda params: not params.get('interactive'),
+    # Without --force, apply asks for confirmation
+    'apply': lambda params: bool(
+        params.get('dry_run')
+        and params.get('force')
+        and not (params.get('interactive') or params.get('resume') or params.get('abort'))
+    ),
+}
+
+
+def serve(path: Path) -> None:
+    """Runs the dfu commands that the CLI sends to the socket, one at a time, until interrupted"""
+    warm_up()
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if path.exists():
+        if _is_listening(path):
+            raise ValueError(f"A dfu daemon is already running on {path}")
+        # A daemon that crashed left its socket behind
+        path.unlink()
+    with socketserver.UnixStreamServer(str(path), _Handler) as server:
+        os.chmod(path, 0o600)
+        click.echo(f"Listening on {path}", err=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            path.unlink(missing_ok=True)
+
+
+def can_serve(args: Sequence[str]) -> bool:
+    if not args or args[0] not in SERVED_COMMANDS:
+        return False
+    params = command_params(args)
+    return params is not None and SERVED_COMMANDS[args[0]](params)
+
+
+def command_params(args: Sequence[str]) -> Mapping[str, Any] | None:
+    """Parses the options of the dfu command without running it. Returns None if there's no such command"""
+    from dfu.cli import main
+
+    command = main.get_command(click.Context(main), args[0])
+    if command is None:
+        return None
+    # Parsing errors are ignored, the command reports them when it runs
+    with command.make_context(args[0], list(args[1:]), resilient_parsing=True) as ctx:
+        return ctx.params
+
+
+def run_command(request: Request, stdout: io.TextIOBase, stderr: io.TextIOBase) -> int:
+    """Runs the dfu command as if it was started in request.cwd, and returns its exit code"""
+    from dfu.cli import main
+
+    daemon_cwd = os.getcwd()
+    daemon_stdin = sys.stdin
+    try:
+        os.chdir(request.cwd)
+        # Prompts fail right away, instead of waiting for input that never comes
+        sys.stdin = io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                result = main.main(list(request.args), prog_name='dfu', standalone_mode=False)
+            except SystemExit as e:
+                return e.code if isinstance(e.code, int) else 1
+            except click.ClickException as e:
+                e.show()
+                return e.exit_code
+            except click.Abort:
+                click.echo("Aborted!", err=True)
+                return 1
+            except Exception:
+                traceback.print_exc()
+                return 1
+            # standalone_mode=False returns the exit code of click.exceptions.Exit, e.g. from --help
+            return result if isinstance(result, int) else 0
+    finally:
+        sys.stdin = daemon_stdin
+        os.chdir(daemon_cwd)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        request = read_frame(self.rfile, Request)
+        if request is None:
+            return
+        if request.version != PROTOCOL_VERSION or not _can_serve_in(request) or not _sudo_authenticated():
+            write_frame(self.wfile, Reply(served=False))
+            return
+        stdout = _ReplyStream(self.wfile, 'stdout', isatty=request.stdout_isatty)
+        stderr = _ReplyStream(self.wfile, 'stderr', isatty=request.stderr_isatty)
+        try:
+            exit_code = run_command(request, stdout, stderr)
+            write_frame(self.wfile, Reply(exit_code=exit_code))
+        except BrokenPipeError:
+            # The CLI was interrupted
+            pass
+
+
+def _can_serve_in(request: Request) -> bool:
+    daemon_cwd = os.getcwd()
+    try:
+        # Relative paths in the arguments are relative to the client
+        os.chdir(request.cwd)
+        return can_serve(request.args)
+    except OSError:
+        return False
+    finally:
+        os.chdir(daemon_cwd)
+
+
+def _sudo_authenticated() -> bool:
+    # The commands can't ask for the sudo password, since the daemon's terminal isn't the CLI's.
+    # Validating also extends the daemon's credentials, so they only expire when the daemon isn't used
+    try:
+        return subprocess.run(['sudo', '--non-interactive', '--validate'], capture_output=True).returncode == 0
+    except FileNotFoundError:
+        # Without sudo, the commands fail the same way as they would in the CLI
+        return True
+
+
+class _ReplyStream(io.TextIOBase):
+    """Sends everything that the command writes to the CLI, as soon as it's written"""
+
+    def __init__(self, f: io.BufferedIOBase, stream: Literal['stdout', 'stderr'], *, isatty: bool) -> None:
+        self._f = f
+        self._stream = stream
+        self._isatty = isatty
+
+    def writable(self) -> bool:
+        return True
+
+    def isatty(self) -> bool:
+        return self._isatty
+
+    def write(self, text: str) -> int:
+        if not isinstance(text, str):
+            # click writes bytes to the stream if it accepts them
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        if text:
+            write_frame(self._f, Reply(stream=self._stream, text=text))
+        return len(text)
+
+
+def warm_up() -> None:
+    # Import the served commands, and discover the plugins, before the first command instead of during it
+    from dfu.api.plugin_registry import load_registry
+
+    for module in ('dfu.commands.apply', 'dfu.commands.diff', 'dfu.commands.load_store', 'dfu.commands.ls_files'):
+        importlib.import_module(module)
+    load_registry()
+
+
+def _is_listening(path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except OSError:
+            return False
+    return True
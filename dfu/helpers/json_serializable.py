@@ -4,6 +4,8 @@ from typing import Any, Dict, Type, TypeVar, get_args, get_origin
 
 import msgspec
 
+from dfu.helpers.atomic_write import write_atomic
+
 T = TypeVar('T', bound='JsonSerializableMixin')
 
 
@@ -17,14 +19,19 @@ class JsonSerializableMixin:
     def from_json(cls: Type[T], data: str) -> T:
         return msgspec.json.decode(data, type=cls, dec_hook=cls.dec_hook)
 
+    def encode(self) -> bytes:
+        data = msgspec.json.encode(self, enc_hook=self.enc_hook)
+        # Pretty-print the JSON
+        return msgspec.json.format(data, indent=2)
+
     def write(self, path: Path, mode: str = "wb") -> None:
         if 'b' not in mode:
             mode += 'b'
-        data = msgspec.json.encode(self, enc_hook=self.enc_hook)
-        # Pretty-print the JSON
-        data = msgspec.json.format(data, indent=2)
         with open(path, mode) as f:
-            f.write(data)
+            f.write(self.encode())
+
+    def write_atomic(self, path: Path) -> None:
+        write_atomic(path, self.encode())
 
     @classmethod
     def enc_hook(cls, obj: Any) -> Any:
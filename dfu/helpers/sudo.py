@@ -0,0 +1,13 @@
+import subprocess
+
+
+def validate_sudo() -> None:
+    """Asks for the sudo password once, so that the later sudo calls (which may run in the background,
+    or without a terminal) don't prompt"""
+    try:
+        subprocess.run(['sudo', '--validate'], check=True)
+    except FileNotFoundError:
+        # Without sudo, the sudo calls fail the same way as they would without validating first
+        pass
+    except subprocess.CalledProcessError:
+        raise ValueError("Could not authenticate with sudo")
@@ -2,47 +2,54 @@ import re
 from dataclasses import dataclass
 from pathlib import Path
 
+_MODE_PATTERN = re.compile(r'[0-7]+')
+_NAME_PATTERN = re.compile(r'[a-zA-Z0-9_-]+')
+# Most entries share a few combinations of mode, uid and gid, so each combination is only validated once
+_VALID_FIELDS: set[tuple[str, str, str]] = set()
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class AclEntry:
-    path: Path
+    # Normalized absolute path, e.g. /home/user. Paths are kept as str, since acl.txt files can have
+    # hundreds of thousands of entries, and creating, hashing and sorting Path objects is slow
+    path: str
     mode: str
     uid: str
     gid: str
 
     def __post_init__(self) -> None:
-        if not self.path.is_absolute():
+        if not self.path.startswith('/'):
             raise ValueError(f"Invalid path: {self.path} - must be an absolute path starting with /")
-        if not re.match(r'^[0-7]+$', self.mode):
+        if (self.mode, self.uid, self.gid) in _VALID_FIELDS:
+            return
+        if not _MODE_PATTERN.fullmatch(self.mode):
             raise ValueError(f"Invalid mode: {self.mode} - must be octal digits only (0-7)")
 
-        if not re.match(r'^[a-zA-Z0-9_-]+$', self.uid):
+        if not _NAME_PATTERN.fullmatch(self.uid):
             raise ValueError(f"Invalid uid: {self.uid} - must be alphanumeric with optional hyphens/underscores")
 
-        if not re.match(r'^[a-zA-Z0-9_-]+$', self.gid):
+        if not _NAME_PATTERN.fullmatch(self.gid):
             raise ValueError(f"Invalid gid: {self.gid} - must be alphanumeric with optional hyphens/underscores")
+        _VALID_FIELDS.add((self.mode, self.uid, self.gid))
 
 
 @dataclass(frozen=True)
 class AclFile:
-    entries: dict[Path, AclEntry]
+    entries: dict[str, AclEntry]
 
     @classmethod
     def from_string(cls, content: str) -> "AclFile":
         entries = {}
         for line in content.splitlines():
-            line = line.strip()
-            if not line:
+            # The path can contain spaces, so the fields are split from the right
+            parts = line.rsplit(None, 3)
+            if not parts:
                 continue
-            parts = line.split()
             if len(parts) < 4:
-                raise ValueError(f"Invalid line in acl.txt: {line}")
-            gid = parts[-1].strip()
-            uid = parts[-2].strip()
-            mode = parts[-3].strip()
-            path = Path(" ".join(parts[:-3]).strip())
-            row = AclEntry(path, mode, uid, gid)
-            entries[path] = row
+                raise ValueError(f"Invalid line in acl.txt: {line.strip()}")
+            path, mode, uid, gid = parts
+            path = normalize_path(path.strip())
+            entries[path] = AclEntry(path, mode, uid, gid)
         return cls(entries)
 
     @classmethod
@@ -52,9 +59,22 @@ class AclFile:
         return cls.from_string(content)
 
     def write(self, path: Path) -> None:
-        rows = [
-            f"{entry.path} {entry.mode} {entry.uid} {entry.gid}\n"
-            for entry in sorted(self.entries.values(), key=lambda x: x.path)
-        ]
+        # The lines are written as they're formatted, instead of building the whole file in memory first
         with open(path, "w") as f:
-            f.writelines(rows)
+            f.writelines(
+                f"{entry.path} {entry.mode} {entry.uid} {entry.gid}\n"
+                for entry in (self.entries[key] for key in sorted(self.entries, key=_sort_key))
+            )
+
+
+def normalize_path(path: str) -> str:
+    """Normalizes the path the same way as pathlib, e.g. /home/user/ becomes /home/user"""
+    if '//' in path or '/./' in path or path.endswith(('/', '/.')):
+        return str(Path(path))
+    return path
+
+
+def _sort_key(path: str) -> str:
+    # Sorts the same way as Path objects, which compare the components of the paths.
+    # The separator sorts before every other character, e.g. /a/b sorts before /a-b
+    return path.replace('/', '\0')
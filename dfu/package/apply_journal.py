@@ -0,0 +1,35 @@
+from dataclasses import dataclass, field, replace
+
+from dfu.helpers.json_serializable import JsonSerializableMixin
+
+
+@dataclass(frozen=True)
+class JournalStep:
+    patch: str
+    interactive: bool
+
+
+@dataclass(frozen=True)
+class ApplyJournal(JsonSerializableMixin):
+    """Progress of an in-progress dfu apply, so that it can be resumed after a failure.
+    completed holds the commit of each step that was applied, in the same order as steps"""
+
+    reverse: bool
+    base_commit: str
+    root: str = "/"
+    sudo: bool = True
+    steps: tuple[JournalStep, ...] = field(default_factory=tuple)
+    completed: tuple[str, ...] = field(default_factory=tuple)
+
+    @property
+    def last_commit(self) -> str:
+        return self.completed[-1] if self.completed else self.base_commit
+
+    @property
+    def remaining_steps(self) -> tuple[JournalStep, ...]:
+        return self.steps[len(self.completed) :]
+
+    def complete_step(self, commit: str) -> 'ApplyJournal':
+        if len(self.completed) >= len(self.steps):
+            raise ValueError("All of the patches were already applied")
+        return replace(self, completed=self.completed + (commit,))
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+from dfu.config import LargeFiles
+
+POINTER_PREFIX = "dfu-object sha256:"
+_POINTER_REGEX = re.compile(r'^dfu-object sha256:(?P<digest>[0-9a-f]{64}) size (?P<size>[0-9]+)$')
+_CHUNK_SIZE = 1024 * 1024
+# Pointers are a single short line, so anything larger is never a pointer
+_MAX_POINTER_SIZE = 128
+# Git uses the same heuristic: A file is binary if there's a null byte in the first 8000 bytes
+_BINARY_CHECK_SIZE = 8000
+
+
+@dataclass(frozen=True)
+class ObjectPointer:
+    digest: str
+    size: int
+
+    def encode(self) -> str:
+        return f"{POINTER_PREFIX}{self.digest} size {self.size}\n"
+
+    @classmethod
+    def from_string(cls, content: str) -> "ObjectPointer | None":
+        match = _POINTER_REGEX.match(content.removesuffix("\n"))
+        if not match:
+            return None
+        return cls(digest=match.group('digest'), size=int(match.group('size')))
+
+    @classmethod
+    def from_file(cls, path: Path) -> "ObjectPointer | None":
+        if path.is_symlink() or not path.is_file() or path.stat().st_size > _MAX_POINTER_SIZE:
+            return None
+        try:
+            return cls.from_string(path.read_text())
+        except UnicodeDecodeError:
+            return None
+
+
+class ObjectStore:
+    """A content-addressed directory of large files, stored as objects/ab/cdef... (the sha256 of the content)"""
+
+    root: Path
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+
+    def object_path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:]
+
+    def contains(self, pointer: ObjectPointer) -> bool:
+        return self.object_path(pointer.digest).is_file()
+
+    def add(self, path: Path) -> ObjectPointer:
+        self.root.mkdir(mode=0o755, parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as src, NamedTemporaryFile(dir=self.root, prefix=".tmp_", delete=False) as tmp:
+            try:
+                while chunk := src.read(_CHUNK_SIZE):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        pointer = ObjectPointer(digest=digest.hexdigest(), size=size)
+        dest = self.object_path(pointer.digest)
+        if dest.exists():
+            os.unlink(tmp.name)
+        else:
+            dest.parent.mkdir(mode=0o755, exist_ok=True)
+            os.chmod(tmp.name, 0o644)
+            os.replace(tmp.name, dest)
+        return pointer
+
+    def restore(self, pointer: ObjectPointer, dest: Path) -> None:
+        """Streams the object into dest, verifying the content matches the pointer"""
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(self.object_path(pointer.digest), "rb") as src, open(dest, "wb") as f:
+                while chunk := src.read(_CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except FileNotFoundError:
+            raise ValueError(f"Object {pointer.digest} is missing from {self.root}")
+        if digest.hexdigest() != pointer.digest or size != pointer.size:
+            raise ValueError(f"Object {pointer.digest} in {self.root} is corrupt")
+
+
+def should_externalize(path: Path, large_files: LargeFiles) -> bool:
+    if path.is_symlink() or not path.is_file() or ObjectPointer.from_file(path) is not None:
+        return False
+    if path.stat().st_size > large_files.max_size:
+        return True
+    if not large_files.binary:
+        return False
+    with open(path, "rb") as f:
+        return b"\0" in f.read(_BINARY_CHECK_SIZE)
@@ -12,6 +12,7 @@ class UpdateArgs(TypedDict, total=False):
     snapshots: tuple[MappingProxyType[SnapperName, int], ...]
     programs_added: tuple[str, ...]
     programs_removed: tuple[str, ...]
+    program_versions: MappingProxyType[str, str]
     version: str
 
 
@@ -22,6 +23,8 @@ class PackageConfig(JsonSerializableMixin):
     snapshots: tuple[MappingProxyType[SnapperName, int], ...] = field(default_factory=tuple)
     programs_added: tuple[str, ...] = field(default_factory=tuple)
     programs_removed: tuple[str, ...] = field(default_factory=tuple)
+    # The version of each added program in the snapshot, so the same package archive can be installed offline
+    program_versions: MappingProxyType[str, str] = field(default_factory=lambda: MappingProxyType({}))
     version: str = "0.0.1"
 
     def update(self, **kwargs: Unpack[UpdateArgs]) -> 'PackageConfig':
@@ -1,9 +1,18 @@
+from pathlib import Path
+
 from dfu.api import DfuPlugin, State, Store
 from dfu.api.plugin import Event
+from dfu.helpers.atomic_write import write_atomic
 
 
 class AutosavePlugin(DfuPlugin):
+    events = ()
+    subscribes = True
+    # The content of each config file, as of the last time it was read or written
+    _saved: dict[Path, bytes | None]
+
     def __init__(self, store: Store) -> None:
+        self._saved = {}
         store.subscribe(self.on_change)
 
     def handle(self, event: Event) -> None:
@@ -11,7 +20,16 @@ class AutosavePlugin(DfuPlugin):
 
     def on_change(self, old_state: State, new_state: State) -> None:
         if old_state.package_config is not new_state.package_config or old_state.package_dir != new_state.package_dir:
-            new_state.package_config.write(new_state.package_dir / 'dfu_config.json')
+            path = new_state.package_dir / 'dfu_config.json'
+            data = new_state.package_config.encode()
+            if path not in self._saved:
+                try:
+                    self._saved[path] = path.read_bytes()
+                except FileNotFoundError:
+                    self._saved[path] = None
+            if self._saved[path] != data:
+                write_atomic(path, data)
+                self._saved[path] = data
 
 
 def entrypoint(store: Store) -> AutosavePlugin:
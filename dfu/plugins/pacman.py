@@ -1,4 +1,11 @@
+import os
+import shutil
 import subprocess
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import MappingProxyType
 
 import click
 
@@ -9,13 +16,20 @@ from dfu.api.plugin import (
     UninstallDependenciesEvent,
     UpdateInstalledDependenciesEvent,
 )
+from dfu.api.state import State
 from dfu.api.store import Store
-
-# TODO: Refactor this into an API, for non btrfs/snapper roots. Then move it to the API directory
-from dfu.snapshots.proot import proot
+from dfu.plugins.pacman_db import (
+    PACKAGE_CACHE_PATH,
+    InstalledPackage,
+    path_in_snapshot,
+    read_local_db,
+    snapshot_packages,
+)
 
 
 class PacmanPlugin(DfuPlugin):
+    events = (UpdateInstalledDependenciesEvent, InstallDependenciesEvent, UninstallDependenciesEvent)
+    concurrent = True
     store: Store
 
     def __init__(self, store: Store) -> None:
@@ -23,59 +37,146 @@ class PacmanPlugin(DfuPlugin):
 
     def handle(self, event: Event) -> None:
         if isinstance(event, UpdateInstalledDependenciesEvent):
-            self._update_installed_packages(event.from_index, event.to_index)
+            self._update_installed_packages(event.from_index, event.to_index, export_packages=event.export_packages)
         elif isinstance(event, InstallDependenciesEvent):
-            self._install_dependencies(confirm=event.confirm, dry_run=event.dry_run)
+            self._install_dependencies(
+                confirm=event.confirm,
+                dry_run=event.dry_run,
+                package_dirs=event.package_dirs or (self.store.state.package_dir,),
+            )
         elif isinstance(event, UninstallDependenciesEvent):
             self._uninstall_dependencies(confirm=event.confirm, dry_run=event.dry_run)
 
-    def _update_installed_packages(self, from_index: int, to_index: int) -> None:
-        old = self._get_installed_packages(from_index)
-        new = self._get_installed_packages(to_index)
-
-        added = list((new - old) | set(self.store.state.package_config.programs_added))
-        removed = list((old - new) | set(self.store.state.package_config.programs_removed))
-        added.sort()
-        removed.sort()
-
-        self.store.state = self.store.state.update(
-            package_config=self.store.state.package_config.update(
-                programs_added=tuple(added),
-                programs_removed=tuple(removed),
-            ),
-        )
-
-    def _get_installed_packages(self, snapshot_index: int) -> set[str]:
-        args = ['pacman', '-Qqe']
+    def _update_installed_packages(self, from_index: int, to_index: int, *, export_packages: bool) -> None:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            old_packages, new_packages = executor.map(self._get_installed_packages, (from_index, to_index))
+        # Equivalent to pacman -Qqe in the snapshot
+        old = {package.name for package in old_packages.values() if package.explicit}
+        new = {package.name for package in new_packages.values() if package.explicit}
+
+        def update(state: State) -> State:
+            package_config = state.package_config
+            added = sorted((new - old) | set(package_config.programs_added))
+            removed = sorted((old - new) | set(package_config.programs_removed))
+            # Programs that are no longer installed keep the version from the previous diff
+            versions = {
+                program: package_config.program_versions[program]
+                for program in added
+                if program in package_config.program_versions
+            }
+            versions.update({program: new_packages[program].version for program in added if program in new_packages})
+            return state.update(
+                package_config=package_config.update(
+                    programs_added=tuple(added),
+                    programs_removed=tuple(removed),
+                    program_versions=MappingProxyType(versions),
+                ),
+            )
+
+        # This can run in the background while dfu diff copies the files, so the state is updated afterwards
+        self.store.update(update)
+        if export_packages:
+            # The archives are only copied into the package once dfu diff finishes, so an aborted diff doesn't
+            # leave them behind
+            self.store.defer(
+                lambda: self._export_packages(
+                    to_index,
+                    [
+                        new_packages[program]
+                        for program in self.store.state.package_config.programs_added
+                        if program in new_packages
+                    ],
+                )
+            )
+
+    def _get_installed_packages(self, snapshot_index: int) -> Mapping[str, InstalledPackage]:
+        # Reads the snapshot's pacman database, without starting pacman under proot
         snapshot = self.store.state.package_config.snapshots[snapshot_index]
-        args = proot(args, config=self.store.state.config, snapshot=snapshot)
-
-        result = subprocess.run(args, capture_output=True, text=True, check=True)
-        packages = result.stdout.split('\n')
-        packages = [package.strip() for package in packages]
-        return set([package for package in packages if package])
+        return snapshot_packages(self.store.state.config, snapshot)
 
-    def _install_dependencies(self, *, confirm: bool, dry_run: bool) -> None:
-        to_remove = [p for p in self.store.state.package_config.programs_removed if _is_package_installed(p)]
+    def _export_packages(self, snapshot_index: int, packages: list[InstalledPackage]) -> None:
+        snapshot = self.store.state.package_config.snapshots[snapshot_index]
+        cache_dir = path_in_snapshot(self.store.state.config, snapshot, PACKAGE_CACHE_PATH)
+        cached_files = _list_directory(cache_dir)
+        archives: list[Path] = []
+        missing: list[str] = []
+        for package in packages:
+            # Includes the .sig file, so pacman can verify the archive
+            matches = [cache_dir / name for name in cached_files if name.startswith(package.archive_prefix)]
+            if matches:
+                archives.extend(matches)
+            else:
+                missing.append(package.name)
+
+        if archives:
+            dest = _packages_dir(self.store.state.package_dir)
+            dest.mkdir(mode=0o755, exist_ok=True)
+            _copy_archives(archives, dest)
+            click.echo(f"Exported {len(archives)} package files to {dest}", err=True)
+        if missing:
+            click.echo(
+                f"These programs are not in the pacman cache, so they'll be downloaded: {', '.join(missing)}", err=True
+            )
+
+    def _local_archives(self, programs: tuple[str, ...], package_dirs: tuple[Path, ...]) -> dict[str, Path]:
+        """Returns the exported archive of each program, if it has the version that was recorded by dfu diff.
+        Later packages take precedence, the same way as their recorded versions do"""
+        archives: dict[str, Path] = {}
+        for package_dir in reversed(package_dirs):
+            packages_dir = _packages_dir(package_dir)
+            if not packages_dir.is_dir():
+                continue
+            files = sorted(os.listdir(packages_dir))
+            for program in programs:
+                version = self.store.state.package_config.program_versions.get(program)
+                if version is None or program in archives:
+                    continue
+                prefix = f"{program}-{version}-"
+                for name in files:
+                    arch, _, extension = name.removeprefix(prefix).partition('.pkg.tar')
+                    # The architecture can't contain a dash, otherwise it's a different program
+                    if name.startswith(prefix) and '-' not in arch and not extension.endswith('.sig'):
+                        archives[program] = packages_dir / name
+                        break
+        return {program: archives[program] for program in programs if program in archives}
+
+    def _install_dependencies(self, *, confirm: bool, dry_run: bool, package_dirs: tuple[Path, ...]) -> None:
+        to_remove = _installed_packages(self.store.state.package_config.programs_removed)
         _uninstall(to_remove, confirm=confirm, dry_run=dry_run)
-        _install(self.store.state.package_config.programs_added, confirm=confirm, dry_run=dry_run)
+        programs_added = self.store.state.package_config.programs_added
+        _install(
+            programs_added,
+            archives=self._local_archives(programs_added, package_dirs),
+            confirm=confirm,
+            dry_run=dry_run,
+        )
 
     def _uninstall_dependencies(self, *, confirm: bool, dry_run: bool) -> None:
-        to_remove = [p for p in self.store.state.package_config.programs_added if _is_package_installed(p)]
+        to_remove = _installed_packages(self.store.state.package_config.programs_added)
         _uninstall(to_remove, confirm=confirm, dry_run=dry_run)
         _install(self.store.state.package_config.programs_removed, confirm=confirm, dry_run=dry_run)
 
 
-def _install(packages: list[str] | tuple[str, ...], *, confirm: bool, dry_run: bool) -> None:
+def _install(
+    packages: list[str] | tuple[str, ...], *, archives: Mapping[str, Path] = {}, confirm: bool, dry_run: bool
+) -> None:
     if not packages:
         return
     click.echo(f"Installing dependencies: {', '.join(packages)}", err=True)
+    if archives:
+        click.echo(f"Installing {len(archives)} of them from the package, without downloading them", err=True)
     if not confirm or click.confirm("Would you like to continue?"):
-        args = ['sudo', 'pacman', '-S', '--needed', '--noconfirm', *packages]
+        commands: list[list[str]] = []
+        if archives:
+            commands.append(['sudo', 'pacman', '-U', '--needed', '--noconfirm', *(str(a) for a in archives.values())])
+        remote_packages = [package for package in packages if package not in archives]
+        if remote_packages:
+            commands.append(['sudo', 'pacman', '-S', '--needed', '--noconfirm', *remote_packages])
         if dry_run:
             click.echo("Dry run: Skipping installation", err=True)
         else:
-            subprocess.run(args, check=True)
+            for args in commands:
+                subprocess.run(args, check=True)
 
 
 def _uninstall(packages: list[str], *, confirm: bool, dry_run: bool) -> None:
@@ -91,9 +192,59 @@ def _uninstall(packages: list[str], *, confirm: bool, dry_run: bool) -> None:
             subprocess.run(args, check=True)
 
 
-def _is_package_installed(package: str) -> bool:
-    result = subprocess.run(['pacman', '-Q', package], capture_output=True, text=True)
-    return result.returncode == 0
+def _installed_packages(packages: tuple[str, ...]) -> list[str]:
+    """Returns the packages which are installed, by reading the local database once instead of running pacman -Q
+    for each package"""
+    if not packages:
+        return []
+    start = time.perf_counter()
+    installed = read_local_db()
+    result = [package for package in packages if package in installed]
+    click.echo(
+        f"Checked {len(packages)} packages in {time.perf_counter() - start:.2f}s, {len(result)} are installed", err=True
+    )
+    return result
+
+
+def _packages_dir(package_dir: Path) -> Path:
+    return package_dir / 'packages'
+
+
+def _list_directory(path: Path) -> list[str]:
+    try:
+        return os.listdir(path)
+    except PermissionError:
+        # Snapshots are usually only readable by root
+        result = subprocess.run(
+            ['sudo', 'find', str(path), '-mindepth', '1', '-maxdepth', '1', '-printf', '%f\\0'],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return [name for name in result.stdout.split('\0') if name]
+
+
+def _copy_archives(archives: list[Path], dest: Path) -> None:
+    try:
+        for archive in archives:
+            shutil.copyfile(archive, dest / archive.name)
+    except PermissionError:
+        # Copy the archives with a single sudo call, keeping them owned by the current user
+        subprocess.run(
+            [
+                'sudo',
+                'install',
+                '--mode=644',
+                f'--owner={os.getuid()}',
+                f'--group={os.getgid()}',
+                f'--target-directory={dest}',
+                '--',
+                *(str(archive) for archive in archives),
+            ],
+            check=True,
+            text=True,
+            capture_output=True,
+        )
 
 
 def entrypoint(store: Store) -> PacmanPlugin:
@@ -0,0 +1,151 @@
+import os
+import subprocess
+from collections.abc import Mapping
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
+from typing import NamedTuple
+
+from dfu.config import Config
+from dfu.snapshots.environment import load_environment
+from dfu.snapshots.snapper import Snapper, SnapperName, snapshot_identity, snapshot_path
+
+LOCAL_DB_PATH = Path('/var/lib/pacman/local')
+PACKAGE_CACHE_PATH = Path('/var/cache/pacman/pkg')
+
+
+@dataclass(frozen=True)
+class InstalledPackage:
+    name: str
+    version: str
+    # False if the package was only installed as a dependency of another package
+    explicit: bool
+    arch: str = ''
+
+    @property
+    def archive_prefix(self) -> str:
+        # Package archives are named <name>-<version>-<arch>.pkg.tar.<compression>
+        return f"{self.name}-{self.version}-{self.arch}.pkg.tar"
+
+
+def read_local_db(db_dir: Path = LOCAL_DB_PATH) -> dict[str, InstalledPackage]:
+    """Reads the installed packages from pacman's local database, i.e. the desc file of each package"""
+    packages: dict[str, InstalledPackage] = {}
+    try:
+        entries = list(os.scandir(db_dir))
+    except PermissionError:
+        return _read_local_db_privileged(db_dir)
+    for entry in entries:
+        if not entry.is_dir():
+            # e.g. ALPM_DB_VERSION
+            continue
+        try:
+            with open(os.path.join(entry.path, 'desc')) as f:
+                package = parse_desc(f.read())
+        except FileNotFoundError:
+            continue
+        except PermissionError:
+            return _read_local_db_privileged(db_dir)
+        if package is not None:
+            packages[package.name] = package
+    return packages
+
+
+def parse_desc(content: str) -> InstalledPackage | None:
+    """Parses the %NAME%, %VERSION%, %ARCH% and %REASON% sections of a desc file.
+    A package without a %REASON% section was installed explicitly"""
+    fields: dict[str, str] = {}
+    section: str | None = None
+    for line in content.splitlines():
+        if len(line) > 2 and line[0] == '%' and line[-1] == '%':
+            section = line
+        elif line and section is not None and section not in fields:
+            fields[section] = line
+    if '%NAME%' not in fields:
+        return None
+    return InstalledPackage(
+        name=fields['%NAME%'],
+        version=fields.get('%VERSION%', ''),
+        explicit=fields.get('%REASON%', '0') == '0',
+        arch=fields.get('%ARCH%', ''),
+    )
+
+
+def snapshot_packages(config: Config, snapshot: Mapping[SnapperName, int]) -> Mapping[str, InstalledPackage]:
+    """Returns the packages that were installed in the snapshot. The snapshots are mounted in the same order
+    as proot does, and since snapshots never change, the result is cached by snapshot"""
+    mounts = _mount_order(config, snapshot)
+    return _snapshot_packages(mounts, snapshot_identity([mount.snapshot_path.parent for mount in mounts]))
+
+
+def path_in_snapshot(config: Config, snapshot: Mapping[SnapperName, int], path: Path) -> Path:
+    """Returns where the absolute path is inside of the snapshot"""
+    return _path_in_snapshot(_mount_order(config, snapshot), path)
+
+
+class _Mount(NamedTuple):
+    snapper_name: SnapperName
+    snapshot_id: int
+    mountpoint: Path
+
+    @property
+    def snapshot_path(self) -> Path:
+        return snapshot_path(self.mountpoint, self.snapshot_id)
+
+
+def _mount_order(config: Config, snapshot: Mapping[SnapperName, int]) -> tuple[_Mount, ...]:
+    mount_order = tuple(name for name in config.btrfs.snapper_configs if name in snapshot)
+    if len(mount_order) == 0:
+        raise ValueError('No snapshots to mount')
+    # The cached environment only needs sudo when a snapper config or a mount changed, unlike snapper get-config
+    mountpoints = load_environment().mountpoints
+    return tuple(
+        _Mount(
+            snapper_name=name,
+            snapshot_id=snapshot[name],
+            mountpoint=Path(mountpoints[name]) if name in mountpoints else Snapper(name).get_mountpoint(),
+        )
+        for name in mount_order
+    )
+
+
+@lru_cache(maxsize=32)
+def _snapshot_packages(mounts: tuple[_Mount, ...], identity: tuple[str, ...]) -> Mapping[str, InstalledPackage]:
+    # identity is only part of the cache key
+    return MappingProxyType(read_local_db(_path_in_snapshot(mounts, LOCAL_DB_PATH)))
+
+
+def _path_in_snapshot(mounts: tuple[_Mount, ...], path: Path) -> Path:
+    # The path is in the snapshot of the deepest config which is mounted above it, or in the root snapshot
+    root_mount, *other_mounts = mounts
+    result = root_mount.snapshot_path / path.relative_to('/')
+    deepest_mountpoint = Path('/')
+    for mount in other_mounts:
+        if path.is_relative_to(mount.mountpoint) and mount.mountpoint.is_relative_to(deepest_mountpoint):
+            deepest_mountpoint = mount.mountpoint
+            result = mount.snapshot_path / path.relative_to(mount.mountpoint)
+    return result
+
+
+def _read_local_db_privileged(db_dir: Path) -> dict[str, InstalledPackage]:
+    # Snapshots are usually only readable by root. Read every desc file with a single sudo call instead
+    # grep prints each line as <path>\0<line>, so the files can be put back together
+    result = subprocess.run(
+        ['sudo', 'grep', '--recursive', '--null', '--include=desc', '', '--', str(db_dir)],
+        capture_output=True,
+        text=True,
+    )
+    # grep exits with 1 if there are no packages
+    if result.returncode > 1:
+        raise ValueError(f"Could not read the pacman database in {db_dir}: {result.stderr.strip()}")
+    contents: dict[str, list[str]] = {}
+    for record in result.stdout.splitlines():
+        path, _, line = record.partition('\0')
+        contents.setdefault(path, []).append(line)
+    packages: dict[str, InstalledPackage] = {}
+    for lines in contents.values():
+        package = parse_desc('\n'.join(lines))
+        if package is not None:
+            packages[package.name] = package
+    return packages
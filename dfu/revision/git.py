@@ -1,7 +1,9 @@
 import os
 import re
+import shutil
 import subprocess
 from pathlib import Path
+from tempfile import NamedTemporaryFile
 from typing import Iterable
 
 from platformdirs import PlatformDirs
@@ -20,6 +22,20 @@ def git_commit(git_dir: Path, message: str) -> None:
     subprocess.run(['git', 'commit', '-m', message], cwd=git_dir, check=True, capture_output=True)
 
 
+def git_rev_parse(git_dir: Path, revision: str) -> str:
+    return subprocess.run(
+        ['git', 'rev-parse', '--verify', revision], cwd=git_dir, text=True, capture_output=True, check=True
+    ).stdout.strip()
+
+
+def git_reset_hard(git_dir: Path, revision: str, *, sudo: bool = False) -> None:
+    """Discards every change since the revision, including untracked files.
+    With sudo, files which were chowned to other users can be discarded too"""
+    sudo_args = ['sudo'] if sudo else []
+    subprocess.run([*sudo_args, 'git', 'reset', '--hard', revision], cwd=git_dir, check=True, capture_output=True)
+    subprocess.run([*sudo_args, 'git', 'clean', '-fd'], cwd=git_dir, check=True, capture_output=True)
+
+
 def git_num_commits(git_dir: Path) -> int:
     try:
         return int(
@@ -65,8 +81,70 @@ def git_ls_files(cwd: Path) -> list[str]:
     return tracked_files.stdout.splitlines() + untracked_files.stdout.splitlines()
 
 
+def git_grep_staged(git_dir: Path, pattern: str, paths: list[str]) -> list[tuple[str, str]]:
+    """Searches the staged (not working tree) contents of the text files for a fixed string.
+    Returns a list of (path, line) tuples for every matching line"""
+    cmd = ['git', 'grep', '--cached', '-z', '-I', '--fixed-strings', '-e', pattern, '--', *paths]
+    result = subprocess.run(cmd, cwd=git_dir, text=True, capture_output=True)
+    if result.returncode not in (0, 1):
+        # A return code of 1 means that nothing matched
+        raise subprocess.CalledProcessError(result.returncode, cmd, output=result.stdout, stderr=result.stderr)
+    matches: list[tuple[str, str]] = []
+    for line in result.stdout.splitlines():
+        path, _, content = line.partition('\0')
+        matches.append((path, content))
+    return matches
+
+
+def git_show_staged(git_dir: Path, paths: list[str]) -> dict[str, bytes]:
+    """Returns the staged contents of the given paths, using a single git cat-file process"""
+    if not paths:
+        return {}
+    result = subprocess.run(
+        ['git', 'cat-file', '--batch'],
+        cwd=git_dir,
+        input="".join(f":{path}\n" for path in paths).encode(),
+        capture_output=True,
+        check=True,
+    )
+    contents: dict[str, bytes] = {}
+    output = result.stdout
+    offset = 0
+    for path in paths:
+        header_end = output.index(b'\n', offset)
+        header = output[offset:header_end].split(b' ')
+        offset = header_end + 1
+        if header[-1] == b'missing':
+            continue
+        size = int(header[2])
+        contents[path] = output[offset : offset + size]
+        offset += size + 1
+    return contents
+
+
+def git_changed_files(git_dir: Path, base: str) -> list[str]:
+    """Returns the paths which differ between the base commit and the working tree, including untracked files"""
+    changed = subprocess.run(
+        ['git', 'diff', '--name-only', '-z', base], cwd=git_dir, text=True, capture_output=True, check=True
+    )
+    untracked = subprocess.run(
+        ['git', 'ls-files', '--others', '--exclude-standard', '-z'],
+        cwd=git_dir,
+        text=True,
+        capture_output=True,
+        check=True,
+    )
+    return [p for p in changed.stdout.split('\0') + untracked.stdout.split('\0') if p]
+
+
+def git_show(git_dir: Path, revision: str, path: str) -> str:
+    return subprocess.run(
+        ['git', 'show', f'{revision}:{path}'], cwd=git_dir, text=True, capture_output=True, check=True
+    ).stdout
+
+
 def git_diff(git_dir: Path, base: str, target: str) -> str:
-    args = ['git', 'diff', '--patch', f'{base}..{target}']
+    args = ['git', 'diff', '--patch', '--binary', f'{base}..{target}']
     return subprocess.run(
         args,
         cwd=git_dir,
@@ -121,6 +199,73 @@ def git_apply(
         raise e
 
 
+def git_apply_check(
+    git_dir: Path,
+    patch: Path,
+    reverse: bool = False,
+    exclude: list[str] | None = None,
+) -> str | None:
+    """Checks whether the patch applies cleanly to the index with a 3-way merge, the same way as git_apply,
+    without modifying the index or the working tree. Returns None if it does, otherwise the errors reported by git"""
+    # git apply --check doesn't report 3-way merge conflicts, so the patch is applied to a copy of the index instead
+    with NamedTemporaryFile(dir=git_dir / '.git', prefix='dfu_check_index_') as index:
+        shutil.copyfile(git_dir / '.git' / 'index', index.name)
+        args: list[str] = ['git', 'apply', '--3way', '--cached']
+        if reverse:
+            args.append('--reverse')
+        for file_path in exclude or []:
+            args.append(f'--exclude={file_path}')
+        args.append(str(patch.resolve()))
+        env = os.environ.copy()
+        env["LC_ALL"] = "C"
+        env["GIT_INDEX_FILE"] = index.name
+        result = subprocess.run(args, cwd=git_dir, text=True, capture_output=True, env=env)
+    if result.returncode == 0:
+        return None
+    return result.stderr
+
+
+def git_enable_rerere(git_dir: Path, cache_dir: Path) -> None:
+    """Enables git rerere, storing the recorded conflict resolutions in cache_dir, so that they are reused
+    by every repository that points to the same cache_dir"""
+    cache_dir.mkdir(parents=True, exist_ok=True, mode=0o755)
+    rr_cache = git_dir / '.git' / 'rr-cache'
+    if not rr_cache.is_symlink() and not rr_cache.exists():
+        rr_cache.symlink_to(cache_dir.resolve(), target_is_directory=True)
+    subprocess.run(['git', 'config', 'rerere.enabled', 'true'], cwd=git_dir, check=True, capture_output=True)
+
+
+def git_rerere(git_dir: Path) -> None:
+    """Records the resolutions of conflicts that were resolved in the working tree"""
+    subprocess.run(['git', 'rerere'], cwd=git_dir, check=True, capture_output=True)
+
+
+def git_rerere_remaining(git_dir: Path) -> list[str]:
+    """Returns the conflicted paths that weren't automatically resolved using a recorded resolution"""
+    return subprocess.run(
+        ['git', 'rerere', 'remaining'], cwd=git_dir, text=True, capture_output=True, check=True
+    ).stdout.splitlines()
+
+
+def git_cherry_pick(git_dir: Path, commit: str, reverse: bool = False) -> bool:
+    """Merges the changes made by the commit (or reverts them) into the index and working tree, without committing.
+    This is a tree-level merge (merge-ort) using the commit's parent as the merge base.
+    Returns False if there were merge conflicts"""
+    args = ['git', 'revert' if reverse else 'cherry-pick', '--no-commit', commit]
+    env = os.environ.copy()
+    env["LC_ALL"] = "C"
+    try:
+        subprocess.run(args, cwd=git_dir, check=True, text=True, capture_output=True, env=env)
+        return True
+    except subprocess.CalledProcessError as e:
+        unmerged = subprocess.run(
+            ['git', 'ls-files', '--unmerged'], cwd=git_dir, check=True, text=True, capture_output=True
+        ).stdout
+        if e.returncode == 1 and unmerged:
+            return False
+        raise e
+
+
 def git_stash(git_dir: Path) -> None:
     subprocess.run(['git', 'stash', 'save'], cwd=git_dir, check=True, capture_output=True)
 
@@ -139,6 +284,59 @@ def git_fetch(git_dir: Path, remote: str) -> subprocess.CompletedProcess[str]:
     return subprocess.run(['git', 'fetch', remote], cwd=git_dir, text=True, check=True, capture_output=True)
 
 
+def git_fetch_head(git_dir: Path, remote: str) -> str:
+    """Fetches the HEAD of the remote (e.g. a bundle) without creating any refs, and returns its commit"""
+    subprocess.run(['git', 'fetch', '--quiet', remote, 'HEAD'], cwd=git_dir, text=True, check=True, capture_output=True)
+    return git_rev_parse(git_dir, 'FETCH_HEAD')
+
+
+def git_diff_name_status(git_dir: Path, base: str, target: str) -> list[tuple[str, str]]:
+    """Returns the (status, path) of every file that differs between the commits, e.g. ('M', 'file.txt')"""
+    result = subprocess.run(
+        ['git', 'diff', '--name-status', '--no-renames', '-z', base, target],
+        cwd=git_dir,
+        text=True,
+        check=True,
+        capture_output=True,
+    )
+    fields = result.stdout.split('\0')
+    return [(status, path) for status, path in zip(fields[0::2], fields[1::2]) if status]
+
+
+def git_checkout_paths(git_dir: Path, revision: str, paths: list[str]) -> None:
+    """Writes the paths from the revision into the working tree and the index"""
+    if not paths:
+        return
+    # Important: Paths are separated by the null character, since it can't appear in a filename
+    subprocess.run(
+        ['git', '--literal-pathspecs', 'checkout', revision, '--pathspec-from-file=-', '--pathspec-file-nul'],
+        cwd=git_dir,
+        input='\0'.join(paths) + '\0',
+        text=True,
+        check=True,
+        capture_output=True,
+    )
+
+
+def git_rm(git_dir: Path, paths: list[str]) -> None:
+    if not paths:
+        return
+    subprocess.run(
+        ['git', '--literal-pathspecs', 'rm', '--quiet', '--force', '--pathspec-from-file=-', '--pathspec-file-nul'],
+        cwd=git_dir,
+        input='\0'.join(paths) + '\0',
+        text=True,
+        check=True,
+        capture_output=True,
+    )
+
+
+def git_write_tree(git_dir: Path) -> str:
+    """Stages every change in the working tree, and returns the id of the resulting tree"""
+    subprocess.run(['git', 'add', '--all', '--force'], cwd=git_dir, check=True, capture_output=True)
+    return subprocess.run(['git', 'write-tree'], cwd=git_dir, text=True, check=True, capture_output=True).stdout.strip()
+
+
 def git_add_remote(git_dir: Path, name: str, remote: str) -> subprocess.CompletedProcess[str]:
     return subprocess.run(
         ['git', 'remote', 'add', name, remote], cwd=git_dir, text=True, check=True, capture_output=True
@@ -1,7 +1,7 @@
 import os
 import subprocess
 import sys
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from types import MappingProxyType
 
@@ -10,13 +10,28 @@ from dfu.package.acl_file import AclEntry, AclFile
 from dfu.revision.git import git_check_ignore
 from dfu.snapshots.proot import proot
 from dfu.snapshots.snapper import Snapper, SnapperName
-from dfu.snapshots.snapper_diff import FileChangeAction
+from dfu.snapshots.snapper_diff import FileChangeAction, SnapperDiff
 
 
 @dataclass
 class FilesModified:
     pre_files: set[str]
     post_files: set[str]
+    # Files whose content is unchanged, but whose mode, owner, or group changed
+    # Only their acl.txt entries need to be recorded, without copying any content
+    permission_files: set[str] = field(default_factory=set)
+    # Directories which were entirely deleted (pre) or created (post). Their files are still listed in
+    # pre_files and post_files, but they can be copied and stat'd as a single recursive operation
+    pre_subtrees: set[str] = field(default_factory=set)
+    post_subtrees: set[str] = field(default_factory=set)
+
+
+@dataclass(frozen=True)
+class SubtreeEntry:
+    file_type: str
+    mode: str
+    uid: str
+    gid: str
 
 
 def files_modified(
@@ -29,7 +44,7 @@ def files_modified(
     for snapper_name, pre_id in pre_snapshot.items():
         post_id = post_snapshot[snapper_name]
         snapper = Snapper(snapper_name)
-        deltas = snapper.get_delta(pre_id, post_id)
+        all_deltas = deltas = snapper.get_delta(pre_id, post_id)
 
         ignored_files: set[str] = set(
             git_check_ignore(
@@ -43,27 +58,134 @@ def files_modified(
         else:
             deltas = [d for d in deltas if d.path not in ignored_files]
 
+        pre_subtrees: dict[str, SubtreeEntry] = {}
+        post_subtrees: dict[str, SubtreeEntry] = {}
+        pre_roots: set[str] = set()
+        post_roots: set[str] = set()
+        if not only_ignored:
+            pre_roots, pre_subtrees = _coalesce_subtrees(
+                snapper, pre_id, deltas=all_deltas, ignored_files=ignored_files, action=FileChangeAction.deleted
+            )
+            post_roots, post_subtrees = _coalesce_subtrees(
+                snapper, post_id, deltas=all_deltas, ignored_files=ignored_files, action=FileChangeAction.created
+            )
+
         pre_files_to_check = set(
             [
                 delta.path
                 for delta in deltas
                 if delta.action not in (FileChangeAction.created, FileChangeAction.no_change)
+                and delta.path not in pre_subtrees
             ]
         )
-        pre_files = filter_files(store, pre_snapshot, pre_files_to_check)
+        pre_files = filter_files(store, pre_snapshot, pre_files_to_check) | _subtree_files(pre_subtrees)
 
         post_files_to_check = set(
             [
                 delta.path
                 for delta in deltas
                 if delta.action not in (FileChangeAction.deleted, FileChangeAction.no_change)
+                and delta.path not in post_subtrees
             ]
         )
-        post_files = filter_files(store, post_snapshot, post_files_to_check)
-        files_modified[snapper_name] = FilesModified(pre_files=pre_files, post_files=post_files)
+        post_files = filter_files(store, post_snapshot, post_files_to_check) | _subtree_files(post_subtrees)
+
+        permission_files_to_check = set(
+            [delta.path for delta in deltas if delta.action == FileChangeAction.no_change and delta.permissions_changed]
+        )
+        permission_files = filter_files(store, post_snapshot, permission_files_to_check)
+        files_modified[snapper_name] = FilesModified(
+            pre_files=pre_files,
+            post_files=post_files,
+            permission_files=permission_files,
+            pre_subtrees=pre_roots,
+            post_subtrees=post_roots,
+        )
     return files_modified
 
 
+def _coalesce_subtrees(
+    snapper: Snapper,
+    snapshot_id: int,
+    *,
+    deltas: list[SnapperDiff],
+    ignored_files: set[str],
+    action: FileChangeAction,
+) -> tuple[set[str], dict[str, SubtreeEntry]]:
+    """Folds directories whose every entry was created (or deleted) into a single subtree.
+    Returns the subtree roots, and the contents of those subtrees, listed with a single find call.
+    A subtree is only used if the result is identical to handling each file individually.
+    """
+    roots = find_subtree_roots(deltas, ignored_files=ignored_files, action=action)
+    if not roots:
+        return set(), {}
+    matching = {delta.path for delta in deltas if delta.action == action and delta.path not in ignored_files}
+    listing = list_subtrees(snapper, snapshot_id, roots)
+    contents: dict[str, dict[str, SubtreeEntry]] = {root: {} for root in roots}
+    for path, entry in listing.items():
+        root = next((str(p) for p in (Path(path), *Path(path).parents) if str(p) in contents), None)
+        if root is not None:
+            contents[root][path] = entry
+
+    valid_roots: set[str] = set()
+    subtrees: dict[str, SubtreeEntry] = {}
+    for root, entries in contents.items():
+        # Snapper may filter out some paths (e.g. /etc/snapper/filters), and special files are never copied.
+        # Fall back to handling each file individually, so the patch stays identical
+        if any(path not in matching or entry.file_type not in ("f", "l", "d") for path, entry in entries.items()):
+            continue
+        valid_roots.add(root)
+        subtrees.update(entries)
+    return valid_roots, subtrees
+
+
+def _subtree_files(subtrees: dict[str, SubtreeEntry]) -> set[str]:
+    return {path for path, entry in subtrees.items() if entry.file_type in ("f", "l")}
+
+
+def find_subtree_roots(deltas: list[SnapperDiff], *, ignored_files: set[str], action: FileChangeAction) -> set[str]:
+    """Returns the top-most directories where the directory and every entry underneath it have the given action"""
+    matching = {delta.path for delta in deltas if delta.action == action and delta.path not in ignored_files}
+    has_children: set[str] = set()
+    blocked: set[str] = set()
+    for delta in deltas:
+        for parent in Path(delta.path).parents:
+            parent_path = str(parent)
+            has_children.add(parent_path)
+            if delta.path not in matching:
+                blocked.add(parent_path)
+    candidates = {path for path in matching if path in has_children and path not in blocked}
+    return {path for path in candidates if not any(str(parent) in candidates for parent in Path(path).parents)}
+
+
+def list_subtrees(snapper: Snapper, snapshot_id: int, roots: set[str]) -> dict[str, SubtreeEntry]:
+    """Returns the type and permissions of every entry (including the roots) underneath the given directories"""
+    if not roots:
+        return {}
+    mountpoint = snapper.get_mountpoint()
+    snapshot_dir = str(snapper.get_snapshot_path(snapshot_id))
+    sources = [os.path.join(snapshot_dir, Path(root).relative_to(mountpoint)) for root in sorted(roots)]
+    # Important: Separate each entry with the null character, since it can't appear in a filename
+    result = subprocess.run(
+        ["sudo", "find", *sources, "-printf", "%y %m %u %g %p\\0"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries: dict[str, SubtreeEntry] = {}
+    for record in result.stdout.split("\0"):
+        if not record:
+            continue
+        file_type, mode, uid, gid, path = record.split(" ", 4)
+        dest = os.path.abspath(mountpoint / Path(path).relative_to(snapshot_dir))
+        entries[dest] = SubtreeEntry(file_type=file_type, mode=mode, uid=uid, gid=gid)
+    return entries
+
+
+def in_subtrees(path: str | Path, subtrees: set[str]) -> bool:
+    return any(str(parent) in subtrees for parent in Path(path).parents)
+
+
 def filter_files(store: Store, snapshot: MappingProxyType[SnapperName, int], paths: set[str]) -> set[str]:
     if len(paths) == 0:
         # Performance optimization: Suprocess.run() takes several hundred milliseconds.
@@ -88,28 +210,47 @@ done
     return set(p for p in result.stdout.splitlines())
 
 
-def get_permissions(store: Store, *, files_modified: dict[SnapperName, set[str]], snapshot_index: int) -> AclFile:
+def get_permissions(
+    store: Store,
+    *,
+    files_modified: dict[SnapperName, set[str]],
+    snapshot_index: int,
+    subtrees: dict[SnapperName, set[str]] | None = None,
+) -> AclFile:
     """Returns an AclFile containing permission metadata for the files and folders in a given snapshot
     Each entry contains a path, mode, uid, and gid.
+    Files underneath one of the subtrees are listed with a single find call, instead of calling stat on each file.
     For example, given a Snapper snapshot mounted at /home with a file /home/user/file.txt
     this might return an AclFile with entries like:
     [
-        AclEntry(Path("/home/user/"), "755", "user", "user"),
-        AclEntry(Path("/home/user/file.txt"), "644", "user", "user"),
+        AclEntry("/home/user", "755", "user", "user"),
+        AclEntry("/home/user/file.txt", "644", "user", "user"),
     ]
     """
-    entries: dict[Path, AclEntry] = {}
+    entries: dict[str, AclEntry] = {}
     snapshot = store.state.package_config.snapshots[snapshot_index]
     for snapper_name, paths in files_modified.items():
-        paths = filter_files(store, snapshot, paths)
+        roots = (subtrees or {}).get(snapper_name, set())
+        subtree_paths = {path for path in paths if in_subtrees(path, roots)}
+        paths = filter_files(store, snapshot, paths - subtree_paths)
         snapper = Snapper(snapper_name)
         mountpoint = snapper.get_mountpoint()
         snapshot_dir = snapper.get_snapshot_path(snapshot[snapper_name])
         sub_path_directories: set[Path] = set()
+        listing = list_subtrees(snapper, snapshot[snapper_name], roots)
+        for path in subtree_paths:
+            listed = listing.get(os.path.abspath(path))
+            if listed is None or listed.file_type not in ("f", "l"):
+                continue
+            sub_path = Path(path).relative_to(mountpoint)
+            dest = os.path.abspath(str(mountpoint / sub_path))
+            sub_path_directories.update(sub_path.parents)
+            entries[dest] = AclEntry(dest, listed.mode, listed.uid, listed.gid)
+
         for path in paths:
             sub_path = Path(path).relative_to(mountpoint)
             src = snapshot_dir / sub_path
-            dest = Path(os.path.abspath(str(mountpoint / sub_path)))
+            dest = os.path.abspath(str(mountpoint / sub_path))
             stats = subprocess.run(
                 ["sudo", "stat", "-c", "%F#%a#%U#%G", str(src)],
                 capture_output=True,
@@ -136,7 +277,10 @@ def get_permissions(store: Store, *, files_modified: dict[SnapperName, set[str]]
                 continue
         sub_path_directories.discard(Path("."))
         for sub_path in sub_path_directories:
-            dest = mountpoint / sub_path
+            dest = str(mountpoint / sub_path)
+            if (listed := listing.get(dest)) is not None:
+                entries[dest] = AclEntry(dest, listed.mode, listed.uid, listed.gid)
+                continue
             dir_src = os.path.abspath(snapshot_dir / sub_path)
             stats = subprocess.run(
                 ["sudo", "stat", "-c", "%a#%U#%G", dir_src],
@@ -0,0 +1,201 @@
+import hashlib
+import mmap
+import os
+import stat
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+from dfu.api import Store
+from dfu.snapshots.changes import FilesModified
+from dfu.snapshots.snapper import Snapper, SnapperName
+
+
+@dataclass(frozen=True)
+class FileInfo:
+    mode: int
+    uid: int
+    gid: int
+    size: int
+
+
+@dataclass(frozen=True)
+class IdenticalPair:
+    size: int
+    permissions_changed: bool
+
+
+@dataclass
+class DedupeStats:
+    files: int = 0
+    bytes: int = 0
+
+
+def remove_identical_files(
+    store: Store, *, from_index: int, to_index: int, sources: dict[SnapperName, FilesModified]
+) -> tuple[dict[SnapperName, FilesModified], DedupeStats]:
+    """Drops files which snapper reports as changed, but whose content is identical
+    in both snapshots (e.g. files that were only touched, or rewritten with the same bytes).
+    If only the mode, owner, or group changed, the file is moved to permission_files instead.
+    Returns the remaining files, and how many files (and bytes) no longer need to be copied
+    """
+    pre_snapshot = store.state.package_config.snapshots[from_index]
+    post_snapshot = store.state.package_config.snapshots[to_index]
+    stats = DedupeStats()
+    result: dict[SnapperName, FilesModified] = {}
+    for snapper_name, files in sources.items():
+        candidates = files.pre_files & files.post_files
+        if not candidates:
+            result[snapper_name] = files
+            continue
+        snapper = Snapper(snapper_name)
+        mountpoint = snapper.get_mountpoint()
+        pre_dir = snapper.get_snapshot_path(pre_snapshot[snapper_name])
+        post_dir = snapper.get_snapshot_path(post_snapshot[snapper_name])
+        pairs: dict[str, tuple[Path, Path]] = {}
+        for file in candidates:
+            sub_path = Path(file).relative_to(mountpoint)
+            pairs[file] = (pre_dir / sub_path, post_dir / sub_path)
+
+        identical = find_identical_pairs(list(pairs.values()))
+        identical_files: set[str] = set()
+        permission_files: set[str] = set()
+        for file, pair in pairs.items():
+            if pair in identical:
+                identical_files.add(file)
+                if identical[pair].permissions_changed:
+                    permission_files.add(file)
+                stats.files += 1
+                stats.bytes += 2 * identical[pair].size
+
+        result[snapper_name] = replace(
+            files,
+            pre_files=files.pre_files - identical_files,
+            post_files=files.post_files - identical_files,
+            permission_files=files.permission_files | permission_files,
+        )
+    return result, stats
+
+
+def find_identical_pairs(pairs: list[tuple[Path, Path]]) -> dict[tuple[Path, Path], IdenticalPair]:
+    """Returns the (pre, post) pairs whose file type and content match.
+    Sizes are compared first, so that only files which could be identical are hashed"""
+    infos = stat_files({path for pair in pairs for path in pair})
+    to_hash: list[tuple[Path, Path]] = []
+    identical: dict[tuple[Path, Path], IdenticalPair] = {}
+    for pre, post in pairs:
+        pre_info = infos.get(pre)
+        post_info = infos.get(post)
+        if pre_info is None or post_info is None:
+            continue
+        if stat.S_IFMT(pre_info.mode) != stat.S_IFMT(post_info.mode) or pre_info.size != post_info.size:
+            continue
+        if stat.S_ISLNK(pre_info.mode):
+            target = _readlink(pre)
+            if target is not None and target == _readlink(post):
+                identical[(pre, post)] = IdenticalPair(pre_info.size, _permissions_changed(pre_info, post_info))
+        elif stat.S_ISREG(pre_info.mode):
+            to_hash.append((pre, post))
+
+    digests = hash_files({path for pair in to_hash for path in pair})
+    for pre, post in to_hash:
+        pre_digest = digests.get(pre)
+        if pre_digest is not None and pre_digest == digests.get(post):
+            identical[(pre, post)] = IdenticalPair(infos[pre].size, _permissions_changed(infos[pre], infos[post]))
+    return identical
+
+
+def _permissions_changed(pre: FileInfo, post: FileInfo) -> bool:
+    return (stat.S_IMODE(pre.mode), pre.uid, pre.gid) != (stat.S_IMODE(post.mode), post.uid, post.gid)
+
+
+def stat_files(paths: set[Path]) -> dict[Path, FileInfo]:
+    infos: dict[Path, FileInfo] = {}
+    denied: set[Path] = set()
+    for path in paths:
+        try:
+            st = os.lstat(path)
+            infos[path] = FileInfo(mode=st.st_mode, uid=st.st_uid, gid=st.st_gid, size=st.st_size)
+        except PermissionError:
+            denied.add(path)
+        except OSError:
+            continue
+    if denied:
+        infos.update(_stat_files_privileged(denied))
+    return infos
+
+
+def hash_files(paths: set[Path]) -> dict[Path, str]:
+    """Hashes the files in parallel. hashlib releases the GIL while hashing the mmapped content,
+    so a thread pool is enough to use every core"""
+    digests: dict[Path, str] = {}
+    denied: set[Path] = set()
+    ordered_paths = list(paths)
+    with ThreadPoolExecutor() as executor:
+        for path, digest in zip(ordered_paths, executor.map(_hash_file, ordered_paths)):
+            if isinstance(digest, str):
+                digests[path] = digest
+            elif digest is PermissionError:
+                denied.add(path)
+    if denied:
+        digests.update(_hash_files_privileged(denied))
+    return digests
+
+
+def _hash_file(path: Path) -> str | type[PermissionError] | None:
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return hashlib.sha256().hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return hashlib.sha256(m).hexdigest()
+    except PermissionError:
+        return PermissionError
+    except OSError:
+        return None
+
+
+def _readlink(path: Path) -> str | None:
+    try:
+        return os.readlink(path)
+    except PermissionError:
+        result = subprocess.run(["sudo", "readlink", str(path)], capture_output=True, text=True)
+        return result.stdout.rstrip("\n") if result.returncode == 0 else None
+    except OSError:
+        return None
+
+
+def _stat_files_privileged(paths: set[Path]) -> dict[Path, FileInfo]:
+    # Snapshots are usually only readable by root. Stat all of the files with a single sudo call instead
+    # Important: Paths are separated by the null character, since it can't appear in a filename
+    result = subprocess.run(
+        ["sudo", "xargs", "-0", "stat", "--printf", "%f %u %g %s %n\\0", "--"],
+        capture_output=True,
+        text=True,
+        input="\0".join(str(p) for p in paths) + "\0",
+    )
+    infos: dict[Path, FileInfo] = {}
+    for record in result.stdout.split("\0"):
+        if not record:
+            continue
+        mode, uid, gid, size, name = record.split(" ", 4)
+        infos[Path(name)] = FileInfo(mode=int(mode, 16), uid=int(uid), gid=int(gid), size=int(size))
+    return infos
+
+
+def _hash_files_privileged(paths: set[Path]) -> dict[Path, str]:
+    result = subprocess.run(
+        ["sudo", "xargs", "-0", "sha256sum", "--binary", "--zero", "--"],
+        capture_output=True,
+        text=True,
+        input="\0".join(str(p) for p in paths) + "\0",
+    )
+    digests: dict[Path, str] = {}
+    for record in result.stdout.split("\0"):
+        if not record:
+            continue
+        # Each record is in the form <hash> *<name>
+        digest, name = record.split(" *", 1)
+        digests[Path(name)] = digest
+    return digests
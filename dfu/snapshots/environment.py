@@ -0,0 +1,95 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from types import MappingProxyType
+
+import msgspec
+from platformdirs import PlatformDirs
+
+from dfu.helpers.json_serializable import JsonSerializableMixin
+from dfu.snapshots.btrfs import get_all_subvolumes
+from dfu.snapshots.snapper import SNAPPER_CONFIGS_DIR, Snapper, SnapperConfigInfo, SnapperName
+
+# snapper list-configs reads the config names from /etc/conf.d/snapper, and each config from /etc/snapper/configs
+SNAPPER_CONFIG_PATHS = (SNAPPER_CONFIGS_DIR, Path('/etc/conf.d/snapper'))
+MOUNTINFO_PATH = Path('/proc/self/mountinfo')
+
+
+@dataclass(frozen=True)
+class Environment(JsonSerializableMixin):
+    key: str
+    # The mountpoint of each snapper config, in the order that snapper lists them
+    mountpoints: MappingProxyType[str, str]
+    subvolumes: tuple[str, ...]
+
+    @property
+    def snapper_configs(self) -> list[SnapperConfigInfo]:
+        return [
+            SnapperConfigInfo(name=SnapperName(name), mountpoint=Path(mountpoint))
+            for name, mountpoint in self.mountpoints.items()
+        ]
+
+
+def load_environment(cache_path: Path | None = None) -> Environment:
+    """Returns the snapper configs and the btrfs subvolumes. Finding them takes several sudo calls,
+    so the result is cached until a snapper config changes or a filesystem is mounted or unmounted"""
+    if cache_path is None:
+        cache_path = PlatformDirs("dfu").user_cache_path / "environment.json"
+    key = environment_key()
+    cached: Environment | None
+    try:
+        cached = Environment.from_file(cache_path)
+    except OSError:
+        cached = None
+    except msgspec.DecodeError:
+        # The cache was written by a different version of dfu
+        cached = None
+    if cached is not None and cached.key == key:
+        return cached
+
+    environment = resolve_environment(key)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        environment.write_atomic(cache_path)
+    except OSError:
+        # The cache is only an optimization
+        pass
+    return environment
+
+
+def resolve_environment(key: str) -> Environment:
+    return Environment(
+        key=key,
+        mountpoints=MappingProxyType({config.name: str(config.mountpoint) for config in Snapper.get_configs()}),
+        subvolumes=tuple(get_all_subvolumes()),
+    )
+
+
+def environment_key() -> str:
+    """Hashes the modification time of the snapper configs, and the mount table.
+    The modification time of /proc/self/mountinfo is when the process started, so its content is hashed instead"""
+    digest = hashlib.sha256()
+    for path in SNAPPER_CONFIG_PATHS:
+        for name, mtime in _modification_times(path):
+            digest.update(f"{name}\0{mtime}\0".encode())
+    try:
+        digest.update(MOUNTINFO_PATH.read_bytes())
+    except OSError:
+        pass
+    return digest.hexdigest()
+
+
+def _modification_times(path: Path) -> list[tuple[str, int]]:
+    # Editing a config file doesn't change the modification time of its directory
+    try:
+        result = [(str(path), os.stat(path).st_mtime_ns)]
+    except OSError:
+        return [(str(path), 0)]
+    try:
+        with os.scandir(path) as entries:
+            result.extend(sorted((entry.path, entry.stat().st_mtime_ns) for entry in entries))
+    except OSError:
+        # /etc/conf.d/snapper is a file, the directory isn't readable, or an entry was removed while listing it
+        pass
+    return result
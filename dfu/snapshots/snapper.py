@@ -1,6 +1,9 @@
 import json
+import os
 import subprocess
-from dataclasses import dataclass
+from collections.abc import Sequence
+from dataclasses import dataclass, replace
+from functools import lru_cache
 from pathlib import Path
 from typing import NewType, TypedDict
 
@@ -8,6 +11,9 @@ from dfu.snapshots.snapper_diff import SnapperDiff
 
 SnapperName = NewType('SnapperName', str)
 
+# snapper get-config reads the config from /etc/snapper/configs/<name>
+SNAPPER_CONFIGS_DIR = Path('/etc/snapper/configs')
+
 
 class SnapperConfig(TypedDict):
     config: SnapperName
@@ -40,11 +46,7 @@ class Snapper:
         self.snapper_name = snapper_name
 
     def get_mountpoint(self) -> Path:
-        result = subprocess.run(
-            ['sudo', 'snapper', '-c', self.snapper_name, '--jsonout', 'get-config'], capture_output=True
-        )
-        config = json.loads(result.stdout)
-        return Path(config['SUBVOLUME'])
+        return _get_mountpoint(self.snapper_name, _config_key(self.snapper_name))
 
     def create_snapshot(self, description: str) -> int:
         result = subprocess.run(
@@ -67,13 +69,61 @@ class Snapper:
         return int(result.stdout.strip())
 
     def get_delta(self, pre_snapshot_id: int, post_snapshot_id: int) -> list[SnapperDiff]:
-        result = subprocess.run(
-            ['sudo', 'snapper', '-c', self.snapper_name, 'status', f'{pre_snapshot_id}..{post_snapshot_id}'],
-            capture_output=True,
-            text=True,
+        identity = snapshot_identity(
+            [self.get_snapshot_path(snapshot_id).parent for snapshot_id in (pre_snapshot_id, post_snapshot_id)]
         )
-        status_lines = result.stdout.splitlines()
-        return [SnapperDiff.from_status(line) for line in status_lines]
+        # The deltas are mutable, so the cached ones are copied
+        return [replace(delta) for delta in _get_delta(self.snapper_name, pre_snapshot_id, post_snapshot_id, identity)]
 
     def get_snapshot_path(self, snapshot_id: int) -> Path:
-        return self.get_mountpoint() / '.snapshots' / str(snapshot_id) / 'snapshot'
+        return snapshot_path(self.get_mountpoint(), snapshot_id)
+
+
+def snapshot_path(mountpoint: Path, snapshot_id: int) -> Path:
+    return mountpoint / '.snapshots' / str(snapshot_id) / 'snapshot'
+
+
+def snapshot_identity(directories: Sequence[Path]) -> tuple[str, ...]:
+    """Identifies the snapshot directories beyond their ids, since snapper reuses the id of a deleted snapshot.
+    snapper creates a new directory for each snapshot, so its inode and change time are used"""
+    try:
+        return tuple(f"{stat.st_ino}:{int(stat.st_ctime)}" for stat in map(os.stat, directories))
+    except PermissionError:
+        # The snapshots are usually only readable by root
+        result = subprocess.run(
+            ['sudo', 'stat', '--format=%i:%Z', '--', *map(str, directories)], capture_output=True, text=True, check=True
+        )
+        return tuple(result.stdout.splitlines())
+
+
+# The answers of snapper are kept for as long as the process runs (e.g. in the dfu daemon),
+# so they're keyed on what changes them, in addition to their arguments
+
+
+@lru_cache(maxsize=32)
+def _get_mountpoint(snapper_name: SnapperName, config_key: int) -> Path:
+    # config_key is only part of the cache key
+    result = subprocess.run(['sudo', 'snapper', '-c', snapper_name, '--jsonout', 'get-config'], capture_output=True)
+    config = json.loads(result.stdout)
+    return Path(config['SUBVOLUME'])
+
+
+def _config_key(snapper_name: SnapperName) -> int:
+    try:
+        return os.stat(SNAPPER_CONFIGS_DIR / snapper_name).st_mtime_ns
+    except OSError:
+        return 0
+
+
+@lru_cache(maxsize=32)
+def _get_delta(
+    snapper_name: SnapperName, pre_snapshot_id: int, post_snapshot_id: int, identity: tuple[str, ...]
+) -> tuple[SnapperDiff, ...]:
+    # identity is only part of the cache key
+    result = subprocess.run(
+        ['sudo', 'snapper', '-c', snapper_name, 'status', f'{pre_snapshot_id}..{post_snapshot_id}'],
+        capture_output=True,
+        text=True,
+    )
+    status_lines = result.stdout.splitlines()
+    return tuple(SnapperDiff.from_status(line) for line in status_lines)
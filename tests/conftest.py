@@ -10,6 +10,14 @@ from dfu.api import State, Store
 from dfu.config import Config
 from dfu.package.package_config import PackageConfig
 from dfu.revision.git import git_init
+from dfu.snapshots.snapper import _get_delta, _get_mountpoint
+
+
+@pytest.fixture(autouse=True)
+def clear_snapper_cache() -> None:
+    # The answers of snapper are cached for the whole process, and each test mocks them differently
+    _get_mountpoint.cache_clear()
+    _get_delta.cache_clear()
 
 
 @pytest.fixture
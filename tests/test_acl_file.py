@@ -17,11 +17,11 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 2
 
-        expected_python = AclEntry(Path("/usr/bin/python"), "755", "root", "root")
-        expected_bash = AclEntry(Path("/usr/bin/bash"), "755", "root", "root")
+        expected_python = AclEntry("/usr/bin/python", "755", "root", "root")
+        expected_bash = AclEntry("/usr/bin/bash", "755", "root", "root")
 
-        assert acl_file.entries[Path("/usr/bin/python")] == expected_python
-        assert acl_file.entries[Path("/usr/bin/bash")] == expected_bash
+        assert acl_file.entries["/usr/bin/python"] == expected_python
+        assert acl_file.entries["/usr/bin/bash"] == expected_bash
 
     def test_from_string_with_spaces_in_path(self) -> None:
         content = dedent("""
@@ -32,11 +32,11 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 2
 
-        expected_script = AclEntry(Path("/usr/local/bin/my script"), "755", "root", "root")
-        expected_log = AclEntry(Path("/var/log/my log"), "644", "root", "root")
+        expected_script = AclEntry("/usr/local/bin/my script", "755", "root", "root")
+        expected_log = AclEntry("/var/log/my log", "644", "root", "root")
 
-        assert acl_file.entries[Path("/usr/local/bin/my script")] == expected_script
-        assert acl_file.entries[Path("/var/log/my log")] == expected_log
+        assert acl_file.entries["/usr/local/bin/my script"] == expected_script
+        assert acl_file.entries["/var/log/my log"] == expected_log
 
     def test_from_string_invalid_line_too_few_parts(self) -> None:
         content = dedent("""
@@ -57,11 +57,11 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 2
 
-        expected_python = AclEntry(Path("/usr/bin/python"), "755", "root", "root")
-        expected_bash = AclEntry(Path("/usr/bin/bash"), "755", "root", "root")
+        expected_python = AclEntry("/usr/bin/python", "755", "root", "root")
+        expected_bash = AclEntry("/usr/bin/bash", "755", "root", "root")
 
-        assert acl_file.entries[Path("/usr/bin/python")] == expected_python
-        assert acl_file.entries[Path("/usr/bin/bash")] == expected_bash
+        assert acl_file.entries["/usr/bin/python"] == expected_python
+        assert acl_file.entries["/usr/bin/bash"] == expected_bash
 
     def test_from_string_empty_content(self) -> None:
         acl_file = AclFile.from_string("")
@@ -171,8 +171,8 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 1
 
-        expected_entry = AclEntry(Path("/usr/bin/python"), "755", "user-name", "root")
-        assert acl_file.entries[Path("/usr/bin/python")] == expected_entry
+        expected_entry = AclEntry("/usr/bin/python", "755", "user-name", "root")
+        assert acl_file.entries["/usr/bin/python"] == expected_entry
 
     def test_from_string_valid_uid_with_underscores(self) -> None:
         content = dedent("""
@@ -182,8 +182,8 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 1
 
-        expected_entry = AclEntry(Path("/usr/bin/python"), "755", "user_name", "root")
-        assert acl_file.entries[Path("/usr/bin/python")] == expected_entry
+        expected_entry = AclEntry("/usr/bin/python", "755", "user_name", "root")
+        assert acl_file.entries["/usr/bin/python"] == expected_entry
 
     def test_from_string_valid_gid_with_hyphens(self) -> None:
         content = dedent("""
@@ -193,8 +193,8 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 1
 
-        expected_entry = AclEntry(Path("/usr/bin/python"), "755", "root", "group-name")
-        assert acl_file.entries[Path("/usr/bin/python")] == expected_entry
+        expected_entry = AclEntry("/usr/bin/python", "755", "root", "group-name")
+        assert acl_file.entries["/usr/bin/python"] == expected_entry
 
     def test_from_string_valid_gid_with_underscores(self) -> None:
         content = dedent("""
@@ -204,8 +204,8 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 1
 
-        expected_entry = AclEntry(Path("/usr/bin/python"), "755", "root", "group_name")
-        assert acl_file.entries[Path("/usr/bin/python")] == expected_entry
+        expected_entry = AclEntry("/usr/bin/python", "755", "root", "group_name")
+        assert acl_file.entries["/usr/bin/python"] == expected_entry
 
     def test_from_string_path_with_special_chars(self) -> None:
         content = dedent("""
@@ -215,8 +215,8 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 1
 
-        expected_entry = AclEntry(Path("/tmp/file-with-dashes_and_underscores"), "644", "user", "group")
-        assert acl_file.entries[Path("/tmp/file-with-dashes_and_underscores")] == expected_entry
+        expected_entry = AclEntry("/tmp/file-with-dashes_and_underscores", "644", "user", "group")
+        assert acl_file.entries["/tmp/file-with-dashes_and_underscores"] == expected_entry
 
     def test_from_string_strips_whitespace_from_fields(self) -> None:
         content = dedent("""
@@ -227,11 +227,11 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 2
 
-        expected_python = AclEntry(Path("/usr/bin/python"), "755", "root", "root")
-        expected_bash = AclEntry(Path("/usr/bin/bash"), "644", "user", "group")
+        expected_python = AclEntry("/usr/bin/python", "755", "root", "root")
+        expected_bash = AclEntry("/usr/bin/bash", "644", "user", "group")
 
-        assert acl_file.entries[Path("/usr/bin/python")] == expected_python
-        assert acl_file.entries[Path("/usr/bin/bash")] == expected_bash
+        assert acl_file.entries["/usr/bin/python"] == expected_python
+        assert acl_file.entries["/usr/bin/bash"] == expected_bash
 
     def test_from_string_strips_whitespace_from_path_with_spaces(self) -> None:
         content = dedent("""
@@ -241,8 +241,8 @@ class TestAclFile:
         acl_file = AclFile.from_string(content)
         assert len(acl_file.entries) == 1
 
-        expected_entry = AclEntry(Path("/usr/local/bin/my script"), "755", "root", "root")
-        assert acl_file.entries[Path("/usr/local/bin/my script")] == expected_entry
+        expected_entry = AclEntry("/usr/local/bin/my script", "755", "root", "root")
+        assert acl_file.entries["/usr/local/bin/my script"] == expected_entry
 
     def test_from_file_smoke_test(self) -> None:
         content = dedent("""
@@ -257,8 +257,8 @@ class TestAclFile:
 
             acl_file = AclFile.from_file(acl_path)
             assert len(acl_file.entries) == 2
-            assert Path("/usr/bin/python") in acl_file.entries
-            assert Path("/usr/bin/bash") in acl_file.entries
+            assert "/usr/bin/python" in acl_file.entries
+            assert "/usr/bin/bash" in acl_file.entries
 
     def test_from_file_empty_file_smoke_test(self) -> None:
         with TemporaryDirectory() as temp_dir:
@@ -271,8 +271,8 @@ class TestAclFile:
 
     def test_write_simple(self) -> None:
         entries = {
-            Path("/usr/bin/python"): AclEntry(Path("/usr/bin/python"), "755", "root", "root"),
-            Path("/usr/bin/bash"): AclEntry(Path("/usr/bin/bash"), "755", "root", "root"),
+            "/usr/bin/python": AclEntry("/usr/bin/python", "755", "root", "root"),
+            "/usr/bin/bash": AclEntry("/usr/bin/bash", "755", "root", "root"),
         }
         acl_file = AclFile(entries)
 
@@ -291,8 +291,8 @@ class TestAclFile:
 
     def test_write_with_spaces_in_path(self) -> None:
         entries = {
-            Path("/usr/local/bin/my script"): AclEntry(Path("/usr/local/bin/my script"), "755", "root", "root"),
-            Path("/var/log/my log"): AclEntry(Path("/var/log/my log"), "644", "root", "root"),
+            "/usr/local/bin/my script": AclEntry("/usr/local/bin/my script", "755", "root", "root"),
+            "/var/log/my log": AclEntry("/var/log/my log", "644", "root", "root"),
         }
         acl_file = AclFile(entries)
 
@@ -311,9 +311,9 @@ class TestAclFile:
 
     def test_round_trip_serialization(self) -> None:
         original_entries = {
-            Path("/usr/bin/python"): AclEntry(Path("/usr/bin/python"), "755", "root", "root"),
-            Path("/usr/local/bin/my script"): AclEntry(Path("/usr/local/bin/my script"), "755", "user", "group"),
-            Path("/var/log/my log"): AclEntry(Path("/var/log/my log"), "644", "root", "root"),
+            "/usr/bin/python": AclEntry("/usr/bin/python", "755", "root", "root"),
+            "/usr/local/bin/my script": AclEntry("/usr/local/bin/my script", "755", "user", "group"),
+            "/var/log/my log": AclEntry("/var/log/my log", "644", "root", "root"),
         }
         original_acl_file = AclFile(original_entries)
 
@@ -333,14 +333,12 @@ class TestAclFile:
 
     def test_round_trip_with_complex_paths(self) -> None:
         original_entries = {
-            Path("/tmp/file-with-dashes"): AclEntry(Path("/tmp/file-with-dashes"), "644", "user-name", "group-name"),
-            Path("/var/log/file_with_underscores"): AclEntry(
-                Path("/var/log/file_with_underscores"), "644", "user_name", "group_name"
+            "/tmp/file-with-dashes": AclEntry("/tmp/file-with-dashes", "644", "user-name", "group-name"),
+            "/var/log/file_with_underscores": AclEntry(
+                "/var/log/file_with_underscores", "644", "user_name", "group_name"
             ),
-            Path("/usr/local/bin/script with spaces"): AclEntry(
-                Path("/usr/local/bin/script with spaces"), "755", "root", "root"
-            ),
-            Path("/home/user/dot.file"): AclEntry(Path("/home/user/dot.file"), "600", "user", "user"),
+            "/usr/local/bin/script with spaces": AclEntry("/usr/local/bin/script with spaces", "755", "root", "root"),
+            "/home/user/dot.file": AclEntry("/home/user/dot.file", "600", "user", "user"),
         }
         original_acl_file = AclFile(original_entries)
 
@@ -372,9 +370,9 @@ class TestAclFile:
 
     def test_entries_sorted_by_path(self) -> None:
         entries = {
-            Path("/usr/bin/zsh"): AclEntry(Path("/usr/bin/zsh"), "755", "root", "root"),
-            Path("/usr/bin/bash"): AclEntry(Path("/usr/bin/bash"), "755", "root", "root"),
-            Path("/usr/bin/python"): AclEntry(Path("/usr/bin/python"), "755", "root", "root"),
+            "/usr/bin/zsh": AclEntry("/usr/bin/zsh", "755", "root", "root"),
+            "/usr/bin/bash": AclEntry("/usr/bin/bash", "755", "root", "root"),
+            "/usr/bin/python": AclEntry("/usr/bin/python", "755", "root", "root"),
         }
         acl_file = AclFile(entries)
 
@@ -388,3 +386,35 @@ class TestAclFile:
             expected_order = ["/usr/bin/bash", "/usr/bin/python", "/usr/bin/zsh"]
             for i, expected_path in enumerate(expected_order):
                 assert lines[i].startswith(expected_path)
+
+    def test_entries_sorted_by_path_components(self) -> None:
+        paths = ["/a-b", "/a/b", "/a", "/a b/c", "/a.b", "/ab", "/a/b/c", "/"]
+        acl_file = AclFile({path: AclEntry(path, "755", "root", "root") for path in paths})
+
+        with TemporaryDirectory() as temp_dir:
+            acl_path = Path(temp_dir) / "acl.txt"
+            acl_file.write(acl_path)
+
+            with open(acl_path, "r") as f:
+                written = [line.rsplit(" ", 3)[0] for line in f]
+
+        # The same order as before the paths were stored as str, so existing acl.txt files don't change
+        assert written == [str(path) for path in sorted(Path(path) for path in paths)]
+
+    def test_from_string_normalizes_paths(self) -> None:
+        content = dedent("""
+            /usr/bin/ 755 root root
+            /usr//lib/./python 755 root root
+        """)
+
+        acl_file = AclFile.from_string(content)
+        assert acl_file.entries == {
+            "/usr/bin": AclEntry("/usr/bin", "755", "root", "root"),
+            "/usr/lib/python": AclEntry("/usr/lib/python", "755", "root", "root"),
+        }
+
+    def test_invalid_entry_with_previously_valid_fields(self) -> None:
+        AclEntry("/usr/bin/python", "755", "root", "root")
+
+        with pytest.raises(ValueError, match="must be an absolute path"):
+            AclEntry("usr/bin/python", "755", "root", "root")
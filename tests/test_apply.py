@@ -0,0 +1,230 @@
+import os
+import subprocess
+from pathlib import Path
+from typing import Generator
+from unittest.mock import patch
+
+import pytest
+
+from dfu.api import Playground, State, Store
+from dfu.commands.apply import (
+    _check_patches,
+    _copy_base_files,
+    _dependencies_store,
+    _journal_path,
+    _resume_journal,
+    _write_initial_permissions,
+)
+from dfu.config import Config
+from dfu.package.acl_file import AclEntry, AclFile
+from dfu.package.apply_journal import ApplyJournal, JournalStep
+from dfu.package.objects import ObjectStore
+from dfu.package.package_config import PackageConfig
+from dfu.revision.git import git_add, git_apply, git_commit, git_diff, git_init, git_reset_hard, git_rev_parse
+
+
+@pytest.fixture
+def playground() -> Generator[Playground, None, None]:
+    playground = Playground(prefix="unit_test")
+    git_init(playground.location)
+    subprocess.run(['git', 'config', 'user.name', 'myself'], cwd=playground.location, check=True)
+    subprocess.run(['git', 'config', 'user.email', 'me@example.com'], cwd=playground.location, check=True)
+    yield playground
+    playground.cleanup()
+
+
+@pytest.fixture
+def conflicting_patch(playground: Playground, tmp_path: Path) -> Path:
+    (playground.location / 'files' / 'etc').mkdir(parents=True)
+    (playground.location / 'files' / 'etc' / 'hosts').write_text('before\n')
+    git_add(playground.location, ['.'])
+    git_commit(playground.location, 'Before')
+    (playground.location / 'files' / 'etc' / 'hosts').write_text('after\n')
+    git_add(playground.location, ['.'])
+    git_commit(playground.location, 'After')
+    patch_file = tmp_path / '001.patch'
+    patch_file.write_text(git_diff(playground.location, 'HEAD~1', 'HEAD'))
+    (playground.location / 'files' / 'etc' / 'hosts').write_text('changed on the system\n')
+    git_add(playground.location, ['.'])
+    git_commit(playground.location, 'Base files')
+    return patch_file
+
+
+def test_check_patches_conflict(
+    playground: Playground, conflicting_patch: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    with patch('click.confirm', return_value=False) as mock_confirm, pytest.raises(ValueError, match='Aborting'):
+        _check_patches(playground, root=Path('/'), patches=[conflicting_patch], reverse=False, confirm=True)
+    mock_confirm.assert_called_once()
+    assert "001.patch" in capsys.readouterr().err
+
+
+def test_check_patches_conflict_without_confirm(
+    playground: Playground, conflicting_patch: Path, capsys: pytest.CaptureFixture[str]
+) -> None:
+    # e.g. dfu apply --force, which can run without a terminal
+    with patch('click.confirm') as mock_confirm:
+        _check_patches(playground, root=Path('/'), patches=[conflicting_patch], reverse=False, confirm=False)
+    mock_confirm.assert_not_called()
+    assert "The following patches don't apply cleanly to the files in /" in capsys.readouterr().err
+
+
+@pytest.fixture
+def interrupted_apply(playground: Playground) -> ApplyJournal:
+    (playground.location / 'files' / 'etc').mkdir(parents=True)
+    (playground.location / 'files' / 'etc' / 'hosts').write_text('base\n')
+    (playground.location / 'acl.txt').write_text('/etc 755 root root\n/etc/hosts 644 root root\n')
+    git_add(playground.location, ['.'])
+    git_commit(playground.location, 'Initial files')
+    base_commit = git_rev_parse(playground.location, 'HEAD')
+    (playground.location / 'files' / 'etc' / 'hosts').write_text('patched\n')
+    git_add(playground.location, ['.'])
+    git_commit(playground.location, 'Patch 001.patch')
+    journal = ApplyJournal(
+        reverse=False,
+        base_commit=base_commit,
+        sudo=True,
+        steps=(JournalStep(patch='001.patch', interactive=False), JournalStep(patch='002.patch', interactive=False)),
+        completed=(git_rev_parse(playground.location, 'HEAD'),),
+    )
+    _journal_path(playground).parent.mkdir(parents=True)
+    journal.write_atomic(_journal_path(playground))
+    return journal
+
+
+def test_resume_journal(playground: Playground, interrupted_apply: ApplyJournal) -> None:
+    # The second patch was interrupted after it changed the files
+    (playground.location / 'files' / 'etc' / 'hosts').write_text('interrupted\n')
+    (playground.location / 'files' / 'etc' / 'new').write_text('interrupted\n')
+    with (
+        # The files are owned by root during the apply, so the reset uses sudo
+        patch('dfu.commands.apply.git_reset_hard', side_effect=lambda *args, sudo: git_reset_hard(*args)) as mock_reset,
+        patch('dfu.commands.apply._apply_metadata') as mock_apply_metadata,
+    ):
+        assert _resume_journal(playground) == interrupted_apply
+    mock_reset.assert_called_once_with(playground.location, interrupted_apply.last_commit, sudo=True)
+    assert (playground.location / 'files' / 'etc' / 'hosts').read_text() == 'patched\n'
+    assert not (playground.location / 'files' / 'etc' / 'new').exists()
+    # The reset wrote the files again, so their owners and modes are restored
+    mock_apply_metadata.assert_called_once_with(playground, paths={Path('/etc/hosts'), Path('/etc/new')}, sudo=True)
+
+
+def test_resume_journal_unchanged(playground: Playground, interrupted_apply: ApplyJournal) -> None:
+    with patch('dfu.commands.apply.git_reset_hard') as mock_reset:
+        assert _resume_journal(playground) == interrupted_apply
+    mock_reset.assert_not_called()
+
+
+def file_patch(path: str) -> str:
+    return f"""\
+diff --git a/files{path} b/files{path}
+--- a/files{path}
++++ b/files{path}
+@@ -1 +1 @@
+-before
++after
+"""
+
+
+def test_copy_base_files_includes_archived_patches(
+    playground: Playground, tmp_path: Path, config: Config, package_config: PackageConfig
+) -> None:
+    package_dir = tmp_path / 'package'
+    (package_dir / 'archive' / '000_to_002').mkdir(parents=True)
+    (package_dir / '000_to_002.patch').write_text(file_patch('/etc/hosts'))
+    (package_dir / 'archive' / '000_to_002' / '000_to_001.patch').write_text(file_patch('/etc/hosts'))
+    # The file was changed back by the next patch, so it's only in the original patches
+    (package_dir / 'archive' / '000_to_002' / '001_to_002.patch').write_text(file_patch('/etc/fstab'))
+    store = Store(State(config=config, package_dir=package_dir, package_config=package_config))
+    with (
+        patch.object(playground, 'copy_files_from_filesystem') as mock_copy,
+        patch.object(playground, 'externalize_files'),
+        patch('dfu.commands.apply._write_initial_permissions'),
+    ):
+        _copy_base_files([store], playground=playground, root=Path('/'), reverse=False, sudo=False)
+    assert {copy_file.target for copy_file in mock_copy.call_args[0][0]} == {Path('/etc/hosts'), Path('/etc/fstab')}
+
+
+def test_write_initial_permissions(
+    playground: Playground, tmp_path: Path, current_user: str, current_group: str
+) -> None:
+    # The files are in a container rootfs instead of /
+    root = tmp_path / 'rootfs'
+    (root / 'etc' / 'dir#1').mkdir(parents=True)
+    files = {Path('/etc/dir#1/a#b'), Path('/etc/dir#1/with space'), Path('/etc/dir#1/new\nline')}
+    for file in files:
+        (root / file.relative_to('/')).write_text('content')
+        os.chmod(root / file.relative_to('/'), 0o640)
+    os.chmod(root / 'etc' / 'dir#1', 0o750)
+    with patch.object(AclFile, 'write', autospec=True) as mock_write:
+        # A file which doesn't exist is skipped
+        _write_initial_permissions(playground=playground, files={*files, Path('/etc/missing')}, root=root, sudo=False)
+    acl_file: AclFile = mock_write.call_args[0][0]
+    assert acl_file.entries == {
+        '/etc': AclEntry('/etc', oct(os.stat(root / 'etc').st_mode & 0o7777)[2:], current_user, current_group),
+        '/etc/dir#1': AclEntry('/etc/dir#1', '750', current_user, current_group),
+        **{str(file): AclEntry(str(file), '640', current_user, current_group) for file in files},
+    }
+
+
+def test_copy_base_files_reverse_externalized_file(
+    playground: Playground, tmp_path: Path, config: Config, package_config: PackageConfig
+) -> None:
+    root = tmp_path / 'rootfs'
+    root.mkdir()
+    (root / 'big').write_bytes(b'\0binary' * 100)
+    # The patch created /big, which was stored in the package objects
+    package_dir = tmp_path / 'package'
+    repo = tmp_path / 'repo'
+    (repo / 'files').mkdir(parents=True)
+    git_init(repo)
+    subprocess.run(['git', 'config', 'user.name', 'myself'], cwd=repo, check=True)
+    subprocess.run(['git', 'config', 'user.email', 'me@example.com'], cwd=repo, check=True)
+    (repo / 'acl.txt').write_text('')
+    git_add(repo, ['.'])
+    git_commit(repo, 'Initial files')
+    pointer = ObjectStore(package_dir / 'objects').add(root / 'big')
+    (repo / 'files' / 'big').write_text(pointer.encode())
+    git_add(repo, ['.'])
+    git_commit(repo, 'Modified files')
+    patch_file = package_dir / '000_to_001.patch'
+    patch_file.write_text(git_diff(repo, 'HEAD~1', 'HEAD'))
+
+    store = Store(State(config=config, package_dir=package_dir, package_config=package_config))
+    with patch.object(playground, '_apply_permissions_to_playground'):
+        _copy_base_files([store], playground=playground, root=root, reverse=True, sudo=False)
+    git_add(playground.location, ['.'])
+    git_commit(playground.location, 'Initial files')
+    # The base file is a pointer like in the patch, so the patch can be reversed
+    assert (playground.location / 'files' / 'big').read_text() == pointer.encode()
+    assert git_apply(playground.location, patch_file, reverse=True)
+    assert not (playground.location / 'files' / 'big').exists()
+
+
+@pytest.mark.parametrize(
+    'reverse, programs_added, programs_removed',
+    [
+        # The second package removed vim after the first package installed it
+        (False, ('git',), ('vim',)),
+        # Undoing the second package comes first, so undoing the first package decides what happens to vim
+        (True, ('vim', 'git'), ()),
+    ],
+)
+def test_dependencies_store(
+    config: Config,
+    package_config: PackageConfig,
+    reverse: bool,
+    programs_added: tuple[str, ...],
+    programs_removed: tuple[str, ...],
+) -> None:
+    stores = [
+        Store(State(config=config, package_dir=Path(name), package_config=package_config.update(**programs)))
+        for name, programs in (
+            ('first', {'programs_added': ('vim', 'git')}),
+            ('second', {'programs_added': (), 'programs_removed': ('vim',)}),
+        )
+    ]
+    with patch('dfu.commands.apply.load_plugins', side_effect=lambda store: store):
+        store = _dependencies_store(stores, reverse=reverse)
+    assert store.state.package_config.programs_added == programs_added
+    assert store.state.package_config.programs_removed == programs_removed
@@ -0,0 +1,41 @@
+from pathlib import Path
+
+import pytest
+
+from dfu.package.apply_journal import ApplyJournal, JournalStep
+
+
+@pytest.fixture
+def journal() -> ApplyJournal:
+    return ApplyJournal(
+        reverse=False,
+        base_commit="base",
+        steps=(
+            JournalStep(patch="/package/000_to_001.patch", interactive=False),
+            JournalStep(patch="/package/001_to_002.patch", interactive=True),
+        ),
+    )
+
+
+def test_journal_progress(journal: ApplyJournal) -> None:
+    assert journal.last_commit == "base"
+    assert journal.remaining_steps == journal.steps
+
+    journal = journal.complete_step("first")
+    assert journal.last_commit == "first"
+    assert journal.remaining_steps == (JournalStep(patch="/package/001_to_002.patch", interactive=True),)
+
+    journal = journal.complete_step("second")
+    assert journal.last_commit == "second"
+    assert journal.remaining_steps == ()
+    with pytest.raises(ValueError, match="already applied"):
+        journal.complete_step("third")
+
+
+def test_journal_write_atomic(tmp_path: Path, journal: ApplyJournal) -> None:
+    path = tmp_path / "journal.json"
+    journal.write_atomic(path)
+    journal = journal.complete_step("first")
+    journal.write_atomic(path)
+    assert ApplyJournal.from_file(path) == journal
+    assert [p.name for p in tmp_path.iterdir()] == ["journal.json"]
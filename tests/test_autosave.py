@@ -1,10 +1,12 @@
 from pathlib import Path
+from unittest.mock import patch
 
 import pytest
 
 from dfu.api import State, Store
 from dfu.api.plugin import InstallDependenciesEvent
 from dfu.config import Config
+from dfu.helpers.atomic_write import write_atomic
 from dfu.package.package_config import PackageConfig
 from dfu.plugins.autosave import AutosavePlugin
 
@@ -28,3 +30,28 @@ def test_save_package_config(store: Store) -> None:
 def test_handle_no_ops(store: Store) -> None:
     # Just make sure no exception is raised
     store.dispatch(InstallDependenciesEvent(confirm=False, dry_run=False))
+
+
+def test_save_package_config_atomically(store: Store) -> None:
+    store.state = store.state.update(
+        package_config=store.state.package_config.update(description="Updated the description")
+    )
+    assert [path.name for path in store.state.package_dir.iterdir()] == ['dfu_config.json']
+
+
+def test_skip_unchanged_package_config(store: Store) -> None:
+    with patch('dfu.plugins.autosave.write_atomic') as mock_write_atomic:
+        # An equal, but not identical, config
+        store.state = store.state.update(package_config=store.state.package_config.update())
+    mock_write_atomic.assert_not_called()
+
+
+def test_save_once_per_transaction(store: Store) -> None:
+    with patch('dfu.plugins.autosave.write_atomic', wraps=write_atomic) as mock_write_atomic:
+        with store.transaction():
+            for description in ('First', 'Second'):
+                store.state = store.state.update(
+                    package_config=store.state.package_config.update(description=description)
+                )
+    mock_write_atomic.assert_called_once()
+    assert PackageConfig.from_file(store.state.package_dir / 'dfu_config.json').description == 'Second'
@@ -0,0 +1,110 @@
+import io
+import json
+import subprocess
+from pathlib import Path
+from typing import Any, Generator
+from unittest.mock import patch
+
+import pytest
+
+from dfu.commands.batch import BatchEntry, _group_entries, parse_batch, run_batch, run_entry
+
+
+@pytest.fixture(autouse=True)
+def mock_sudo() -> Generator[None, None, None]:
+    with patch('dfu.commands.batch.validate_sudo'), patch('dfu.commands.batch.warm_up'):
+        yield
+
+
+def read_results(capsys: pytest.CaptureFixture[str]) -> list[dict[str, Any]]:
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_parse_batch() -> None:
+    batch = io.StringIO('{"args": ["ls-files", "--from", "1"]}\n\n{"args": ["diff"], "cwd": "package"}\n')
+    assert parse_batch(batch) == [
+        BatchEntry(args=('ls-files', '--from', '1')),
+        BatchEntry(args=('diff',), cwd='package'),
+    ]
+
+
+@pytest.mark.parametrize(
+    'line,message',
+    [
+        ('{"args": ["diff"]', 'Line 1 of the batch is invalid'),
+        ('{"cwd": "package"}', 'Line 1 of the batch is invalid'),
+        ('{"args": []}', "Line 1 of the batch doesn't have a command"),
+        ('{"args": ["shell"]}', "Line 1 of the batch runs dfu shell, which can't run in a batch"),
+    ],
+)
+def test_parse_invalid_batch(line: str, message: str) -> None:
+    with pytest.raises(ValueError, match=message):
+        parse_batch(io.StringIO(line))
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_run_batch(tmp_path: Path, jobs: int, capsys: pytest.CaptureFixture[str]) -> None:
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    batch = io.StringIO(
+        '\n'.join(
+            [
+                json.dumps({'args': ['ls-files'], 'cwd': str(tmp_path / 'a')}),
+                json.dumps({'args': ['diff'], 'cwd': str(tmp_path / 'b')}),
+                json.dumps({'args': ['ls-files', '--from', 'one'], 'cwd': str(tmp_path / 'a')}),
+            ]
+        )
+    )
+    assert not run_batch(batch, jobs=jobs)
+    results = read_results(capsys)
+    assert [(result['index'], result['args'], result['exit_code']) for result in results] == [
+        (0, ['ls-files'], 1),
+        (1, ['diff'], 1),
+        (2, ['ls-files', '--from', 'one'], 2),
+    ]
+    assert results[0]['stdout'] == 'No dfu_config.json found in the current directory or any parent directory\n'
+    assert "'one' is not a valid integer" in results[2]['stderr']
+
+
+def test_run_batch_success(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    with patch('dfu.commands.batch.run_command', return_value=0) as mock_run_command:
+        assert run_batch(io.StringIO('{"args": ["ls-files"]}\n{"args": ["diff"]}\n'), jobs=1)
+    assert mock_run_command.call_count == 2
+    assert [result['exit_code'] for result in read_results(capsys)] == [0, 0]
+
+
+def test_run_empty_batch(capsys: pytest.CaptureFixture[str]) -> None:
+    assert run_batch(io.StringIO(''), jobs=1)
+    assert capsys.readouterr().out == ''
+
+
+def test_run_entry_captures_subprocesses(capfd: pytest.CaptureFixture[str]) -> None:
+    def run_command(request: object, stdout: io.TextIOBase, stderr: io.TextIOBase) -> int:
+        stdout.write("Installing the packages\n")
+        # e.g. pacman, which writes to the inherited stdout
+        subprocess.run(['echo', 'installed'], check=True)
+        subprocess.run(['sh', '-c', 'echo warning >&2'], check=True)
+        return 0
+
+    with patch('dfu.commands.batch.run_command', side_effect=run_command):
+        result = run_entry(0, BatchEntry(args=('apply', '--force')))
+    assert result.stdout == 'Installing the packages\ninstalled\n'
+    assert result.stderr == 'warning\n'
+    assert capfd.readouterr() == ('', '')
+
+
+def test_group_entries(tmp_path: Path) -> None:
+    for package in ('a', 'b', 'c'):
+        (tmp_path / package).mkdir()
+    entries = [
+        BatchEntry(args=('diff',), cwd=str(tmp_path / 'a')),
+        BatchEntry(args=('apply', '--force'), cwd=str(tmp_path / 'b')),
+        BatchEntry(args=('apply', '--dry-run', '--force'), cwd=str(tmp_path / 'c')),
+        BatchEntry(args=('snap',), cwd=str(tmp_path / 'a')),
+        BatchEntry(args=('apply', '--abort'), cwd=str(tmp_path / 'c')),
+    ]
+    # The entries which write to the system run in one group, with the other entries of their packages
+    assert _group_entries(entries) == [
+        [(0, entries[0]), (1, entries[1]), (3, entries[3])],
+        [(2, entries[2]), (4, entries[4])],
+    ]
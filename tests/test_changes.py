@@ -11,7 +11,15 @@ import pytest
 from dfu.api import Store
 from dfu.package.acl_file import AclEntry
 from dfu.revision.git import DEFAULT_GITIGNORE
-from dfu.snapshots.changes import FilesModified, files_modified, filter_files, get_permissions
+from dfu.snapshots.changes import (
+    FilesModified,
+    SubtreeEntry,
+    files_modified,
+    filter_files,
+    find_subtree_roots,
+    get_permissions,
+    list_subtrees,
+)
 from dfu.snapshots.snapper import Snapper, SnapperName
 from dfu.snapshots.snapper_diff import FileChangeAction, SnapperDiff
 
@@ -56,13 +64,17 @@ def store_with_user_snapper(tmp_path: Path, request: pytest.FixtureRequest, setu
 class DeltaEntry:
     path: str
     action: FileChangeAction = FileChangeAction.created
+    permissions_changed: bool = False
 
 
 @contextmanager
 def mock_get_delta(responses: dict[str, list[DeltaEntry]]) -> Generator[MagicMock, None, None]:
     def side_effect(self: Any, pre_snapshot_id: int, post_snapshot_id: int) -> list[SnapperDiff]:
         response = responses[self.snapper_name]
-        return [SnapperDiff(path=entry.path, action=entry.action, permissions_changed=False) for entry in response]
+        return [
+            SnapperDiff(path=entry.path, action=entry.action, permissions_changed=entry.permissions_changed)
+            for entry in response
+        ]
 
     with patch.object(Snapper, "get_delta", autospec=True) as mock_get_delta:
         mock_get_delta.side_effect = side_effect
@@ -142,6 +154,21 @@ def test_files_modified_action_no_change(store: Store, mock_filter_files: MagicM
         assert result == {"root": FilesModified(pre_files=set(), post_files=set())}
 
 
+def test_files_modified_permissions_only(store: Store, mock_filter_files: MagicMock) -> None:
+    with mock_get_delta(
+        {
+            "root": [
+                DeltaEntry("/etc/fstab", FileChangeAction.no_change, permissions_changed=True),
+                DeltaEntry("/etc/hosts", FileChangeAction.modified, permissions_changed=True),
+            ]
+        }
+    ):
+        result = files_modified(store, from_index=0, to_index=1, only_ignored=False)
+        assert result == {
+            "root": FilesModified(pre_files={"/etc/hosts"}, post_files={"/etc/hosts"}, permission_files={"/etc/fstab"})
+        }
+
+
 @pytest.fixture
 def mock_proot() -> Generator[MagicMock, None, None]:
     def side_effect(cmd: list[str], *args: Any, **kwargs: Any) -> list[str]:
@@ -263,8 +290,8 @@ def test_get_permissions_empty_file_owned_by_user(
     result = get_permissions(
         store_with_user_snapper, files_modified={SnapperName("user"): set(["/user/file.txt"])}, snapshot_index=1
     )
-    expected_entry = AclEntry(Path("/user/file.txt"), "644", current_user, current_group)
-    assert result.entries[Path("/user/file.txt")] == expected_entry
+    expected_entry = AclEntry("/user/file.txt", "644", current_user, current_group)
+    assert result.entries["/user/file.txt"] == expected_entry
 
 
 def test_get_permissions_file_owned_by_user(
@@ -280,8 +307,8 @@ def test_get_permissions_file_owned_by_user(
     result = get_permissions(
         store_with_user_snapper, files_modified={SnapperName("user"): set(["/user/file.txt"])}, snapshot_index=1
     )
-    expected_entry = AclEntry(Path("/user/file.txt"), "644", current_user, current_group)
-    assert result.entries[Path("/user/file.txt")] == expected_entry
+    expected_entry = AclEntry("/user/file.txt", "644", current_user, current_group)
+    assert result.entries["/user/file.txt"] == expected_entry
 
 
 def test_get_permissions_symlink_owned_by_user(
@@ -302,8 +329,8 @@ def test_get_permissions_symlink_owned_by_user(
     result = get_permissions(
         store_with_user_snapper, files_modified={SnapperName("user"): set(["/user/symlink.txt"])}, snapshot_index=1
     )
-    expected_entry = AclEntry(Path("/user/symlink.txt"), "777", current_user, current_group)
-    assert result.entries[Path("/user/symlink.txt")] == expected_entry
+    expected_entry = AclEntry("/user/symlink.txt", "777", current_user, current_group)
+    assert result.entries["/user/symlink.txt"] == expected_entry
 
 
 def test_get_permission_subpath_owned_by_user(
@@ -327,14 +354,14 @@ def test_get_permission_subpath_owned_by_user(
         snapshot_index=1,
     )
     expected_entries = {
-        Path("/user/subpath/"): AclEntry(Path("/user/subpath/"), "766", current_user, current_group),
-        Path("/user/subpath/subpath2/"): AclEntry(Path("/user/subpath/subpath2/"), "766", current_user, current_group),
-        Path("/user/subpath/subpath2/file.txt"): AclEntry(
-            Path("/user/subpath/subpath2/file.txt"), "644", current_user, current_group
+        "/user/subpath": AclEntry("/user/subpath", "766", current_user, current_group),
+        "/user/subpath/subpath2": AclEntry("/user/subpath/subpath2", "766", current_user, current_group),
+        "/user/subpath/subpath2/file.txt": AclEntry(
+            "/user/subpath/subpath2/file.txt", "644", current_user, current_group
         ),
     }
-    for path, expected_entry in expected_entries.items():
-        assert result.entries[path] == expected_entry
+    for acl_path, expected_entry in expected_entries.items():
+        assert result.entries[acl_path] == expected_entry
 
 
 def test_get_permissions_setuid_setgid(
@@ -383,17 +410,15 @@ def test_get_permissions_setuid_setgid(
     )
 
     expected_entries = {
-        Path("/user/setgid_dir/"): AclEntry(Path("/user/setgid_dir/"), "2755", current_user, current_group),
-        Path("/user/setgid_file"): AclEntry(Path("/user/setgid_file"), "2755", current_user, current_group),
-        Path("/user/setuid_dir/"): AclEntry(Path("/user/setuid_dir/"), "4755", current_user, current_group),
-        Path("/user/setuid_file"): AclEntry(Path("/user/setuid_file"), "4755", current_user, current_group),
-        Path("/user/setuid_setgid_file"): AclEntry(
-            Path("/user/setuid_setgid_file"), "6755", current_user, current_group
-        ),
+        "/user/setgid_dir": AclEntry("/user/setgid_dir", "2755", current_user, current_group),
+        "/user/setgid_file": AclEntry("/user/setgid_file", "2755", current_user, current_group),
+        "/user/setuid_dir": AclEntry("/user/setuid_dir", "4755", current_user, current_group),
+        "/user/setuid_file": AclEntry("/user/setuid_file", "4755", current_user, current_group),
+        "/user/setuid_setgid_file": AclEntry("/user/setuid_setgid_file", "6755", current_user, current_group),
     }
 
-    for path, expected_entry in expected_entries.items():
-        assert result.entries[path] == expected_entry
+    for acl_path, expected_entry in expected_entries.items():
+        assert result.entries[acl_path] == expected_entry
 
 
 def test_get_permissions_multiple_roots(
@@ -424,10 +449,149 @@ def test_get_permissions_multiple_roots(
         snapshot_index=1,
     )
     expected_entries = {
-        Path("/root/subpath/"): AclEntry(Path("/root/subpath/"), "755", current_user, current_group),
-        Path("/root/subpath/test.txt"): AclEntry(Path("/root/subpath/test.txt"), "644", current_user, current_group),
-        Path("/user/subpath/"): AclEntry(Path("/user/subpath/"), "755", current_user, current_group),
-        Path("/user/subpath/test.txt"): AclEntry(Path("/user/subpath/test.txt"), "600", current_user, current_group),
+        "/root/subpath": AclEntry("/root/subpath", "755", current_user, current_group),
+        "/root/subpath/test.txt": AclEntry("/root/subpath/test.txt", "644", current_user, current_group),
+        "/user/subpath": AclEntry("/user/subpath", "755", current_user, current_group),
+        "/user/subpath/test.txt": AclEntry("/user/subpath/test.txt", "600", current_user, current_group),
+    }
+    for acl_path, expected_entry in expected_entries.items():
+        assert result.entries[acl_path] == expected_entry
+
+
+def test_find_subtree_roots() -> None:
+    deltas = [
+        SnapperDiff("/opt", FileChangeAction.modified, False),
+        SnapperDiff("/opt/tool", FileChangeAction.created, False),
+        SnapperDiff("/opt/tool/bin", FileChangeAction.created, False),
+        SnapperDiff("/opt/tool/bin/tool", FileChangeAction.created, False),
+        SnapperDiff("/opt/mixed", FileChangeAction.created, False),
+        SnapperDiff("/opt/mixed/new.txt", FileChangeAction.created, False),
+        SnapperDiff("/opt/mixed/nested", FileChangeAction.created, False),
+        SnapperDiff("/opt/mixed/nested/ignored.pyc", FileChangeAction.created, False),
+        SnapperDiff("/opt/mixed/nested/new.txt", FileChangeAction.created, False),
+        SnapperDiff("/opt/mixed/old.txt", FileChangeAction.modified, False),
+        SnapperDiff("/opt/empty", FileChangeAction.created, False),
+        SnapperDiff("/opt/old", FileChangeAction.deleted, False),
+        SnapperDiff("/opt/old/file.txt", FileChangeAction.deleted, False),
+    ]
+    ignored_files = {"/opt/mixed/nested/ignored.pyc"}
+    assert find_subtree_roots(deltas, ignored_files=ignored_files, action=FileChangeAction.created) == {"/opt/tool"}
+    assert find_subtree_roots(deltas, ignored_files=ignored_files, action=FileChangeAction.deleted) == {"/opt/old"}
+
+
+@pytest.fixture
+def mock_stat_and_find() -> Generator[MagicMock, None, None]:
+    original_subprocess_run = subprocess.run
+
+    def side_effect(cmd: list[str], *args: Any, **kwargs: Any) -> subprocess.CompletedProcess[str]:
+        if cmd[:2] in (["sudo", "stat"], ["sudo", "find"]):
+            return original_subprocess_run(cmd[1:], *args, **kwargs)
+        elif cmd[0] == "git":
+            return original_subprocess_run(cmd, *args, **kwargs)
+        raise ValueError(f"Unexpected subprocess.run call: {cmd}")
+
+    with patch("subprocess.run", side_effect=side_effect) as mock_run:
+        yield mock_run
+
+
+@pytest.fixture
+def subtree(tmp_path: Path, mock_snapper: MagicMock) -> set[str]:
+    root = tmp_path / "root" / "snapshot"
+    (root / "opt" / "tool" / "bin").mkdir(parents=True)
+    (root / "opt" / "tool" / "empty").mkdir()
+    (root / "opt" / "tool" / "bin").chmod(0o700)
+    (root / "opt" / "tool" / "bin" / "tool").write_text("tool")
+    (root / "opt" / "tool" / "bin" / "tool").chmod(0o4755)
+    (root / "opt" / "tool" / "README").write_text("readme")
+    (root / "opt" / "tool" / "link").symlink_to("README")
+    (root / "etc").mkdir()
+    (root / "etc" / "fstab").write_text("fstab")
+    return {"/root/opt/tool/bin/tool", "/root/opt/tool/README", "/root/opt/tool/link", "/root/etc/fstab"}
+
+
+def test_list_subtrees(
+    subtree: set[str], mock_snapper: MagicMock, mock_stat_and_find: MagicMock, current_user: str, current_group: str
+) -> None:
+    listing = list_subtrees(Snapper(SnapperName("root")), 2, {"/root/opt/tool"})
+    assert {path: entry.file_type for path, entry in listing.items()} == {
+        "/root/opt/tool": "d",
+        "/root/opt/tool/bin": "d",
+        "/root/opt/tool/empty": "d",
+        "/root/opt/tool/bin/tool": "f",
+        "/root/opt/tool/README": "f",
+        "/root/opt/tool/link": "l",
+    }
+    assert listing["/root/opt/tool/bin/tool"] == SubtreeEntry("f", "4755", current_user, current_group)
+    assert listing["/root/opt/tool/bin"] == SubtreeEntry("d", "700", current_user, current_group)
+
+
+def test_get_permissions_subtrees_match_per_file(
+    store: Store,
+    subtree: set[str],
+    mock_snapper: MagicMock,
+    mock_stat_and_find: MagicMock,
+    mock_filter_files: MagicMock,
+) -> None:
+    per_file = get_permissions(store, files_modified={SnapperName("root"): subtree}, snapshot_index=1)
+    mock_stat_and_find.reset_mock()
+    coalesced = get_permissions(
+        store,
+        files_modified={SnapperName("root"): subtree},
+        snapshot_index=1,
+        subtrees={SnapperName("root"): {"/root/opt/tool"}},
+    )
+    assert coalesced == per_file
+    commands = [call.args[0][1] for call in mock_stat_and_find.call_args_list]
+    # One find for the subtree, and stat for /root/etc/fstab, /root/etc, and /root/opt
+    assert commands.count("find") == 1
+    assert commands.count("stat") == 3
+
+
+def test_files_modified_coalesces_subtrees(
+    store: Store,
+    subtree: set[str],
+    mock_snapper: MagicMock,
+    mock_stat_and_find: MagicMock,
+    mock_filter_files: MagicMock,
+) -> None:
+    deltas = [
+        DeltaEntry("/root/opt/tool"),
+        DeltaEntry("/root/opt/tool/bin"),
+        DeltaEntry("/root/opt/tool/bin/tool"),
+        DeltaEntry("/root/opt/tool/empty"),
+        DeltaEntry("/root/opt/tool/README"),
+        DeltaEntry("/root/opt/tool/link"),
+        DeltaEntry("/root/etc/fstab", FileChangeAction.modified),
+    ]
+    with mock_get_delta({"root": deltas}):
+        result = files_modified(store, from_index=0, to_index=1, only_ignored=False)
+    assert result == {
+        "root": FilesModified(
+            pre_files={"/root/etc/fstab"},
+            post_files={"/root/opt/tool/bin/tool", "/root/opt/tool/README", "/root/opt/tool/link", "/root/etc/fstab"},
+            post_subtrees={"/root/opt/tool"},
+        )
     }
-    for path, expected_entry in expected_entries.items():
-        assert result.entries[path] == expected_entry
+    # Only the file outside of the subtree needs to be checked individually
+    assert mock_filter_files.call_args_list[1].args[2] == {"/root/etc/fstab"}
+
+
+def test_files_modified_does_not_coalesce_partial_subtrees(
+    store: Store,
+    subtree: set[str],
+    mock_snapper: MagicMock,
+    mock_stat_and_find: MagicMock,
+    mock_filter_files: MagicMock,
+) -> None:
+    # Snapper did not report /root/opt/tool/link (e.g. because of a snapper filter), so it must not be copied
+    deltas = [
+        DeltaEntry("/root/opt/tool"),
+        DeltaEntry("/root/opt/tool/bin"),
+        DeltaEntry("/root/opt/tool/bin/tool"),
+        DeltaEntry("/root/opt/tool/empty"),
+        DeltaEntry("/root/opt/tool/README"),
+    ]
+    with mock_get_delta({"root": deltas}):
+        result = files_modified(store, from_index=0, to_index=1, only_ignored=False)
+    assert result[SnapperName("root")].post_subtrees == set()
+    assert result[SnapperName("root")].post_files == {d.path for d in deltas}
@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from dfu.cli import main
+
+# Generous, so that slow CI machines don't fail. Importing every command used to take ~270ms
+STARTUP_BUDGET_US = 150_000
+HEAVY_MODULES = ('unidiff', 'msgspec', 'platformdirs', 'tomlkit', 'dfu.api', 'dfu.commands', 'dfu.snapshots')
+
+
+def import_times(statement: str) -> dict[str, int]:
+    """Returns the cumulative import time (in microseconds) of every module imported by the statement"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement], check=True, text=True, capture_output=True
+    )
+    times: dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_does_not_import_commands() -> None:
+    modules = import_times('import dfu.cli')
+    assert [module for module in modules if module.startswith(HEAVY_MODULES)] == []
+
+
+def test_cli_import_budget() -> None:
+    # Use the fastest of a few runs, to ignore noise from other processes
+    duration = min(import_times('import dfu.cli')['dfu.cli'] for _ in range(3))
+    assert duration < STARTUP_BUDGET_US
+
+
+def test_help() -> None:
+    result = CliRunner().invoke(main, ['--help'])
+    assert result.exit_code == 0
+    assert 'apply' in result.output
@@ -3,7 +3,7 @@ import tempfile
 import pytest
 from msgspec import DecodeError, ValidationError
 
-from dfu.config import Btrfs, Config
+from dfu.config import Btrfs, Config, LargeFiles
 from dfu.snapshots.snapper import SnapperName
 
 
@@ -68,3 +68,22 @@ def test_invalid_toml() -> None:
     toml = """{]"""
     with pytest.raises(DecodeError):
         Config.from_toml(toml)
+
+
+def test_large_files_defaults() -> None:
+    toml = """
+[btrfs]
+snapper_configs = ["/"]
+"""
+    assert Config.from_toml(toml).large_files == LargeFiles()
+
+
+def test_large_files() -> None:
+    toml = """
+[btrfs]
+snapper_configs = ["/"]
+[large_files]
+max_size = 1024
+binary = false
+"""
+    assert Config.from_toml(toml).large_files == LargeFiles(max_size=1024, binary=False)
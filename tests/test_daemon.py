@@ -0,0 +1,173 @@
+import io
+import multiprocessing
+import socketserver
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Generator
+from unittest.mock import patch
+
+import click
+import pytest
+
+from dfu.cli import main
+from dfu.daemon.client import run_in_daemon
+from dfu.daemon.protocol import PROTOCOL_VERSION, Reply, Request, read_frame, write_frame
+from dfu.daemon.server import _Handler, _sudo_authenticated, can_serve, serve
+
+
+@contextmanager
+def running_daemon(path: Path) -> Generator[Path, None, None]:
+    # The commands redirect sys.stdout, so the daemon runs in a forked process, which keeps the mocks
+    server = socketserver.UnixStreamServer(str(path), _Handler)
+    process = multiprocessing.get_context('fork').Process(target=server.serve_forever)
+    process.start()
+    try:
+        yield path
+    finally:
+        process.terminate()
+        process.join()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def mock_sudo() -> Generator[None, None, None]:
+    with patch('dfu.daemon.server._sudo_authenticated', return_value=True):
+        yield
+
+
+@pytest.fixture
+def daemon(tmp_path: Path) -> Generator[Path, None, None]:
+    with running_daemon(tmp_path / 'daemon.sock') as path:
+        yield path
+
+
+def fake_ls_files(*args: object, **kwargs: object) -> None:
+    click.echo("file.txt")
+    click.echo(click.style("Listed the files", fg="red"), err=True)
+
+
+def test_frame_round_trip() -> None:
+    f = io.BytesIO()
+    write_frame(f, Request(version=PROTOCOL_VERSION, args=('ls-files', '--from', '1'), cwd='/tmp'))
+    write_frame(f, Reply(stream='stdout', text='file.txt\n'))
+    f.seek(0)
+    assert read_frame(f, Request) == Request(version=PROTOCOL_VERSION, args=('ls-files', '--from', '1'), cwd='/tmp')
+    assert read_frame(f, Reply) == Reply(stream='stdout', text='file.txt\n')
+    assert read_frame(f, Reply) is None
+
+
+def test_read_truncated_frame() -> None:
+    f = io.BytesIO()
+    write_frame(f, Reply(exit_code=0))
+    assert read_frame(io.BytesIO(f.getvalue()[:-1]), Reply) is None
+
+
+@pytest.mark.parametrize(
+    'args,expected',
+    [
+        (['ls-files'], True),
+        (['ls-files', '--ignored', '--from', '2'], True),
+        (['diff'], True),
+        (['diff', '-i'], False),
+        (['apply', '--dry-run', '--force'], True),
+        (['apply', '--dry-run'], False),
+        (['apply', '-f'], False),
+        (['apply', '--dry-run', '-f', '-i'], False),
+        (['apply', '--dry-run', '-f', '--resume'], False),
+        (['init'], False),
+        (['--help'], False),
+        ([], False),
+    ],
+)
+def test_can_serve(args: list[str], expected: bool) -> None:
+    assert can_serve(args) == expected
+
+
+def test_run_in_daemon(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    with (
+        patch('dfu.commands.load_store.load_store'),
+        patch('dfu.commands.ls_files.ls_files', side_effect=fake_ls_files),
+        running_daemon(tmp_path / 'daemon.sock') as daemon,
+    ):
+        assert run_in_daemon(daemon, ['ls-files', '--from', '1']) == 0
+    captured = capsys.readouterr()
+    assert captured.out == 'file.txt\n'
+    # The client's stderr isn't a terminal, so the output isn't colored
+    assert captured.err == 'Listed the files\n'
+
+
+def test_run_in_daemon_error(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    with (
+        patch('dfu.commands.load_store.load_store', side_effect=ValueError('No dfu_config.json found')),
+        running_daemon(tmp_path / 'daemon.sock') as daemon,
+    ):
+        assert run_in_daemon(daemon, ['diff']) == 1
+    assert capsys.readouterr().out == 'No dfu_config.json found\n'
+
+
+def test_run_in_daemon_not_served(daemon: Path) -> None:
+    assert run_in_daemon(daemon, ['init']) is None
+
+
+def test_run_in_daemon_sudo_expired(tmp_path: Path) -> None:
+    # The CLI runs the command instead, since it can ask for the sudo password
+    with (
+        patch('dfu.daemon.server._sudo_authenticated', return_value=False),
+        running_daemon(tmp_path / 'daemon.sock') as daemon,
+    ):
+        assert run_in_daemon(daemon, ['ls-files']) is None
+
+
+@pytest.mark.parametrize(
+    'result,expected',
+    [
+        (subprocess.CompletedProcess([], 0), True),
+        (subprocess.CompletedProcess([], 1), False),
+        (FileNotFoundError(), True),
+    ],
+)
+def test_sudo_authenticated(result: subprocess.CompletedProcess[bytes] | Exception, expected: bool) -> None:
+    with patch('subprocess.run', side_effect=[result]) as mock_run:
+        assert _sudo_authenticated() == expected
+    assert mock_run.call_args[0][0] == ['sudo', '--non-interactive', '--validate']
+
+
+def test_run_in_daemon_not_running(tmp_path: Path) -> None:
+    assert run_in_daemon(tmp_path / 'daemon.sock', ['ls-files']) is None
+
+
+def test_run_in_daemon_stale_socket(daemon: Path, tmp_path: Path) -> None:
+    stale = tmp_path / 'stale.sock'
+    socketserver.UnixStreamServer(str(stale), _Handler).server_close()
+    assert run_in_daemon(stale, ['ls-files']) is None
+
+
+def test_serve_already_running(daemon: Path) -> None:
+    with patch('dfu.daemon.server.warm_up'), pytest.raises(ValueError, match='already running'):
+        serve(daemon)
+
+
+def test_cli_uses_daemon(tmp_path: Path) -> None:
+    (tmp_path / 'daemon.sock').touch()
+    with (
+        patch('dfu.daemon.socket_path', return_value=tmp_path / 'daemon.sock'),
+        patch('dfu.daemon.client.run_in_daemon', return_value=3) as mock_run_in_daemon,
+        patch('sys.argv', ['dfu', 'ls-files']),
+        pytest.raises(SystemExit) as e,
+    ):
+        main()
+    assert e.value.code == 3
+    mock_run_in_daemon.assert_called_once_with(tmp_path / 'daemon.sock', ['ls-files'])
+
+
+def test_cli_without_daemon(tmp_path: Path) -> None:
+    with (
+        patch.dict('os.environ', {'DFU_NO_DAEMON': '1'}),
+        patch('dfu.daemon.client.run_in_daemon') as mock_run_in_daemon,
+        patch('sys.argv', ['dfu', '--help']),
+        pytest.raises(SystemExit) as e,
+    ):
+        main()
+    assert e.value.code == 0
+    mock_run_in_daemon.assert_not_called()
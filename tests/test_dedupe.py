@@ -0,0 +1,188 @@
+import hashlib
+import os
+import subprocess
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Generator
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from dfu.api import Store
+from dfu.snapshots.changes import FilesModified
+from dfu.snapshots.dedupe import (
+    DedupeStats,
+    IdenticalPair,
+    _hash_files_privileged,
+    _stat_files_privileged,
+    find_identical_pairs,
+    hash_files,
+    remove_identical_files,
+    stat_files,
+)
+from dfu.snapshots.snapper import Snapper, SnapperName
+
+
+@pytest.fixture
+def pre_dir(tmp_path: Path) -> Path:
+    path = tmp_path / "pre"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def post_dir(tmp_path: Path) -> Path:
+    path = tmp_path / "post"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def store(store: Store, tmp_path: Path) -> Store:
+    store.state = store.state.update(
+        package_config=store.state.package_config.update(
+            snapshots=(
+                MappingProxyType({SnapperName("root"): 1}),
+                MappingProxyType({SnapperName("root"): 2}),
+            )
+        ),
+    )
+    return store
+
+
+@pytest.fixture
+def mock_snapper(pre_dir: Path, post_dir: Path) -> Generator[None, None, None]:
+    def get_snapshot_path(self: Snapper, snapshot_id: int) -> Path:
+        return pre_dir if snapshot_id == 1 else post_dir
+
+    with (
+        patch.object(Snapper, "get_mountpoint", new=lambda self: Path("/")),
+        patch.object(Snapper, "get_snapshot_path", new=get_snapshot_path),
+    ):
+        yield
+
+
+@pytest.fixture
+def mock_sudo() -> Generator[MagicMock, None, None]:
+    original_subprocess_run = subprocess.run
+
+    def side_effect(cmd: list[str], *args: Any, **kwargs: Any) -> subprocess.CompletedProcess[str]:
+        assert cmd[0] == "sudo"
+        return original_subprocess_run(cmd[1:], *args, **kwargs)
+
+    with patch("subprocess.run", side_effect=side_effect) as mock_run:
+        yield mock_run
+
+
+def write(path: Path, content: str, mode: int = 0o644) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    path.chmod(mode)
+    return path
+
+
+def test_hash_files(tmp_path: Path) -> None:
+    empty = write(tmp_path / "empty.txt", "")
+    full = write(tmp_path / "full.txt", "hello world")
+    missing = tmp_path / "missing.txt"
+    assert hash_files({empty, full, missing}) == {
+        empty: hashlib.sha256(b"").hexdigest(),
+        full: hashlib.sha256(b"hello world").hexdigest(),
+    }
+
+
+def test_stat_files(tmp_path: Path) -> None:
+    file = write(tmp_path / "file.txt", "hello", mode=0o600)
+    infos = stat_files({file, tmp_path / "missing.txt"})
+    assert list(infos.keys()) == [file]
+    assert infos[file].size == 5
+    assert infos[file].mode & 0o777 == 0o600
+    assert infos[file].uid == os.getuid()
+
+
+def test_find_identical_pairs_same_content(pre_dir: Path, post_dir: Path) -> None:
+    pair = (write(pre_dir / "file.txt", "hello"), write(post_dir / "file.txt", "hello"))
+    assert find_identical_pairs([pair]) == {pair: IdenticalPair(size=5, permissions_changed=False)}
+
+
+def test_find_identical_pairs_different_content_same_size(pre_dir: Path, post_dir: Path) -> None:
+    pair = (write(pre_dir / "file.txt", "hello"), write(post_dir / "file.txt", "world"))
+    assert find_identical_pairs([pair]) == {}
+
+
+def test_find_identical_pairs_different_size(pre_dir: Path, post_dir: Path) -> None:
+    pair = (write(pre_dir / "file.txt", "hello"), write(post_dir / "file.txt", "hello world"))
+    assert find_identical_pairs([pair]) == {}
+
+
+def test_find_identical_pairs_different_mode(pre_dir: Path, post_dir: Path) -> None:
+    pair = (write(pre_dir / "file.txt", "hello"), write(post_dir / "file.txt", "hello", mode=0o600))
+    assert find_identical_pairs([pair]) == {pair: IdenticalPair(size=5, permissions_changed=True)}
+
+
+def test_find_identical_pairs_missing_file(pre_dir: Path, post_dir: Path) -> None:
+    pair = (write(pre_dir / "file.txt", "hello"), post_dir / "file.txt")
+    assert find_identical_pairs([pair]) == {}
+
+
+def test_find_identical_pairs_symlinks(pre_dir: Path, post_dir: Path) -> None:
+    (pre_dir / "same").symlink_to("target")
+    (post_dir / "same").symlink_to("target")
+    (pre_dir / "different").symlink_to("target1")
+    (post_dir / "different").symlink_to("target2")
+    same = (pre_dir / "same", post_dir / "same")
+    different = (pre_dir / "different", post_dir / "different")
+    assert find_identical_pairs([same, different]) == {
+        same: IdenticalPair(size=len("target"), permissions_changed=False)
+    }
+
+
+def test_find_identical_pairs_type_changed(pre_dir: Path, post_dir: Path) -> None:
+    write(pre_dir / "file.txt", "target")
+    (post_dir / "file.txt").symlink_to("target")
+    assert find_identical_pairs([(pre_dir / "file.txt", post_dir / "file.txt")]) == {}
+
+
+def test_privileged_fallback(tmp_path: Path, mock_sudo: MagicMock) -> None:
+    file = write(tmp_path / "my file.txt", "hello")
+    other = write(tmp_path / "other.txt", "")
+    infos = _stat_files_privileged({file, other, tmp_path / "missing.txt"})
+    assert set(infos.keys()) == {file, other}
+    assert infos[file] == stat_files({file})[file]
+
+    assert _hash_files_privileged({file, other}) == hash_files({file, other})
+
+
+def test_remove_identical_files(store: Store, pre_dir: Path, post_dir: Path, mock_snapper: None) -> None:
+    write(pre_dir / "etc" / "same.txt", "same")
+    write(post_dir / "etc" / "same.txt", "same")
+    write(pre_dir / "etc" / "chmod.txt", "chmod")
+    write(post_dir / "etc" / "chmod.txt", "chmod", mode=0o600)
+    write(pre_dir / "etc" / "changed.txt", "before")
+    write(post_dir / "etc" / "changed.txt", "after")
+    write(post_dir / "etc" / "created.txt", "created")
+    write(pre_dir / "etc" / "deleted.txt", "deleted")
+
+    sources = {
+        SnapperName("root"): FilesModified(
+            pre_files={"/etc/same.txt", "/etc/chmod.txt", "/etc/changed.txt", "/etc/deleted.txt"},
+            post_files={"/etc/same.txt", "/etc/chmod.txt", "/etc/changed.txt", "/etc/created.txt"},
+            permission_files={"/etc/chown.txt"},
+        )
+    }
+    result, stats = remove_identical_files(store, from_index=0, to_index=1, sources=sources)
+    assert result == {
+        SnapperName("root"): FilesModified(
+            pre_files={"/etc/changed.txt", "/etc/deleted.txt"},
+            post_files={"/etc/changed.txt", "/etc/created.txt"},
+            permission_files={"/etc/chown.txt", "/etc/chmod.txt"},
+        )
+    }
+    assert stats == DedupeStats(files=2, bytes=2 * len("same") + 2 * len("chmod"))
+
+
+def test_remove_identical_files_no_candidates(store: Store) -> None:
+    sources = {SnapperName("root"): FilesModified(pre_files={"/etc/deleted.txt"}, post_files={"/etc/created.txt"})}
+    result, stats = remove_identical_files(store, from_index=0, to_index=1, sources=sources)
+    assert result == sources
+    assert stats == DedupeStats()
@@ -0,0 +1,93 @@
+from pathlib import Path
+from types import MappingProxyType
+from typing import Generator
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from dfu.snapshots.environment import Environment, environment_key, load_environment
+from dfu.snapshots.snapper import SnapperConfigInfo, SnapperName
+
+SNAPPER_CONFIGS = [
+    SnapperConfigInfo(name=SnapperName('root'), mountpoint=Path('/')),
+    SnapperConfigInfo(name=SnapperName('home'), mountpoint=Path('/home')),
+]
+
+
+@pytest.fixture
+def snapper_config_dir(tmp_path: Path) -> Generator[Path, None, None]:
+    config_dir = tmp_path / 'configs'
+    config_dir.mkdir()
+    (config_dir / 'root').write_text('SUBVOLUME="/"\n')
+    mountinfo = tmp_path / 'mountinfo'
+    mountinfo.write_text('22 1 0:21 / / rw,relatime - btrfs /dev/sda1 rw\n')
+    with (
+        patch('dfu.snapshots.environment.SNAPPER_CONFIG_PATHS', (config_dir,)),
+        patch('dfu.snapshots.environment.MOUNTINFO_PATH', mountinfo),
+    ):
+        yield config_dir
+
+
+@pytest.fixture
+def mock_resolve() -> Generator[tuple[MagicMock, MagicMock], None, None]:
+    with (
+        patch('dfu.snapshots.environment.Snapper.get_configs', return_value=SNAPPER_CONFIGS) as mock_get_configs,
+        patch('dfu.snapshots.environment.get_all_subvolumes', return_value=['/', '/home']) as mock_subvolumes,
+    ):
+        yield mock_get_configs, mock_subvolumes
+
+
+def test_load_environment(tmp_path: Path, snapper_config_dir: Path, mock_resolve: tuple[MagicMock, MagicMock]) -> None:
+    environment = load_environment(tmp_path / 'cache' / 'environment.json')
+    assert environment.mountpoints == MappingProxyType({'root': '/', 'home': '/home'})
+    assert environment.subvolumes == ('/', '/home')
+    assert environment.snapper_configs == SNAPPER_CONFIGS
+
+
+def test_load_environment_cached(
+    tmp_path: Path, snapper_config_dir: Path, mock_resolve: tuple[MagicMock, MagicMock]
+) -> None:
+    cache_path = tmp_path / 'environment.json'
+    assert load_environment(cache_path) == load_environment(cache_path)
+    for mock in mock_resolve:
+        mock.assert_called_once()
+
+
+def test_load_environment_snapper_config_changed(
+    tmp_path: Path, snapper_config_dir: Path, mock_resolve: tuple[MagicMock, MagicMock]
+) -> None:
+    cache_path = tmp_path / 'environment.json'
+    load_environment(cache_path)
+    (snapper_config_dir / 'home').write_text('SUBVOLUME="/home"\n')
+    load_environment(cache_path)
+    for mock in mock_resolve:
+        assert mock.call_count == 2
+
+
+def test_load_environment_mounts_changed(
+    tmp_path: Path, snapper_config_dir: Path, mock_resolve: tuple[MagicMock, MagicMock]
+) -> None:
+    cache_path = tmp_path / 'environment.json'
+    load_environment(cache_path)
+    with (tmp_path / 'mountinfo').open('a') as f:
+        f.write('23 22 0:22 /@home /home rw,relatime - btrfs /dev/sda1 rw\n')
+    load_environment(cache_path)
+    for mock in mock_resolve:
+        assert mock.call_count == 2
+
+
+def test_load_environment_corrupted_cache(
+    tmp_path: Path, snapper_config_dir: Path, mock_resolve: tuple[MagicMock, MagicMock]
+) -> None:
+    cache_path = tmp_path / 'environment.json'
+    cache_path.write_text('{"key": ')
+    assert load_environment(cache_path).subvolumes == ('/', '/home')
+    assert Environment.from_file(cache_path).key == environment_key()
+
+
+def test_load_environment_unwritable_cache(
+    tmp_path: Path, snapper_config_dir: Path, mock_resolve: tuple[MagicMock, MagicMock]
+) -> None:
+    # The cache directory can't be created, since its parent is a file
+    (tmp_path / 'file').touch()
+    assert load_environment(tmp_path / 'file' / 'environment.json').subvolumes == ('/', '/home')
@@ -12,17 +12,32 @@ from dfu.revision.git import (
     git_add,
     git_add_remote,
     git_apply,
+    git_apply_check,
     git_are_files_staged,
     git_bundle,
+    git_changed_files,
     git_check_ignore,
+    git_checkout_paths,
     git_commit,
     git_diff,
+    git_diff_name_status,
+    git_enable_rerere,
     git_fetch,
+    git_fetch_head,
+    git_grep_staged,
     git_init,
     git_ls_files,
     git_num_commits,
+    git_rerere,
+    git_rerere_remaining,
+    git_reset_hard,
+    git_rev_parse,
+    git_rm,
+    git_show,
+    git_show_staged,
     git_stash,
     git_stash_pop,
+    git_write_tree,
 )
 
 
@@ -195,6 +210,68 @@ index e69de29..b6fc4c6 100644
     )
 
 
+def test_git_diff_binary(tmp_path: Path) -> None:
+    (tmp_path / 'file.bin').write_bytes(b'\0binary')
+    git_add(tmp_path, ['file.bin'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'file.bin').write_bytes(b'\0changed')
+    git_add(tmp_path, ['file.bin'])
+    git_commit(tmp_path, 'Changed')
+    assert 'GIT binary patch' in git_diff(tmp_path, "HEAD~1", "HEAD")
+
+
+def test_git_grep_staged(tmp_path: Path) -> None:
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'match.txt').write_text('first\nneedle here\n')
+    (tmp_path / 'dir' / 'other.txt').write_text('nothing\n')
+    (tmp_path / 'unstaged.txt').write_text('needle\n')
+    git_add(tmp_path, ['dir'])
+    assert git_grep_staged(tmp_path, 'needle', ['dir']) == [('dir/match.txt', 'needle here')]
+    assert git_grep_staged(tmp_path, 'missing', ['dir']) == []
+
+
+def test_git_show_staged(tmp_path: Path) -> None:
+    (tmp_path / 'file.txt').write_text('hello\nworld\n')
+    (tmp_path / 'my file.bin').write_bytes(b'\0\n\0')
+    (tmp_path / 'empty.txt').touch()
+    git_add(tmp_path, ['.'])
+    assert git_show_staged(tmp_path, ['file.txt', 'missing.txt', 'my file.bin', 'empty.txt']) == {
+        'file.txt': b'hello\nworld\n',
+        'my file.bin': b'\0\n\0',
+        'empty.txt': b'',
+    }
+    assert git_show_staged(tmp_path, []) == {}
+
+
+def test_git_changed_files(tmp_path: Path) -> None:
+    (tmp_path / 'unchanged.txt').write_text('same')
+    (tmp_path / 'modified.txt').write_text('before')
+    (tmp_path / 'deleted.txt').write_text('deleted')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'modified.txt').write_text('after')
+    (tmp_path / 'deleted.txt').unlink()
+    (tmp_path / 'staged.txt').write_text('staged')
+    git_add(tmp_path, ['staged.txt'])
+    (tmp_path / 'my untracked.txt').write_text('untracked')
+    assert sorted(git_changed_files(tmp_path, 'HEAD')) == [
+        'deleted.txt',
+        'modified.txt',
+        'my untracked.txt',
+        'staged.txt',
+    ]
+
+
+def test_git_show(tmp_path: Path) -> None:
+    (tmp_path / 'file.txt').write_text('before')
+    git_add(tmp_path, ['file.txt'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'file.txt').write_text('after')
+    assert git_show(tmp_path, 'HEAD', 'file.txt') == 'before'
+    with pytest.raises(subprocess.CalledProcessError):
+        git_show(tmp_path, 'HEAD', 'missing.txt')
+
+
 def test_git_no_files_are_staged(tmp_path: Path) -> None:
     assert not git_are_files_staged(tmp_path)
 
@@ -211,6 +288,128 @@ def test_git_files_are_staged_error(tmp_path: Path) -> None:
         git_are_files_staged(tmp_path)
 
 
+def test_git_rerere(tmp_path: Path) -> None:
+    cache_dir = tmp_path / 'rr-cache'
+    patch_file = tmp_path / 'changes.patch'
+    (tmp_path / 'file.txt').write_text('first\nhello\nlast\n')
+    git_add(tmp_path, ['file.txt'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'file.txt').write_text('first\nworld\nlast\n')
+    patch_file.write_text(
+        subprocess.run(['git', 'diff', '--full-index'], cwd=tmp_path, text=True, capture_output=True, check=True).stdout
+    )
+    base_blob = subprocess.run(
+        ['git', 'rev-parse', 'HEAD:file.txt'], cwd=tmp_path, text=True, capture_output=True, check=True
+    ).stdout.strip()
+
+    def conflicting_repo(name: str) -> Path:
+        repo = tmp_path / name
+        repo.mkdir()
+        git_init(repo)
+        subprocess.run(['git', 'config', 'user.name', 'myself'], cwd=repo, check=True)
+        subprocess.run(['git', 'config', 'user.email', 'me@example.com'], cwd=repo, check=True)
+        subprocess.run(['git', 'fetch', '-q', str(tmp_path), 'HEAD'], cwd=repo, check=True, capture_output=True)
+        (repo / 'file.txt').write_text('first\ndrift\nlast\n')
+        git_add(repo, ['file.txt'])
+        git_commit(repo, 'Drift')
+        git_enable_rerere(repo, cache_dir)
+        assert subprocess.run(['git', 'cat-file', '-e', base_blob], cwd=repo).returncode == 0
+        assert not git_apply(repo, patch_file)
+        return repo
+
+    first = conflicting_repo('first')
+    assert git_rerere_remaining(first) == ['file.txt']
+    (first / 'file.txt').write_text('first\nresolved\nlast\n')
+    git_rerere(first)
+
+    second = conflicting_repo('second')
+    assert git_rerere_remaining(second) == []
+    assert (second / 'file.txt').read_text() == 'first\nresolved\nlast\n'
+
+
+def test_git_reset_hard(tmp_path: Path) -> None:
+    (tmp_path / 'file.txt').write_text('before')
+    git_add(tmp_path, ['file.txt'])
+    git_commit(tmp_path, 'Initial commit')
+    commit = git_rev_parse(tmp_path, 'HEAD')
+    assert len(commit) == 40
+
+    (tmp_path / 'file.txt').write_text('after')
+    git_add(tmp_path, ['file.txt'])
+    git_commit(tmp_path, 'Changed file.txt')
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'untracked.txt').touch()
+    git_reset_hard(tmp_path, commit)
+    assert git_rev_parse(tmp_path, 'HEAD') == commit
+    assert (tmp_path / 'file.txt').read_text() == 'before'
+    assert not (tmp_path / 'dir').exists()
+
+
+def test_git_fetch_head(tmp_path: Path) -> None:
+    source = tmp_path / 'source'
+    source.mkdir()
+    git_init(source)
+    subprocess.run(['git', 'config', 'user.name', 'myself'], cwd=source, check=True)
+    subprocess.run(['git', 'config', 'user.email', 'me@example.com'], cwd=source, check=True)
+    (source / 'file.txt').write_text('hello')
+    git_add(source, ['file.txt'])
+    git_commit(source, 'Initial commit')
+    git_bundle(source, tmp_path / 'source.pack')
+
+    commit = git_fetch_head(tmp_path, str(tmp_path / 'source.pack'))
+    assert commit == git_rev_parse(source, 'HEAD')
+    assert git_show(tmp_path, commit, 'file.txt') == 'hello'
+    # No refs are created, so the fetched commits aren't part of the repository's history
+    assert subprocess.run(['git', 'branch', '-a'], cwd=tmp_path, text=True, capture_output=True).stdout == ''
+
+
+def test_git_diff_name_status(tmp_path: Path) -> None:
+    (tmp_path / 'modified.txt').write_text('before')
+    (tmp_path / 'deleted.txt').write_text('deleted')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'modified.txt').write_text('after')
+    (tmp_path / 'deleted.txt').unlink()
+    (tmp_path / 'my added.txt').write_text('deleted')
+    git_add(tmp_path, ['-A', '.'])
+    git_commit(tmp_path, 'Changed files')
+    assert git_diff_name_status(tmp_path, 'HEAD~1', 'HEAD') == [
+        ('D', 'deleted.txt'),
+        ('M', 'modified.txt'),
+        ('A', 'my added.txt'),
+    ]
+
+
+def test_git_checkout_paths_and_rm(tmp_path: Path) -> None:
+    (tmp_path / 'file[1].txt').write_text('before')
+    (tmp_path / 'other.txt').write_text('before')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'file[1].txt').write_text('after')
+    (tmp_path / 'other.txt').write_text('after')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Changed files')
+
+    git_checkout_paths(tmp_path, 'HEAD~1', ['file[1].txt'])
+    assert (tmp_path / 'file[1].txt').read_text() == 'before'
+    assert (tmp_path / 'other.txt').read_text() == 'after'
+    git_rm(tmp_path, ['file[1].txt'])
+    assert not (tmp_path / 'file[1].txt').exists()
+    git_checkout_paths(tmp_path, 'HEAD', [])
+    git_rm(tmp_path, [])
+
+
+def test_git_write_tree(tmp_path: Path) -> None:
+    (tmp_path / 'file.txt').write_text('hello')
+    git_add(tmp_path, ['file.txt'])
+    git_commit(tmp_path, 'Initial commit')
+    assert git_write_tree(tmp_path) == git_rev_parse(tmp_path, 'HEAD^{tree}')
+    (tmp_path / 'untracked.txt').write_text('untracked')
+    tree = git_write_tree(tmp_path)
+    assert tree != git_rev_parse(tmp_path, 'HEAD^{tree}')
+    assert git_show(tmp_path, tree, 'untracked.txt') == 'untracked'
+
+
 def test_git_stash(tmp_path: Path) -> None:
     (tmp_path / '.gitignore').touch()
     git_add(tmp_path, ['.gitignore'])
@@ -246,6 +445,51 @@ def test_git_apply(tmp_path: Path) -> None:
     assert (tmp_path / 'file.txt').read_text() == 'hello'
 
 
+def test_git_apply_check(tmp_path: Path) -> None:
+    (tmp_path / 'file.txt').write_text('hello\n')
+    (tmp_path / 'other.txt').write_text('hello\n')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'file.txt').write_text('goodbye\n')
+    (tmp_path / 'other.txt').write_text('goodbye\n')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Changed the files')
+    (tmp_path / 'changes.patch').write_text(git_diff(tmp_path, "HEAD~1", "HEAD"))
+    (tmp_path / 'file.txt').write_text('conflict\n')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Changed the file again')
+
+    error = git_apply_check(tmp_path, tmp_path / 'changes.patch', reverse=True)
+    assert error is not None and 'U file.txt' in error
+    assert git_apply_check(tmp_path, tmp_path / 'changes.patch', reverse=True, exclude=['file.txt']) is None
+    # The patch was already applied to other.txt, which merges cleanly
+    assert git_apply_check(tmp_path, tmp_path / 'changes.patch', exclude=['file.txt']) is None
+    # Nothing was modified
+    assert (tmp_path / 'file.txt').read_text() == 'conflict\n'
+    assert git_changed_files(tmp_path, 'HEAD') == []
+    assert not git_are_files_staged(tmp_path)
+
+
+def test_git_apply_check_three_way(tmp_path: Path) -> None:
+    lines = [f'line {i}\n' for i in range(10)]
+    (tmp_path / 'file.txt').write_text(''.join(lines))
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'file.txt').write_text(''.join([*lines[:2], 'patched\n', *lines[3:]]))
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Patched the file')
+    diff = git_diff(tmp_path, "HEAD~1", "HEAD")
+    git_reset_hard(tmp_path, 'HEAD~1')
+    # The context of the patch changed, so it only applies with a 3-way merge, like git_apply does
+    (tmp_path / 'file.txt').write_text(''.join([*lines[:4], 'changed\n', *lines[5:]]))
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Changed the context')
+    (tmp_path / 'changes.patch').write_text(diff)
+
+    assert git_apply_check(tmp_path, tmp_path / 'changes.patch') is None
+    assert git_apply(tmp_path, tmp_path / 'changes.patch')
+
+
 def test_git_apply_with_conflict(tmp_path: Path) -> None:
     (tmp_path / '.gitignore').touch()
     git_add(tmp_path, ['.gitignore'])
@@ -2,6 +2,7 @@ import json
 from dataclasses import dataclass
 from pathlib import Path
 from types import MappingProxyType
+from unittest.mock import patch
 
 import msgspec
 import pytest
@@ -62,6 +63,21 @@ def test_write_exclusive_fails_if_file_exists(tmp_path: Path) -> None:
         dog.write(tmp_path / "dog.json", mode="x")
 
 
+def test_write_atomic(tmp_path: Path) -> None:
+    (tmp_path / "dog.json").write_text("old content")
+    Dog(name="Ash", age=3).write_atomic(tmp_path / "dog.json")
+    assert Dog.from_file(tmp_path / "dog.json") == Dog(name="Ash", age=3)
+    assert [path.name for path in tmp_path.iterdir()] == ["dog.json"]
+
+
+def test_write_atomic_keeps_old_content_on_error(tmp_path: Path) -> None:
+    (tmp_path / "dog.json").write_text("old content")
+    with patch("os.replace", side_effect=OSError), pytest.raises(OSError):
+        Dog(name="Ash", age=3).write_atomic(tmp_path / "dog.json")
+    assert (tmp_path / "dog.json").read_text() == "old content"
+    assert [path.name for path in tmp_path.iterdir()] == ["dog.json"]
+
+
 def test_mapping_proxy(tmp_path: Path) -> None:
     @dataclass
     class Inner(JsonSerializableMixin):
@@ -0,0 +1,33 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from dfu.commands.load_store import find_package_dir, load_store
+from dfu.config import Config
+from dfu.package.package_config import PackageConfig
+
+
+@pytest.fixture
+def package_dir(tmp_path: Path, package_config: PackageConfig) -> Path:
+    package_dir = tmp_path / 'package'
+    package_dir.mkdir()
+    package_config.write(package_dir / 'dfu_config.json')
+    return package_dir
+
+
+def test_load_store_resolves_package_dir(package_dir: Path, config: Config, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(package_dir.parent)
+    with (
+        patch('dfu.commands.load_store.load_config', return_value=config),
+        patch('dfu.commands.load_store.load_plugins', side_effect=lambda store: store),
+    ):
+        store = load_store(Path('package'))
+    # e.g. dfu apply --resume is run from another directory
+    assert store.state.package_dir == package_dir
+
+
+def test_find_package_dir_current_directory(package_dir: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (package_dir / 'subdir').mkdir()
+    monkeypatch.chdir(package_dir / 'subdir')
+    assert find_package_dir() == package_dir
@@ -0,0 +1,96 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+
+from dfu.config import LargeFiles
+from dfu.package.objects import ObjectPointer, ObjectStore, should_externalize
+
+
+@pytest.fixture
+def objects(tmp_path: Path) -> ObjectStore:
+    return ObjectStore(tmp_path / "objects")
+
+
+def test_pointer_round_trip() -> None:
+    pointer = ObjectPointer(digest=hashlib.sha256(b"hello").hexdigest(), size=5)
+    assert ObjectPointer.from_string(pointer.encode()) == pointer
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "",
+        "hello world\n",
+        "dfu-object sha256:abc size 5\n",
+        f"dfu-object sha256:{'a' * 64} size 5\nanother line\n",
+    ],
+)
+def test_pointer_from_string_invalid(content: str) -> None:
+    assert ObjectPointer.from_string(content) is None
+
+
+def test_pointer_from_file(tmp_path: Path) -> None:
+    pointer = ObjectPointer(digest="a" * 64, size=5)
+    file = tmp_path / "file"
+    file.write_text(pointer.encode())
+    assert ObjectPointer.from_file(file) == pointer
+    assert ObjectPointer.from_file(tmp_path / "missing") is None
+    file.write_bytes(b"\xff" * 10)
+    assert ObjectPointer.from_file(file) is None
+
+
+def test_add_and_restore(tmp_path: Path, objects: ObjectStore) -> None:
+    file = tmp_path / "file.bin"
+    file.write_bytes(b"\0" * 3_000_000)
+    pointer = objects.add(file)
+    assert pointer == ObjectPointer(digest=hashlib.sha256(file.read_bytes()).hexdigest(), size=3_000_000)
+    assert objects.contains(pointer)
+    assert objects.object_path(pointer.digest) == tmp_path / "objects" / pointer.digest[:2] / pointer.digest[2:]
+    assert [p for p in objects.root.glob("**/*") if p.is_file()] == [objects.object_path(pointer.digest)]
+
+    # Adding the same content twice is a no-op
+    assert objects.add(file) == pointer
+
+    dest = tmp_path / "restored.bin"
+    objects.restore(pointer, dest)
+    assert dest.read_bytes() == file.read_bytes()
+
+
+def test_restore_missing(tmp_path: Path, objects: ObjectStore) -> None:
+    pointer = ObjectPointer(digest="a" * 64, size=5)
+    assert not objects.contains(pointer)
+    with pytest.raises(ValueError, match="missing"):
+        objects.restore(pointer, tmp_path / "dest")
+
+
+def test_restore_corrupt(tmp_path: Path, objects: ObjectStore) -> None:
+    file = tmp_path / "file.txt"
+    file.write_text("hello")
+    pointer = objects.add(file)
+    objects.object_path(pointer.digest).chmod(0o644)
+    objects.object_path(pointer.digest).write_text("corrupted")
+    with pytest.raises(ValueError, match="corrupt"):
+        objects.restore(pointer, tmp_path / "dest")
+
+
+def test_should_externalize(tmp_path: Path) -> None:
+    large_files = LargeFiles(max_size=10, binary=True)
+    small = tmp_path / "small.txt"
+    small.write_text("small")
+    large = tmp_path / "large.txt"
+    large.write_text("this is a large file")
+    binary = tmp_path / "binary"
+    binary.write_bytes(b"a\0b")
+    link = tmp_path / "link"
+    link.symlink_to(large)
+    pointer = tmp_path / "pointer"
+    pointer.write_text(ObjectPointer(digest="a" * 64, size=100).encode())
+
+    assert not should_externalize(small, large_files)
+    assert should_externalize(large, large_files)
+    assert should_externalize(binary, large_files)
+    assert not should_externalize(binary, LargeFiles(max_size=10, binary=False))
+    assert not should_externalize(link, large_files)
+    assert not should_externalize(pointer, large_files)
+    assert not should_externalize(tmp_path, large_files)
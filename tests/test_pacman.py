@@ -2,8 +2,8 @@ from contextlib import contextmanager
 from itertools import product
 from pathlib import Path
 from types import MappingProxyType
-from typing import Any, Generator
-from unittest.mock import Mock, patch
+from typing import Generator
+from unittest.mock import Mock, call, patch
 
 import pytest
 
@@ -16,8 +16,9 @@ from dfu.api.plugin import (
 from dfu.config import Config
 from dfu.package.package_config import PackageConfig
 from dfu.plugins.pacman import PacmanPlugin
-from dfu.snapshots.proot import proot
-from dfu.snapshots.snapper import Snapper, SnapperName
+from dfu.plugins.pacman_db import InstalledPackage, _snapshot_packages
+from dfu.snapshots.environment import Environment
+from dfu.snapshots.snapper import SnapperName
 
 
 @pytest.fixture
@@ -42,91 +43,96 @@ def store(config: Config) -> Store:
     return store
 
 
+@contextmanager
+def mock_environment(mountpoints: dict[str, Path]) -> Generator[None, None, None]:
+    environment = Environment(
+        key='key', mountpoints=MappingProxyType({name: str(path) for name, path in mountpoints.items()}), subvolumes=()
+    )
+    with patch('dfu.plugins.pacman_db.load_environment', return_value=environment):
+        yield
+
+
 @pytest.fixture(autouse=True)
-def mock_get_mountpoint() -> Generator[None, None, None]:
-    with patch.object(Snapper, 'get_mountpoint', new=lambda self: Path(f"/{self.snapper_name}")):
+def mock_mountpoints() -> Generator[None, None, None]:
+    with mock_environment({'root': Path('/root'), 'home': Path('/home')}):
         yield
 
 
+def snapshot_dir(mountpoint: Path, snapshot_id: int) -> Path:
+    return mountpoint / '.snapshots' / str(snapshot_id) / 'snapshot'
+
+
 @contextmanager
 def mock_subprocess_run(installed_packages: set[str] | None = None) -> Generator[Mock, None, None]:
-    def side_effect(*args: Any, **kwargs: Any) -> Mock:
-        if args[0][:-1] == ['pacman', '-Q']:
-            if installed_packages is not None and args[0][-1] in installed_packages:
-                return Mock(returncode=0)
-            else:
-                return Mock(returncode=1)
-        return Mock()  # Default case
-
-    with patch('subprocess.run') as mock_run:
-        mock_run.side_effect = side_effect
+    local_db = {
+        package: InstalledPackage(name=package, version='1.0-1', explicit=True) for package in installed_packages or ()
+    }
+    with patch('subprocess.run') as mock_run, patch('dfu.plugins.pacman.read_local_db', return_value=local_db):
         yield mock_run
 
 
+def write_local_db(db_dir: Path, packages: dict[str, bool]) -> None:
+    db_dir.mkdir(parents=True)
+    (db_dir / 'ALPM_DB_VERSION').write_text('9\n')
+    for name, explicit in packages.items():
+        (db_dir / f"{name}-1.0-1").mkdir()
+        reason = '' if explicit else '%REASON%\n1\n\n'
+        (db_dir / f"{name}-1.0-1" / 'desc').write_text(
+            f"%NAME%\n{name}\n\n%VERSION%\n1.0-1\n\n%ARCH%\nx86_64\n\n{reason}"
+        )
+
+
+@pytest.fixture(autouse=True)
+def clear_snapshot_cache() -> Generator[None, None, None]:
+    yield
+    _snapshot_packages.cache_clear()
+
+
 @contextmanager
-def mock_proot(store: Store, before: str, after: str) -> Generator[None, None, None]:
-    before_args = proot(['pacman', '-Qqe'], config=store.state.config, snapshot=store.state.package_config.snapshots[0])
-    after_args = proot(['pacman', '-Qqe'], config=store.state.config, snapshot=store.state.package_config.snapshots[1])
-
-    def side_effect(*args: Any, **kwargs: Any) -> Mock:
-        if args[0] == before_args:
-            return Mock(returncode=0, stdout=before)
-        elif args[0] == after_args:
-            return Mock(returncode=0, stdout=after)
-        else:
-            raise ValueError(f"Unexpected args: {args}")
+def mock_snapshots(tmp_path: Path, before: str, after: str) -> Generator[None, None, None]:
+    # Snapshot 1 is the before snapshot, and snapshot 2 is the after snapshot
+    for snapshot_id, packages in ((1, before), (2, after)):
+        db_dir = snapshot_dir(tmp_path, snapshot_id) / 'var' / 'lib' / 'pacman' / 'local'
+        write_local_db(db_dir, {package: True for package in packages.split()})
 
-    with patch('subprocess.run') as mock_run:
-        mock_run.side_effect = side_effect
+    with mock_environment({'root': tmp_path, 'home': tmp_path}):
         yield
 
 
-def test_one_package_added(store: Store) -> None:
+def test_one_package_added(tmp_path: Path, store: Store) -> None:
     before = 'package1\npackage2\npackage3\n'
     after = 'package1\nnew_package\npackage2\npackage3\n'
-    with mock_proot(store, before, after):
+    with mock_snapshots(tmp_path, before, after):
         store.dispatch(UpdateInstalledDependenciesEvent(from_index=0, to_index=1))
     assert store.state.package_config.programs_added == ('new_package',)
 
 
-def test_trims_whitespace(store: Store) -> None:
-    after = '''
-package1
-package3
-package2
-      
-    leading_whitespace
-    leading_and_trailing_whitespace    
-'''
-    with mock_proot(store, '', after):
+def test_ignores_dependencies(tmp_path: Path, store: Store) -> None:
+    for snapshot_id, packages in ((1, {'package1': True}), (2, {'package1': True, 'package2': False})):
+        write_local_db(snapshot_dir(tmp_path, snapshot_id) / 'var' / 'lib' / 'pacman' / 'local', packages)
+    with mock_environment({'root': tmp_path, 'home': tmp_path}):
         store.dispatch(UpdateInstalledDependenciesEvent(from_index=0, to_index=1))
-    assert store.state.package_config.programs_added == (
-        'leading_and_trailing_whitespace',
-        'leading_whitespace',
-        'package1',
-        'package2',
-        'package3',
-    )
+    assert store.state.package_config.programs_added == tuple()
 
 
-def test_no_packages_added(store: Store) -> None:
+def test_no_packages_added(tmp_path: Path, store: Store) -> None:
     before = 'package1\npackage2\npackage3\n'
     after = 'package1\npackage2\npackage3\n'
-    with mock_proot(store, before, after):
+    with mock_snapshots(tmp_path, before, after):
         store.dispatch(UpdateInstalledDependenciesEvent(from_index=0, to_index=1))
     assert store.state.package_config.programs_added == tuple()
 
 
-def test_packages_added_and_removed(store: Store) -> None:
+def test_packages_added_and_removed(tmp_path: Path, store: Store) -> None:
     before = 'package1\npackage2\npackage3\n'
     after = 'package1\npackage3\npackage4\n'
-    with mock_proot(store, before, after):
+    with mock_snapshots(tmp_path, before, after):
         store.dispatch(UpdateInstalledDependenciesEvent(from_index=0, to_index=1))
     assert store.state.package_config.programs_added == ('package4',)
     assert store.state.package_config.programs_removed == ('package2',)
 
 
-def test_appends_to_existing_updates(store: Store) -> None:
+def test_appends_to_existing_updates(tmp_path: Path, store: Store) -> None:
     store.state = store.state.update(
         package_config=store.state.package_config.update(
             programs_added=('package1', 'other_new_package'), programs_removed=('package_removed',)
@@ -134,7 +140,7 @@ def test_appends_to_existing_updates(store: Store) -> None:
     )
     before = 'package1\npackage2\npackage3\n'
     after = 'package1\nnew_package\n\npackage3\n'
-    with mock_proot(store, before, after):
+    with mock_snapshots(tmp_path, before, after):
         store.dispatch(UpdateInstalledDependenciesEvent(from_index=0, to_index=1))
     assert store.state.package_config.programs_added == ('new_package', 'other_new_package', 'package1')
     assert store.state.package_config.programs_removed == ('package2', 'package_removed')
@@ -193,12 +199,9 @@ def test_remove_and_install_a_dependency_skips_if_none_installed(store: Store) -
     )
     with mock_subprocess_run(installed_packages={'not_package3', 'not_package4'}) as mock_run:
         store.dispatch(InstallDependenciesEvent(confirm=False, dry_run=False))
-        assert mock_run.call_count == 3
-        mock_run.assert_any_call(
+        mock_run.assert_called_once_with(
             ['sudo', 'pacman', '-S', '--needed', '--noconfirm', 'package1', 'package2'], check=True
         )
-        mock_run.assert_any_call(['pacman', '-Q', 'package3'], capture_output=True, text=True)
-        mock_run.assert_any_call(['pacman', '-Q', 'package4'], capture_output=True, text=True)
 
 
 @pytest.mark.parametrize(
@@ -269,9 +272,7 @@ def test_uninstall_dependencies_skips_if_none_are_installed(store: Store) -> Non
     )
     with mock_subprocess_run(installed_packages={'some_other_package', 'another_different_package'}) as mock_run:
         store.dispatch(UninstallDependenciesEvent(confirm=False, dry_run=False))
-        assert mock_run.call_count == 2
-        mock_run.assert_any_call(['pacman', '-Q', 'package1'], capture_output=True, text=True)
-        mock_run.assert_any_call(['pacman', '-Q', 'package2'], capture_output=True, text=True)
+        mock_run.assert_not_called()
 
 
 def test_uninstall_and_readd_a_dependency(store: Store) -> None:
@@ -308,9 +309,7 @@ def test_uninstall_flags(mock_confirm: Mock, store: Store, confirm: bool, dry_ru
         else:
             mock_confirm.assert_not_called()
         if dry_run:
-            assert mock_run.call_count == 2
-            mock_run.assert_any_call(['pacman', '-Q', 'package1'], capture_output=True, text=True)
-            mock_run.assert_any_call(['pacman', '-Q', 'package2'], capture_output=True, text=True)
+            mock_run.assert_not_called()
         else:
             mock_run.assert_any_call(['sudo', 'pacman', '-R', '--noconfirm', 'package1', 'package2'], check=True)
 
@@ -324,6 +323,137 @@ def test_uninstall_confirm_no(mock_confirm: Mock, store: Store) -> None:
     with mock_subprocess_run(installed_packages={'package1', 'package2'}) as mock_run:
         store.dispatch(UninstallDependenciesEvent(confirm=True, dry_run=False))
         mock_confirm.assert_called_once()
-        assert mock_run.call_count == 2
-        mock_run.assert_any_call(['pacman', '-Q', 'package1'], capture_output=True, text=True)
-        mock_run.assert_any_call(['pacman', '-Q', 'package2'], capture_output=True, text=True)
+        mock_run.assert_not_called()
+
+
+def test_reads_local_db_once(store: Store) -> None:
+    programs_removed = tuple(f"package{i}" for i in range(300))
+    store.state = store.state.update(
+        package_config=store.state.package_config.update(programs_removed=programs_removed)
+    )
+    with (
+        patch('subprocess.run') as mock_run,
+        patch('dfu.plugins.pacman.read_local_db', return_value={}) as mock_read_local_db,
+    ):
+        store.dispatch(InstallDependenciesEvent(confirm=False, dry_run=False))
+    mock_read_local_db.assert_called_once_with()
+    mock_run.assert_not_called()
+
+
+def test_records_versions(tmp_path: Path, store: Store) -> None:
+    with mock_snapshots(tmp_path, 'package1', 'package1 package2'):
+        store.dispatch(UpdateInstalledDependenciesEvent(from_index=0, to_index=1))
+    assert store.state.package_config.program_versions == {'package2': '1.0-1'}
+
+
+def test_export_packages(tmp_path: Path, store: Store) -> None:
+    store.state = store.state.update(package_dir=tmp_path / 'package')
+    store.state.package_dir.mkdir()
+    cache_dir = snapshot_dir(tmp_path, 2) / 'var' / 'cache' / 'pacman' / 'pkg'
+    cache_dir.mkdir(parents=True)
+    for name in (
+        'package2-1.0-1-x86_64.pkg.tar.zst',
+        'package2-1.0-1-x86_64.pkg.tar.zst.sig',
+        'package2-0.9-1-x86_64.pkg.tar.zst',
+        'package3-1.0-1-any.pkg.tar.zst',
+    ):
+        (cache_dir / name).write_text(name)
+    with mock_snapshots(tmp_path, 'package1', 'package1 package2 package3'):
+        store.dispatch(UpdateInstalledDependenciesEvent(from_index=0, to_index=1, export_packages=True))
+    # The cached package3 archive has a different architecture than the installed one, so it isn't exported
+    assert sorted(path.name for path in (store.state.package_dir / 'packages').iterdir()) == [
+        'package2-1.0-1-x86_64.pkg.tar.zst',
+        'package2-1.0-1-x86_64.pkg.tar.zst.sig',
+    ]
+
+
+def test_export_packages_on_join(tmp_path: Path, store: Store) -> None:
+    store.state = store.state.update(package_dir=tmp_path / 'package')
+    store.state.package_dir.mkdir()
+    cache_dir = snapshot_dir(tmp_path, 2) / 'var' / 'cache' / 'pacman' / 'pkg'
+    cache_dir.mkdir(parents=True)
+    (cache_dir / 'package2-1.0-1-x86_64.pkg.tar.zst').write_text('package2')
+    with mock_snapshots(tmp_path, 'package1', 'package1 package2'):
+        pending = store.dispatch_async(UpdateInstalledDependenciesEvent(from_index=0, to_index=1, export_packages=True))
+        for future in pending.futures:
+            future.result()
+        # dfu diff can still be aborted, so nothing is written to the package yet
+        assert not (store.state.package_dir / 'packages').exists()
+        pending.join()
+    assert [path.name for path in (store.state.package_dir / 'packages').iterdir()] == [
+        'package2-1.0-1-x86_64.pkg.tar.zst'
+    ]
+
+
+def test_install_exported_packages(tmp_path: Path, store: Store) -> None:
+    packages_dir = tmp_path / 'packages'
+    packages_dir.mkdir()
+    for name in (
+        'package1-1.0-1-x86_64.pkg.tar.zst',
+        'package1-1.0-1-x86_64.pkg.tar.zst.sig',
+        'package1-extra-1.0-1-x86_64.pkg.tar.zst',
+        'package2-0.9-1-x86_64.pkg.tar.zst',
+    ):
+        (packages_dir / name).write_text(name)
+    store.state = store.state.update(
+        package_dir=tmp_path,
+        package_config=store.state.package_config.update(
+            programs_added=('package1', 'package2', 'package3'),
+            program_versions=MappingProxyType({'package1': '1.0-1', 'package2': '1.0-1'}),
+        ),
+    )
+    with patch('subprocess.run') as mock_run:
+        store.dispatch(InstallDependenciesEvent(confirm=False, dry_run=False))
+    assert mock_run.call_args_list == [
+        call(
+            [
+                'sudo',
+                'pacman',
+                '-U',
+                '--needed',
+                '--noconfirm',
+                str(packages_dir / 'package1-1.0-1-x86_64.pkg.tar.zst'),
+            ],
+            check=True,
+        ),
+        call(['sudo', 'pacman', '-S', '--needed', '--noconfirm', 'package2', 'package3'], check=True),
+    ]
+
+
+def test_install_exported_packages_of_several_packages(tmp_path: Path, store: Store) -> None:
+    # dfu apply installs the programs of every package with the first package's store
+    package_dirs = (tmp_path / 'first', tmp_path / 'second')
+    for package_dir, name in zip(
+        package_dirs, ('package1-1.0-1-x86_64.pkg.tar.zst', 'package2-1.0-1-x86_64.pkg.tar.zst')
+    ):
+        (package_dir / 'packages').mkdir(parents=True)
+        (package_dir / 'packages' / name).write_text(name)
+    store.state = store.state.update(
+        package_dir=package_dirs[0],
+        package_config=store.state.package_config.update(
+            programs_added=('package1', 'package2'),
+            program_versions=MappingProxyType({'package1': '1.0-1', 'package2': '1.0-1'}),
+        ),
+    )
+    with patch('subprocess.run') as mock_run:
+        store.dispatch(InstallDependenciesEvent(confirm=False, dry_run=False, package_dirs=package_dirs))
+    mock_run.assert_called_once_with(
+        [
+            'sudo',
+            'pacman',
+            '-U',
+            '--needed',
+            '--noconfirm',
+            str(package_dirs[0] / 'packages' / 'package1-1.0-1-x86_64.pkg.tar.zst'),
+            str(package_dirs[1] / 'packages' / 'package2-1.0-1-x86_64.pkg.tar.zst'),
+        ],
+        check=True,
+    )
+
+
+def test_update_installed_packages_async(tmp_path: Path, store: Store) -> None:
+    with mock_snapshots(tmp_path, 'package1 package2', 'package1 package3'):
+        pending = store.dispatch_async(UpdateInstalledDependenciesEvent(from_index=0, to_index=1))
+        pending.join()
+    assert store.state.package_config.programs_added == ('package3',)
+    assert store.state.package_config.programs_removed == ('package2',)
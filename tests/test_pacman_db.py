@@ -0,0 +1,175 @@
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Generator
+from unittest.mock import Mock, patch
+
+import pytest
+
+from dfu.config import Config
+from dfu.plugins.pacman_db import (
+    LOCAL_DB_PATH,
+    InstalledPackage,
+    _mount_order,
+    _path_in_snapshot,
+    _snapshot_packages,
+    parse_desc,
+    read_local_db,
+    snapshot_packages,
+)
+from dfu.snapshots.environment import Environment
+from dfu.snapshots.snapper import Snapper, SnapperName
+
+DESC = """%NAME%
+vim
+%VERSION%
+9.1.0-1
+
+%DESC%
+Vi Improved, a highly configurable, improved version of the vi text editor
+
+%LICENSE%
+custom:vim
+MIT
+
+%REASON%
+1
+
+%DEPENDS%
+vim-runtime=9.1.0-1
+gpm
+"""
+
+
+@pytest.fixture
+def local_db(tmp_path: Path) -> Path:
+    db_dir = tmp_path / 'var' / 'lib' / 'pacman' / 'local'
+    db_dir.mkdir(parents=True)
+    (db_dir / 'ALPM_DB_VERSION').write_text('9\n')
+    (db_dir / 'vim-9.1.0-1').mkdir()
+    (db_dir / 'vim-9.1.0-1' / 'desc').write_text(DESC)
+    (db_dir / 'vim-9.1.0-1' / 'files').write_text('%FILES%\nusr/\nusr/bin/\nusr/bin/vim\n')
+    (db_dir / 'base-3-2').mkdir()
+    (db_dir / 'base-3-2' / 'desc').write_text('%NAME%\nbase\n\n%VERSION%\n3-2\n\n')
+    # pacman can leave behind a directory without a desc file if it's interrupted
+    (db_dir / 'broken-1-1').mkdir()
+    return db_dir
+
+
+@pytest.fixture(autouse=True)
+def clear_snapshot_cache() -> Generator[None, None, None]:
+    yield
+    _snapshot_packages.cache_clear()
+
+
+def test_parse_desc() -> None:
+    assert parse_desc(DESC) == InstalledPackage(name='vim', version='9.1.0-1', explicit=False)
+
+
+def test_parse_desc_explicit() -> None:
+    assert parse_desc('%NAME%\nbase\n\n%VERSION%\n3-2\n\n%REASON%\n0\n') == InstalledPackage(
+        name='base', version='3-2', explicit=True
+    )
+
+
+def test_parse_desc_without_name() -> None:
+    assert parse_desc('%VERSION%\n3-2\n') is None
+
+
+def test_read_local_db(local_db: Path) -> None:
+    assert read_local_db(local_db) == {
+        'vim': InstalledPackage(name='vim', version='9.1.0-1', explicit=False),
+        'base': InstalledPackage(name='base', version='3-2', explicit=True),
+    }
+
+
+def test_read_local_db_missing(tmp_path: Path) -> None:
+    with pytest.raises(FileNotFoundError):
+        read_local_db(tmp_path / 'missing')
+
+
+def test_read_local_db_privileged(local_db: Path) -> None:
+    original_subprocess_run = subprocess.run
+
+    def side_effect(args: list[str], **kwargs: Any) -> subprocess.CompletedProcess[str]:
+        assert args[0] == 'sudo'
+        return original_subprocess_run(args[1:], **kwargs)
+
+    with (
+        patch('os.scandir', side_effect=PermissionError) as mock_scandir,
+        patch('subprocess.run', side_effect=side_effect) as mock_run,
+    ):
+        packages = read_local_db(local_db)
+    mock_scandir.assert_called_once()
+    mock_run.assert_called_once()
+    assert packages == read_local_db(local_db)
+
+
+@contextmanager
+def mock_environment(mountpoints: dict[str, Path]) -> Generator[Mock, None, None]:
+    environment = Environment(
+        key='key', mountpoints=MappingProxyType({name: str(path) for name, path in mountpoints.items()}), subvolumes=()
+    )
+    with patch('dfu.plugins.pacman_db.load_environment', return_value=environment) as mock_load_environment:
+        yield mock_load_environment
+
+
+def write_snapshot_db(mountpoint: Path, snapshot_id: int, db_path: Path = LOCAL_DB_PATH) -> Path:
+    db_dir = mountpoint / '.snapshots' / str(snapshot_id) / 'snapshot' / db_path.relative_to('/')
+    (db_dir / 'vim-9.1.0-1').mkdir(parents=True)
+    (db_dir / 'vim-9.1.0-1' / 'desc').write_text(DESC)
+    return db_dir
+
+
+def test_snapshot_packages_cached(tmp_path: Path, config: Config) -> None:
+    snapshot = MappingProxyType({SnapperName('root'): 1, SnapperName('home'): 1})
+    write_snapshot_db(tmp_path / 'root', 1)
+    (tmp_path / 'home' / '.snapshots' / '1').mkdir(parents=True)
+    with (
+        mock_environment({'root': tmp_path / 'root', 'home': tmp_path / 'home'}),
+        patch('dfu.plugins.pacman_db.read_local_db', wraps=read_local_db) as mock_read_local_db,
+        patch('subprocess.run') as mock_run,
+    ):
+        assert set(snapshot_packages(config, snapshot)) == {'vim'}
+        assert set(snapshot_packages(config, snapshot)) == {'vim'}
+    assert mock_read_local_db.call_count == 1
+    # The mountpoints came from the cached environment, instead of snapper get-config
+    mock_run.assert_not_called()
+
+
+def test_snapshot_packages_unknown_config(tmp_path: Path, config: Config) -> None:
+    # The environment was cached before the config was created
+    write_snapshot_db(tmp_path, 1)
+    with (
+        mock_environment({}),
+        patch.object(Snapper, 'get_mountpoint', return_value=tmp_path) as mock_get_mountpoint,
+    ):
+        assert set(snapshot_packages(config, MappingProxyType({SnapperName('root'): 1}))) == {'vim'}
+    mock_get_mountpoint.assert_called_once()
+
+
+def test_snapshot_packages_reused_id(tmp_path: Path, config: Config) -> None:
+    snapshots = tmp_path / '.snapshots'
+    write_snapshot_db(tmp_path, 1)
+    snapshot = MappingProxyType({SnapperName('root'): 1})
+    with mock_environment({'root': tmp_path}):
+        assert set(snapshot_packages(config, snapshot)) == {'vim'}
+        # The snapshot was deleted, and snapper created a new snapshot with the same id
+        (snapshots / '1').rename(tmp_path / 'deleted')
+        (snapshots / '1' / 'snapshot' / 'var' / 'lib' / 'pacman' / 'local').mkdir(parents=True)
+        assert set(snapshot_packages(config, snapshot)) == set()
+
+
+def test_path_in_nested_config(config: Config) -> None:
+    # The log config is mounted at /var, so the database is in its snapshot
+    snapshot = MappingProxyType({SnapperName('root'): 1, SnapperName('log'): 5})
+    with mock_environment({'root': Path('/'), 'log': Path('/var')}):
+        mounts = _mount_order(config, snapshot)
+    assert _path_in_snapshot(mounts, LOCAL_DB_PATH) == Path('/var/.snapshots/5/snapshot/lib/pacman/local')
+    assert _path_in_snapshot(mounts, Path('/etc/pacman.conf')) == Path('/.snapshots/1/snapshot/etc/pacman.conf')
+
+
+def test_snapshot_packages_no_snapshots(config: Config) -> None:
+    with pytest.raises(ValueError, match='No snapshots to mount'):
+        snapshot_packages(config, MappingProxyType({}))
@@ -1,4 +1,7 @@
+import os
+import re
 import subprocess
+import time
 from pathlib import Path
 from shutil import copy, rmtree
 from typing import Any, Generator
@@ -6,7 +9,9 @@ from unittest.mock import Mock, patch
 
 import pytest
 
-from dfu.api.playground import CopyFile, Playground
+from dfu.api.playground import CopyFile, Playground, find_leaked_playgrounds
+from dfu.config import LargeFiles
+from dfu.package.objects import ObjectPointer, ObjectStore
 from dfu.revision.git import git_add, git_bundle, git_commit, git_diff, git_init
 
 
@@ -197,6 +202,51 @@ def test_list_files_multiple_actions(tmp_path: Path, playground: Playground, set
     }
 
 
+def test_list_permission_files_in_patch(tmp_path: Path, playground: Playground, setup_git: None) -> None:
+    (tmp_path / 'files' / 'etc').mkdir(parents=True, exist_ok=True)
+    (tmp_path / 'files' / 'etc' / 'modified.txt').write_text('before')
+    (tmp_path / 'acl.txt').write_text(
+        "/etc 755 root root\n/etc/chmod.txt 644 root root\n"
+        "/etc/modified.txt 644 root root\n/etc/unchanged.txt 644 root root\n"
+    )
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'files' / 'etc' / 'modified.txt').write_text('after')
+    (tmp_path / 'files' / 'new').mkdir()
+    (tmp_path / 'files' / 'new' / 'created.txt').write_text('created')
+    (tmp_path / 'acl.txt').write_text(
+        "/etc 755 root root\n/etc/chmod.txt 600 user user\n/etc/modified.txt 600 root root\n"
+        "/etc/unchanged.txt 644 root root\n/new 755 root root\n/new/created.txt 644 root root\n"
+    )
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Modified files')
+    patch = tmp_path / "changes.patch"
+    patch.write_text(git_diff(tmp_path, "HEAD~1", "HEAD"))
+
+    assert playground.list_permission_files_in_patch(patch) == {Path('/etc/chmod.txt')}
+    assert set(playground.list_acl_changes_in_patch(patch).entries.keys()) == {
+        '/etc/chmod.txt',
+        '/etc/modified.txt',
+        '/new',
+        '/new/created.txt',
+    }
+
+
+def test_list_permission_files_in_patch_without_acl(tmp_path: Path, playground: Playground, setup_git: None) -> None:
+    test_file = tmp_path / 'files' / 'file.txt'
+    test_file.parent.mkdir(parents=True, exist_ok=True)
+    test_file.write_text('hello')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Initial commit')
+    test_file.write_text('world')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Modified file')
+    patch = tmp_path / "changes.patch"
+    patch.write_text(git_diff(tmp_path, "HEAD~1", "HEAD"))
+
+    assert playground.list_permission_files_in_patch(patch) == set()
+
+
 def test_copy_files_from_filesystem_no_files(playground: Playground) -> None:
     playground.copy_files_from_filesystem([])
     assert not (playground.location / 'files').exists()
@@ -222,6 +272,40 @@ def test_copy_files_from_filesystem_absolute_file_with_dest(
     assert expected.read_text() == 'hello\nworld'
 
 
+def test_copy_files_from_filesystem_recursive(tmp_path: Path, playground: Playground, mock_subprocess: Mock) -> None:
+    directory = tmp_path / 'tool'
+    (directory / 'bin').mkdir(parents=True)
+    (directory / 'bin' / 'tool').write_text('tool')
+    (directory / 'README').write_text('readme')
+    playground.copy_files_from_filesystem([CopyFile(source=directory, target=Path('/opt/tool'), recursive=True)])
+
+    assert mock_subprocess.call_args_list[0][0][0][:3] == ["sudo", "cp", "--recursive"]
+    expected = playground.location / 'files' / 'opt' / 'tool'
+    assert (expected / 'bin' / 'tool').read_text() == 'tool'
+    assert (expected / 'README').read_text() == 'readme'
+
+
+def test_copy_files_without_sudo(tmp_path: Path, playground: Playground) -> None:
+    root = tmp_path / 'root'
+    (root / 'etc').mkdir(parents=True)
+    (root / 'etc' / 'file.txt').write_text('hello')
+    original_subprocess_run = subprocess.run
+
+    def side_effect(args: list[str], **kwargs: Any) -> subprocess.CompletedProcess[bytes]:
+        assert args[0] != "sudo"
+        if args[0] in ('chown', 'chmod'):
+            return subprocess.CompletedProcess(args, 0)
+        return original_subprocess_run(args, **kwargs)
+
+    with patch('subprocess.run', side_effect=side_effect):
+        playground.copy_files_from_filesystem(
+            [CopyFile(source=root / 'etc' / 'file.txt', target=Path('/etc/file.txt'))], sudo=False
+        )
+        (playground.location / 'files' / 'etc' / 'file.txt').write_text('world')
+        playground.copy_files_to_filesystem(dest=root, sudo=False)
+    assert (root / 'etc' / 'file.txt').read_text() == 'world'
+
+
 def test_copy_protected_file(
     tmp_path: Path, playground: Playground, mock_subprocess: Mock, current_user: str, current_group: str
 ) -> None:
@@ -471,7 +555,39 @@ def test_apply_patches_merge_conflict(playground: Playground, file_patch: Path)
     git_add(playground.location, ['files'])
     git_commit(playground.location, 'Added file')
     assert not playground.apply_patch(file_patch)
-    assert file.read_text() == FILE_MERGE_CONFLICT
+    # With a bundle, the commits are merged, so the conflict markers are labelled with the commits
+    assert re.match(r'^<<<<<<< HEAD\nthis is a conflict\n={7}\nfile\n>>>>>>> [0-9a-f]+ \(.*\)\n$', file.read_text())
+    assert not (playground.location / 'config.json').exists()
+
+
+def test_apply_patch_merge_renames(playground: Playground, patch_playground: Playground, tmp_path: Path) -> None:
+    content = "".join(f"line {i}\n" for i in range(20))
+    (patch_playground.location / 'files').mkdir()
+    (patch_playground.location / 'files' / 'old.txt').write_text(content)
+    git_add(patch_playground.location, ['files'])
+    git_commit(patch_playground.location, 'Initial files')
+    (patch_playground.location / 'files' / 'old.txt').rename(patch_playground.location / 'files' / 'new.txt')
+    (patch_playground.location / 'config.json').write_text('{"pack_format": 2, "version": "1.0.0"}')
+    git_add(patch_playground.location, ['-A', '.'])
+    git_commit(patch_playground.location, 'Renamed old.txt')
+    patch_file = tmp_path / "rename.patch"
+    patch_file.write_text(git_diff(patch_playground.location, "HEAD~1", "HEAD"))
+    git_bundle(patch_playground.location, patch_file.with_suffix('.pack'))
+
+    # The base file was modified locally, which is merged into the renamed file
+    (playground.location / 'files').mkdir()
+    (playground.location / 'files' / 'old.txt').write_text(content.replace('line 0\n', 'local change\n'))
+    git_add(playground.location, ['files'])
+    git_commit(playground.location, 'Initial files')
+    assert playground.apply_patch(patch_file)
+    assert not (playground.location / 'files' / 'old.txt').exists()
+    assert (playground.location / 'files' / 'new.txt').read_text() == content.replace('line 0\n', 'local change\n')
+    assert not (playground.location / 'config.json').exists()
+
+    git_commit(playground.location, 'Applied the patch')
+    assert playground.apply_patch(patch_file, reverse=True)
+    assert (playground.location / 'files' / 'old.txt').exists()
+    assert not (playground.location / 'files' / 'new.txt').exists()
 
 
 def test_apply_patches_other_error(tmp_path: Path, playground: Playground, file_patch: Path) -> None:
@@ -545,3 +661,160 @@ def test_playground_apply_patch_reverse_version_validation(patch_playground: Pla
     except (subprocess.CalledProcessError, ValueError) as e:
         assert "Unsupported pack version" not in str(e)
         assert "does not contain config.json" not in str(e)
+
+
+def test_externalize_large_files_and_restore(playground: Playground, tmp_path: Path) -> None:
+    objects = ObjectStore(tmp_path / "objects")
+    files = playground.location / 'files'
+    (files / 'etc').mkdir(parents=True)
+    (files / 'etc' / 'small.txt').write_text('small')
+    (files / 'etc' / 'large.txt').write_text('large' * 100)
+    (files / 'etc' / 'binary.db').write_bytes(b'\0binary')
+    (files / 'etc' / 'link').symlink_to('large.txt')
+
+    assert playground.externalize_large_files(objects, LargeFiles(max_size=100, binary=True)) == 2
+    assert (files / 'etc' / 'small.txt').read_text() == 'small'
+    large_pointer = ObjectPointer.from_file(files / 'etc' / 'large.txt')
+    binary_pointer = ObjectPointer.from_file(files / 'etc' / 'binary.db')
+    assert large_pointer is not None and objects.contains(large_pointer)
+    assert binary_pointer is not None and objects.contains(binary_pointer)
+    assert (files / 'etc' / 'link').is_symlink()
+
+    # Pointers are never externalized a second time
+    assert playground.externalize_large_files(objects, LargeFiles(max_size=1, binary=True)) == 1
+    assert ObjectPointer.from_file(files / 'etc' / 'large.txt') == large_pointer
+
+    git_add(playground.location, ['.'])
+    git_commit(playground.location, 'Pointers')
+    original_subprocess_run = subprocess.run
+
+    def side_effect(args: list[str], **kwargs: Any) -> subprocess.CompletedProcess[bytes]:
+        return original_subprocess_run(args[1:] if args[0] == 'sudo' else args, **kwargs)
+
+    with patch('subprocess.run', side_effect=side_effect):
+        playground.restore_objects([ObjectStore(tmp_path / "empty"), objects])
+    assert (files / 'etc' / 'large.txt').read_text() == 'large' * 100
+    assert (files / 'etc' / 'binary.db').read_bytes() == b'\0binary'
+
+
+def test_restore_objects_missing_object(playground: Playground, tmp_path: Path) -> None:
+    file = playground.location / 'files' / 'file.txt'
+    file.parent.mkdir(parents=True)
+    file.write_text(ObjectPointer(digest='a' * 64, size=5).encode())
+    git_add(playground.location, ['.'])
+    git_commit(playground.location, 'Pointer')
+    with pytest.raises(ValueError, match="not found"):
+        playground.restore_objects([ObjectStore(tmp_path / "objects")])
+
+
+def test_list_object_files_in_patch(tmp_path: Path, playground: Playground, setup_git: None) -> None:
+    before = ObjectPointer(digest='a' * 64, size=5).encode()
+    after = ObjectPointer(digest='b' * 64, size=5).encode()
+    (tmp_path / 'files').mkdir()
+    (tmp_path / 'files' / 'modified.db').write_text(before)
+    (tmp_path / 'files' / 'shrunk.db').write_text(before)
+    (tmp_path / 'files' / 'text.txt').write_text('hello')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Initial commit')
+    (tmp_path / 'files' / 'modified.db').write_text(after)
+    (tmp_path / 'files' / 'shrunk.db').write_text('small now')
+    (tmp_path / 'files' / 'created.db').write_text(after)
+    (tmp_path / 'files' / 'text.txt').write_text('world')
+    git_add(tmp_path, ['.'])
+    git_commit(tmp_path, 'Modified files')
+    patch_file = tmp_path / "changes.patch"
+    patch_file.write_text(git_diff(tmp_path, "HEAD~1", "HEAD"))
+
+    assert playground.list_object_files_in_patch(patch_file) == {Path('/modified.db'), Path('/shrunk.db')}
+    # Reversing the patch starts from the files after the patch
+    assert playground.list_object_files_in_patch(patch_file, reverse=True) == {
+        Path('/modified.db'),
+        Path('/created.db'),
+    }
+
+
+def test_cleanup_renames_before_removing(playground: Playground) -> None:
+    location = playground.location
+    (location / 'file.txt').write_text('file')
+    with patch('dfu.api.playground.rmtree') as mock_rmtree, patch('subprocess.run') as mock_run:
+        playground.cleanup()
+    assert not location.exists()
+    trash = Path(mock_rmtree.call_args[0][0])
+    assert trash.parent == location.parent
+    assert trash.name.startswith(f"dfu_trash_{location.name}_")
+    # rmtree was mocked, so the files are removed with sudo
+    assert mock_run.call_args[0][0] == ["sudo", "rm", "--recursive", "--force", "--one-file-system", "--", str(trash)]
+    rmtree(trash)
+
+
+def test_cleanup_without_sudo(playground: Playground) -> None:
+    (playground.location / 'file.txt').write_text('file')
+    with patch('subprocess.run') as mock_run:
+        playground.cleanup()
+    assert not playground.location.exists()
+    assert list(playground.location.parent.glob(f"dfu_trash_{playground.location.name}_*")) == []
+    mock_run.assert_not_called()
+
+
+def test_cleanup_background(playground: Playground) -> None:
+    location = playground.location
+    (location / 'file.txt').write_text('file')
+    playground.cleanup(background=True)
+    assert not location.exists()
+    for _ in range(100):
+        if not list(location.parent.glob(f"dfu_trash_{location.name}_*")):
+            break
+        time.sleep(0.05)
+    assert list(location.parent.glob(f"dfu_trash_{location.name}_*")) == []
+
+
+def test_cleanup_background_root_owned(playground: Playground) -> None:
+    location = playground.location
+    (location / 'files' / 'etc').mkdir(parents=True)
+    (location / 'files' / 'etc' / 'fstab').write_text('fstab')
+
+    def access(path: str, mode: int) -> bool:
+        # Simulates dfu apply chowning files/etc to root
+        return not path.endswith('/files/etc')
+
+    with (
+        patch('dfu.api.playground.os.access', side_effect=access),
+        patch('dfu.api.playground.rmtree') as mock_rmtree,
+        patch('subprocess.run') as mock_run,
+    ):
+        playground.cleanup(background=True)
+    assert not location.exists()
+    trash = Path(mock_rmtree.call_args[0][0])
+    # The files are removed with sudo before dfu exits, instead of in a detached shell which can't use sudo
+    mock_run.assert_called_once_with(
+        ["sudo", "rm", "--recursive", "--force", "--one-file-system", "--", str(trash)],
+        check=True,
+        text=True,
+        capture_output=True,
+    )
+    rmtree(trash)
+
+
+def test_temporary_playgrounds_are_collected(tmp_path: Path) -> None:
+    with patch('tempfile.tempdir', str(tmp_path)), Playground.temporary() as playground:
+        assert find_leaked_playgrounds(tmp_path) == []
+        # Simulates a dfu process that exited without removing its playground
+        assert playground._lock_fd is not None
+        os.close(playground._lock_fd)
+        playground._lock_fd = None
+        assert find_leaked_playgrounds(tmp_path) == [playground.location]
+
+
+def test_find_leaked_playgrounds(tmp_path: Path) -> None:
+    in_use = Playground(location=None, prefix=str(tmp_path / "dfu_diff_"))
+    leaked = Playground(location=None, prefix=str(tmp_path / "dfu_squash_"))
+    # Simulates a dfu process that exited without removing its playground
+    assert leaked._lock_fd is not None
+    os.close(leaked._lock_fd)
+    trash = tmp_path / "dfu_trash_dfu_apply_1234"
+    trash.mkdir()
+    (tmp_path / "dfu_object_file").write_text("not a playground")
+    (tmp_path / "unrelated").mkdir()
+
+    assert find_leaked_playgrounds(tmp_path) == sorted([leaked.location, trash])
+    in_use.cleanup()
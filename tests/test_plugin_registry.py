@@ -0,0 +1,99 @@
+import os
+import sys
+from importlib.metadata import EntryPoint, EntryPoints
+from pathlib import Path
+from typing import Generator
+from unittest.mock import Mock, patch
+
+import pytest
+
+from dfu.api.plugin_registry import PluginRegistry, PluginSpec, discover_plugins, environment_key, load_registry
+from dfu.plugins.autosave import AutosavePlugin
+from dfu.plugins.pacman import PacmanPlugin
+
+ENTRY_POINTS = EntryPoints(
+    (
+        EntryPoint(name='pacman', value='dfu.plugins.pacman:PacmanPlugin', group='dfu.plugin'),
+        EntryPoint(name='autosave', value='dfu.plugins.autosave:AutosavePlugin', group='dfu.plugin'),
+        EntryPoint(name='legacy', value='dfu.plugins.pacman:entrypoint', group='dfu.plugin'),
+    )
+)
+
+
+@pytest.fixture
+def mock_entry_points() -> Generator[Mock, None, None]:
+    with patch('dfu.api.plugin_registry.entry_points', return_value=ENTRY_POINTS) as mock:
+        yield mock
+
+
+@pytest.fixture
+def site_packages(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    site_packages = tmp_path / 'site-packages'
+    (site_packages / 'dfu-0.0.5.dist-info').mkdir(parents=True)
+    monkeypatch.setattr(sys, 'path', [str(site_packages)])
+    return site_packages
+
+
+def test_discover_plugins(mock_entry_points: Mock) -> None:
+    assert discover_plugins() == (
+        PluginSpec(
+            name='pacman',
+            value='dfu.plugins.pacman:PacmanPlugin',
+            events=(
+                'dfu.api.plugin:UpdateInstalledDependenciesEvent',
+                'dfu.api.plugin:InstallDependenciesEvent',
+                'dfu.api.plugin:UninstallDependenciesEvent',
+            ),
+            subscribes=False,
+        ),
+        PluginSpec(name='autosave', value='dfu.plugins.autosave:AutosavePlugin', events=(), subscribes=True),
+        PluginSpec(name='legacy', value='dfu.plugins.pacman:entrypoint', events=None, subscribes=False),
+    )
+
+
+def test_plugin_spec_load() -> None:
+    assert PluginSpec(name='autosave', value='dfu.plugins.autosave:AutosavePlugin').load() is AutosavePlugin
+
+
+def test_load_registry_is_cached(tmp_path: Path, site_packages: Path, mock_entry_points: Mock) -> None:
+    cache_path = tmp_path / 'cache' / 'plugins.json'
+    registry = load_registry(cache_path)
+    assert [plugin.name for plugin in registry.plugins] == ['pacman', 'autosave', 'legacy']
+    assert PluginRegistry.from_file(cache_path) == registry
+
+    assert load_registry(cache_path) == registry
+    mock_entry_points.assert_called_once()
+
+
+def test_load_registry_environment_changed(tmp_path: Path, site_packages: Path, mock_entry_points: Mock) -> None:
+    cache_path = tmp_path / 'plugins.json'
+    load_registry(cache_path)
+    (site_packages / 'dfu_extra_plugin-1.0.dist-info').mkdir()
+    load_registry(cache_path)
+    assert mock_entry_points.call_count == 2
+
+
+def test_load_registry_invalid_cache(tmp_path: Path, site_packages: Path, mock_entry_points: Mock) -> None:
+    cache_path = tmp_path / 'plugins.json'
+    cache_path.write_text('{"plugins": "not a registry"}')
+    assert len(load_registry(cache_path).plugins) == 3
+    assert len(PluginRegistry.from_file(cache_path).plugins) == 3
+
+
+def test_environment_key_uses_mtimes(site_packages: Path) -> None:
+    key = environment_key()
+    assert environment_key() == key
+    dist_info = site_packages / 'dfu-0.0.5.dist-info'
+    os.utime(dist_info, ns=(0, dist_info.stat().st_mtime_ns + 1_000_000_000))
+    assert environment_key() != key
+
+
+def test_environment_key_ignores_missing_paths(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(sys, 'path', [str(tmp_path / 'missing'), str(tmp_path / 'file.zip')])
+    (tmp_path / 'file.zip').write_text('')
+    assert environment_key()
+
+
+def test_pacman_plugin_declares_events() -> None:
+    assert PacmanPlugin.events is not None
+    assert not PacmanPlugin.subscribes
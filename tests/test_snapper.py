@@ -1,18 +1,23 @@
 import json
+import os
 import subprocess
 from pathlib import Path
-from typing import Any
+from typing import Any, Generator
 from unittest.mock import MagicMock, Mock, patch
 
 import pytest
 
-from dfu.snapshots.snapper import Snapper, SnapperConfigInfo, SnapperName
+from dfu.snapshots.snapper import Snapper, SnapperConfigInfo, SnapperName, snapshot_identity
 from dfu.snapshots.snapper_diff import FileChangeAction, SnapperDiff
 
 
 @pytest.fixture
-def snapper_instance() -> Snapper:
-    return Snapper(SnapperName('test'))
+def snapper_instance() -> Generator[Snapper, None, None]:
+    with (
+        patch.object(Snapper, 'get_mountpoint', return_value=Path('/test')),
+        patch('dfu.snapshots.snapper.snapshot_identity', return_value=('1:1', '2:2')),
+    ):
+        yield Snapper(SnapperName('test'))
 
 
 @patch('subprocess.run')
@@ -46,6 +51,21 @@ def test_get_mountpoint_subprocess_error(mock_run: Mock) -> None:
         snapper.get_mountpoint()
 
 
+@patch('subprocess.run')
+def test_get_mountpoint_cached(mock_run: Mock, tmp_path: Path) -> None:
+    mock_run.return_value = Mock(stdout='{"SUBVOLUME": "/test"}')
+    snapper = Snapper(SnapperName('test'))
+    (tmp_path / 'test').write_text('SUBVOLUME="/test"\n')
+    with patch('dfu.snapshots.snapper.SNAPPER_CONFIGS_DIR', tmp_path):
+        assert snapper.get_mountpoint() == Path('/test')
+        assert Snapper(SnapperName('test')).get_mountpoint() == Path('/test')
+        mock_run.assert_called_once()
+        # The config was edited
+        mock_run.return_value = Mock(stdout='{"SUBVOLUME": "/other"}')
+        os.utime(tmp_path / 'test', ns=(0, 0))
+        assert snapper.get_mountpoint() == Path('/other')
+
+
 @patch('subprocess.run')
 def test_create_snapshot_success(mock_run: Mock) -> None:
     mock_run.return_value = Mock(stdout='1\n')
@@ -110,6 +130,32 @@ def test_get_delta_different_actions_and_permissions(mock_run: Mock, snapper_ins
     assert result == expected_result
 
 
+@patch('subprocess.run')
+def test_get_delta_cached(mock_run: Mock, snapper_instance: Snapper) -> None:
+    mock_run.return_value = MagicMock(stdout='+..... test\n')
+    assert snapper_instance.get_delta(1, 2) == snapper_instance.get_delta(1, 2)
+    mock_run.assert_called_once()
+    # The snapshots were deleted, and new snapshots reused their ids
+    with patch('dfu.snapshots.snapper.snapshot_identity', return_value=('3:3', '4:4')):
+        snapper_instance.get_delta(1, 2)
+    assert mock_run.call_count == 2
+
+
+def test_snapshot_identity(tmp_path: Path) -> None:
+    (tmp_path / '1').mkdir()
+    stat = os.stat(tmp_path / '1')
+    assert snapshot_identity([tmp_path / '1']) == (f"{stat.st_ino}:{int(stat.st_ctime)}",)
+
+
+@patch('subprocess.run')
+def test_snapshot_identity_privileged(mock_run: Mock) -> None:
+    mock_run.return_value = Mock(stdout='10:100\n20:200\n')
+    directories = [Path('/.snapshots/1'), Path('/.snapshots/2')]
+    with patch('os.stat', side_effect=PermissionError):
+        assert snapshot_identity(directories) == ('10:100', '20:200')
+    assert mock_run.call_args[0][0] == ['sudo', 'stat', '--format=%i:%Z', '--', '/.snapshots/1', '/.snapshots/2']
+
+
 @patch('subprocess.run')
 def test_get_snapshot_path(mock_run: Mock) -> None:
     mock_run.return_value = Mock(stdout='{"SUBVOLUME": "/test"}')
@@ -0,0 +1,218 @@
+import json
+import subprocess
+from pathlib import Path
+from typing import Generator
+from unittest.mock import patch
+
+import pytest
+
+from dfu.api import Playground, State, Store
+from dfu.commands.squash import _acl_changes, _compose_patches, _read_acl, _verify_patches, squash_patches
+from dfu.config import Config
+from dfu.package.acl_file import AclEntry
+from dfu.package.package_config import PackageConfig
+from dfu.revision.git import git_add, git_bundle, git_commit, git_diff, git_init, git_rev_parse, git_show
+
+
+@pytest.fixture(autouse=True)
+def git_identity(monkeypatch: pytest.MonkeyPatch) -> None:
+    # The squash playground is a new repository, so the identity can't be configured in it
+    for variable, value in (('NAME', 'myself'), ('EMAIL', 'me@example.com')):
+        monkeypatch.setenv(f'GIT_AUTHOR_{variable}', value)
+        monkeypatch.setenv(f'GIT_COMMITTER_{variable}', value)
+
+
+@pytest.fixture
+def package_dir(tmp_path: Path) -> Path:
+    package_dir = tmp_path / 'package'
+    package_dir.mkdir()
+    return package_dir
+
+
+@pytest.fixture
+def store(config: Config, package_config: PackageConfig, package_dir: Path) -> Store:
+    return Store(State(config=config, package_dir=package_dir, package_config=package_config))
+
+
+@pytest.fixture
+def playground(tmp_path: Path) -> Generator[Playground, None, None]:
+    playground = Playground(location=tmp_path / 'playground')
+    playground.location.mkdir()
+    git_init(playground.location)
+    yield playground
+    playground.cleanup()
+
+
+def create_patch(
+    package_dir: Path, name: str, before: dict[str, str], after: dict[str, str], *, acl_before: str, acl_after: str
+) -> Path:
+    """Creates the patch and bundle the same way as dfu diff, from the files before and after the patch"""
+    repo = package_dir.parent / f'repo_{name}'
+    (repo / 'files').mkdir(parents=True)
+    git_init(repo)
+    for path, content in before.items():
+        (repo / 'files' / path).write_text(content)
+    (repo / 'acl.txt').write_text(acl_before)
+    git_add(repo, ['.'])
+    git_commit(repo, 'Initial files')
+    for path in before.keys() - after.keys():
+        (repo / 'files' / path).unlink()
+    for path, content in after.items():
+        (repo / 'files' / path).write_text(content)
+    (repo / 'acl.txt').write_text(acl_after)
+    (repo / 'config.json').write_text(json.dumps({'version': '0.0.4', 'pack_format': 2}))
+    subprocess.run(['git', 'add', '--all'], cwd=repo, check=True)
+    git_commit(repo, 'Modified files')
+    patch_file = package_dir / f'{name}.patch'
+    git_bundle(repo, patch_file.with_suffix('.pack'))
+    patch_file.write_text(git_diff(repo, 'HEAD~1', 'HEAD'))
+    return patch_file
+
+
+def test_squash_patches(package_dir: Path, store: Store) -> None:
+    patches = [
+        create_patch(
+            package_dir,
+            '000_to_001',
+            {'a': 'one\n'},
+            {'a': 'two\n'},
+            acl_before='/a 644 root root\n',
+            acl_after='/a 644 root root\n',
+        ),
+        create_patch(package_dir, '001_to_002', {}, {'b': 'new\n'}, acl_before='', acl_after='/b 600 root root\n'),
+        create_patch(
+            package_dir,
+            '002_to_003',
+            {'a': 'two\n'},
+            {'a': 'three\n'},
+            acl_before='/a 644 root root\n',
+            acl_after='/a 755 root root\n',
+        ),
+    ]
+    squash_patches(store)
+
+    assert sorted(path.name for path in package_dir.iterdir() if path.is_file()) == [
+        '000_to_003.pack',
+        '000_to_003.patch',
+    ]
+    archive = package_dir / 'archive' / '000_to_003'
+    assert sorted(path.name for path in archive.iterdir()) == sorted(
+        name for patch in patches for name in (patch.name, patch.with_suffix('.pack').name)
+    )
+    squashed = (package_dir / '000_to_003.patch').read_text()
+    assert '-one' in squashed and '+three' in squashed and '+new' in squashed
+    assert 'two' not in squashed
+    assert '-/a 644 root root' in squashed and '+/a 755 root root' in squashed
+
+
+def test_squash_patches_failure_keeps_patches(package_dir: Path, store: Store) -> None:
+    for name, before, after in (('000_to_001', 'one\n', 'two\n'), ('001_to_002', 'two\n', 'three\n')):
+        create_patch(
+            package_dir,
+            name,
+            {'a': before},
+            {'a': after},
+            acl_before='/a 644 root root\n',
+            acl_after='/a 644 root root\n',
+        )
+    files = sorted(package_dir.iterdir())
+    with (
+        patch('dfu.commands.squash.git_bundle', side_effect=subprocess.CalledProcessError(1, 'git bundle')),
+        pytest.raises(subprocess.CalledProcessError),
+    ):
+        squash_patches(store)
+    # Nothing was archived, and the squashed patch wasn't left behind
+    assert sorted(package_dir.iterdir()) == files
+
+
+def test_compose_patches_reverted_file(package_dir: Path, playground: Playground) -> None:
+    patches = [
+        create_patch(
+            package_dir,
+            '000_to_001',
+            {'a': 'one\n', 'b': 'one\n'},
+            {'a': 'two\n', 'b': 'two\n'},
+            acl_before='/a 644 root root\n/b 644 root root\n',
+            acl_after='/a 644 root root\n/b 644 root root\n',
+        ),
+        create_patch(
+            package_dir,
+            '001_to_002',
+            {'a': 'two\n'},
+            {'a': 'one\n'},
+            acl_before='/a 644 root root\n',
+            acl_after='/a 644 root root\n',
+        ),
+    ]
+    base_commit, head_commit = _compose_patches(playground, patches)
+    # The file was changed back, so it isn't part of the squashed patch
+    squashed = git_diff(playground.location, base_commit, head_commit)
+    assert 'files/b' in squashed and 'files/a' not in squashed
+    assert git_show(playground.location, head_commit, 'files/a') == 'one\n'
+    _verify_patches(playground, patches, base_commit=base_commit, head_commit=head_commit)
+
+
+def test_compose_patches_acl_only(package_dir: Path, playground: Playground) -> None:
+    patches = [
+        create_patch(
+            package_dir,
+            '000_to_001',
+            {'a': 'one\n'},
+            {'a': 'two\n'},
+            acl_before='/a 644 root root\n',
+            acl_after='/a 644 root root\n',
+        ),
+        # Only the permissions changed, so the patch only changes acl.txt
+        create_patch(
+            package_dir, '001_to_002', {}, {}, acl_before='/a 644 root root\n', acl_after='/a 700 user user\n'
+        ),
+    ]
+    base_commit, head_commit = _compose_patches(playground, patches)
+    assert _read_acl(playground, base_commit).entries == {'/a': AclEntry('/a', '644', 'root', 'root')}
+    assert _read_acl(playground, head_commit).entries == {'/a': AclEntry('/a', '700', 'user', 'user')}
+    _verify_patches(playground, patches, base_commit=base_commit, head_commit=head_commit)
+
+
+def test_verify_patches_failure(package_dir: Path, playground: Playground) -> None:
+    patches = [
+        create_patch(
+            package_dir,
+            '000_to_001',
+            {'a': 'one\n'},
+            {'a': 'two\n'},
+            acl_before='/a 644 root root\n',
+            acl_after='/a 644 root root\n',
+        ),
+        create_patch(
+            package_dir,
+            '001_to_002',
+            {'a': 'two\n'},
+            {'a': 'three\n'},
+            acl_before='/a 644 root root\n',
+            acl_after='/a 644 root root\n',
+        ),
+    ]
+    base_commit, head_commit = _compose_patches(playground, patches)
+    # A squashed patch which is missing a change
+    (playground.location / 'files' / 'a').write_text('two\n')
+    git_add(playground.location, ['.'])
+    git_commit(playground.location, 'Wrong files')
+    with pytest.raises(ValueError, match='does not produce the same files'):
+        _verify_patches(
+            playground, patches, base_commit=base_commit, head_commit=git_rev_parse(playground.location, 'HEAD')
+        )
+
+
+def test_acl_changes(package_dir: Path) -> None:
+    patch_file = create_patch(
+        package_dir,
+        '000_to_001',
+        {},
+        {},
+        acl_before='/a 644 root root\n/b 644 root root\n/c 644 root root\n',
+        acl_after='/a 755 root root\n/c 644 root root\n/d 600 user user\n',
+    )
+    assert _acl_changes(patch_file) == (
+        {'/a', '/b'},
+        {'/a': AclEntry('/a', '755', 'root', 'root'), '/d': AclEntry('/d', '600', 'user', 'user')},
+    )
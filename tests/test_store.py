@@ -1,9 +1,10 @@
+import time
 from pathlib import Path
 from unittest.mock import Mock
 
 import pytest
 
-from dfu.api.plugin import DfuPlugin
+from dfu.api.plugin import DfuPlugin, Event, InstallDependenciesEvent, UninstallDependenciesEvent, event_name
 from dfu.api.state import State
 from dfu.api.store import Callback, Store
 from dfu.config import Config
@@ -72,3 +73,239 @@ def test_add_plugin(state: State) -> None:
     mock_plugin = Mock(spec=DfuPlugin)
     store.add_plugin(mock_plugin)
     assert mock_plugin in store.plugins
+
+
+def test_lazy_plugin_loaded_on_event(state: State) -> None:
+    store = Store(state)
+    plugin = Mock(spec=DfuPlugin)
+    load = Mock(return_value=Mock(return_value=plugin))
+    store.add_lazy_plugin(load, events=[event_name(InstallDependenciesEvent)], subscribes=False)
+
+    store.dispatch(UninstallDependenciesEvent(confirm=False, dry_run=False))
+    store.state = state.update(package_dir=Path("test2"))
+    load.assert_not_called()
+
+    event = InstallDependenciesEvent(confirm=False, dry_run=False)
+    store.dispatch(event)
+    store.dispatch(event)
+    load.assert_called_once_with()
+    load.return_value.assert_called_once_with(store)
+    assert plugin.handle.call_count == 2
+    plugin.handle.assert_called_with(event)
+
+
+def test_lazy_plugin_loaded_on_base_event(state: State) -> None:
+    store = Store(state)
+    load = Mock()
+    store.add_lazy_plugin(load, events=[event_name(Event)], subscribes=False)
+    store.dispatch(InstallDependenciesEvent(confirm=False, dry_run=False))
+    load.assert_called_once_with()
+
+
+def test_lazy_plugin_loaded_on_state_change(state: State) -> None:
+    store = Store(state)
+    mock_callback = Mock(spec=Callback)
+
+    def create_plugin(store: Store) -> DfuPlugin:
+        store.subscribe(mock_callback)
+        return Mock(spec=DfuPlugin)
+
+    load = Mock(return_value=create_plugin)
+    store.add_lazy_plugin(load, events=[], subscribes=True)
+    store.dispatch(InstallDependenciesEvent(confirm=False, dry_run=False))
+    load.assert_not_called()
+
+    new_state = state.update(package_dir=Path("test2"))
+    store.state = new_state
+    load.assert_called_once_with()
+    mock_callback.assert_called_once_with(state, new_state)
+
+
+class AppendDescriptionPlugin(DfuPlugin):
+    concurrent = True
+
+    def __init__(self, store: Store, suffix: str, delay: float) -> None:
+        self.store = store
+        self.suffix = suffix
+        self.delay = delay
+
+    def handle(self, event: Event) -> None:
+        time.sleep(self.delay)
+        self.store.update(
+            lambda state: state.update(
+                package_config=state.package_config.update(
+                    description=f"{state.package_config.description}{self.suffix}"
+                )
+            )
+        )
+
+
+def test_dispatch_async_applies_updates_in_order(state: State) -> None:
+    store = Store(state.update(package_config=state.package_config.update(description="")))
+    # The first plugin finishes last, but its update is still applied first
+    store.add_plugin(AppendDescriptionPlugin(store, "a", delay=0.05))
+    store.add_plugin(AppendDescriptionPlugin(store, "b", delay=0))
+    pending = store.dispatch_async(InstallDependenciesEvent(confirm=False, dry_run=False))
+    assert store.state.package_config.description == ""
+    pending.join()
+    assert store.state.package_config.description == "ab"
+
+
+def test_dispatch_async_runs_other_plugins_right_away(state: State) -> None:
+    store = Store(state)
+    mock_plugin = Mock(spec=DfuPlugin)
+    mock_plugin.concurrent = False
+    store.add_plugin(mock_plugin)
+    event = InstallDependenciesEvent(confirm=False, dry_run=False)
+    pending = store.dispatch_async(event)
+    mock_plugin.handle.assert_called_once_with(event)
+    assert pending.futures == []
+
+
+def test_dispatch_async_raises_on_join(state: State) -> None:
+    class FailingPlugin(DfuPlugin):
+        concurrent = True
+
+        def handle(self, event: Event) -> None:
+            raise ValueError("Failed to handle the event")
+
+    store = Store(state)
+    store.add_plugin(FailingPlugin())
+    pending = store.dispatch_async(InstallDependenciesEvent(confirm=False, dry_run=False))
+    with pytest.raises(ValueError, match="Failed to handle the event"):
+        pending.join()
+
+
+def test_dispatch_async_cancel(state: State) -> None:
+    store = Store(state)
+    action = Mock()
+    store.add_plugin(DeferPlugin(store, action))
+    pending = store.dispatch_async(InstallDependenciesEvent(confirm=False, dry_run=False))
+    pending.cancel()
+    # The plugin finished, but neither its state updates nor its deferred actions are applied
+    assert pending.finished
+    assert all(future.done() for future in pending.futures)
+    assert store.state == state
+    action.assert_not_called()
+
+
+def test_dispatch_async_requires_update(state: State) -> None:
+    class SetStatePlugin(DfuPlugin):
+        concurrent = True
+
+        def __init__(self, store: Store) -> None:
+            self.store = store
+
+        def handle(self, event: Event) -> None:
+            self.store.state = self.store.state.update(package_dir=Path("test2"))
+
+    store = Store(state)
+    store.add_plugin(SetStatePlugin(store))
+    pending = store.dispatch_async(InstallDependenciesEvent(confirm=False, dry_run=False))
+    with pytest.raises(RuntimeError, match="store.update"):
+        pending.join()
+    assert store.state == state
+
+
+class DeferPlugin(DfuPlugin):
+    concurrent = True
+
+    def __init__(self, store: Store, action: Mock) -> None:
+        self.store = store
+        self.action = action
+
+    def handle(self, event: Event) -> None:
+        self.store.update(lambda state: state.update(package_dir=Path("test2")))
+        self.store.defer(lambda: self.action(self.store.state.package_dir))
+
+
+def test_defer_until_join(state: State) -> None:
+    store = Store(state)
+    action = Mock()
+    store.add_plugin(DeferPlugin(store, action))
+    pending = store.dispatch_async(InstallDependenciesEvent(confirm=False, dry_run=False))
+    for future in pending.futures:
+        future.result()
+    action.assert_not_called()
+    pending.join()
+    # The action runs after the state updates before it
+    action.assert_called_once_with(Path("test2"))
+
+
+def test_defer_in_foreground(state: State) -> None:
+    store = Store(state)
+    action = Mock()
+    store.add_plugin(DeferPlugin(store, action))
+    store.dispatch(InstallDependenciesEvent(confirm=False, dry_run=False))
+    action.assert_called_once_with(Path("test2"))
+
+
+def test_update(state: State) -> None:
+    store = Store(state)
+    mock_callback = Mock(spec=Callback)
+    store.subscribe(mock_callback)
+    store.update(lambda state: state.update(package_dir=Path("test2")))
+    assert store.state.package_dir == Path("test2")
+    mock_callback.assert_called_once_with(state, store.state)
+
+
+def test_transaction_notifies_once(state: State) -> None:
+    store = Store(state)
+    mock_callback = Mock(spec=Callback)
+    store.subscribe(mock_callback)
+    with store.transaction():
+        store.state = store.state.update(package_dir=Path("test2"))
+        store.state = store.state.update(package_dir=Path("test3"))
+        mock_callback.assert_not_called()
+    mock_callback.assert_called_once_with(state, store.state)
+    assert store.state.package_dir == Path("test3")
+
+
+def test_nested_transaction(state: State) -> None:
+    store = Store(state)
+    mock_callback = Mock(spec=Callback)
+    store.subscribe(mock_callback)
+    with store.transaction():
+        with store.transaction():
+            store.state = store.state.update(package_dir=Path("test2"))
+        mock_callback.assert_not_called()
+    mock_callback.assert_called_once_with(state, store.state)
+
+
+def test_transaction_without_changes(state: State) -> None:
+    store = Store(state)
+    mock_callback = Mock(spec=Callback)
+    store.subscribe(mock_callback)
+    with store.transaction():
+        pass
+    mock_callback.assert_not_called()
+
+
+def test_transaction_notifies_on_error(state: State) -> None:
+    store = Store(state)
+    mock_callback = Mock(spec=Callback)
+    store.subscribe(mock_callback)
+    with pytest.raises(ValueError), store.transaction():
+        store.state = store.state.update(package_dir=Path("test2"))
+        raise ValueError("test")
+    mock_callback.assert_called_once_with(state, store.state)
+
+
+def test_dispatch_notifies_once(state: State) -> None:
+    store = Store(state)
+    store.add_plugin(AppendDescriptionPlugin(store, " a", delay=0))
+    store.add_plugin(AppendDescriptionPlugin(store, " b", delay=0))
+    mock_callback = Mock(spec=Callback)
+    store.subscribe(mock_callback)
+    store.dispatch(InstallDependenciesEvent(confirm=False, dry_run=False))
+    mock_callback.assert_called_once_with(state, store.state)
+
+
+def test_dispatch_async_join_notifies_once(state: State) -> None:
+    store = Store(state)
+    store.add_plugin(AppendDescriptionPlugin(store, " a", delay=0))
+    store.add_plugin(AppendDescriptionPlugin(store, " b", delay=0))
+    mock_callback = Mock(spec=Callback)
+    store.subscribe(mock_callback)
+    store.dispatch_async(InstallDependenciesEvent(confirm=False, dry_run=False)).join()
+    mock_callback.assert_called_once_with(state, store.state)